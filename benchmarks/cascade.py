@@ -0,0 +1,66 @@
+"""
+Compares the per image latency of DETR-ResNet50 and the fast first stage of
+the detection cascade (FastPetDetector) on the CPU, and the mean latency of
+the cascade at a few fractions of images that take the fast path.
+
+Both models have their full architecture but random weights, so nothing is
+downloaded. Random weights are never confident, so the fast path fraction is
+not measured here but given, it depends on the images: see the "Detector
+cascade" stats that scripts/extract_pets.py --cascade logs.
+
+    python -m benchmarks.cascade --images 4 --fractions 0.5 0.8 0.9
+"""
+from argparse import ArgumentParser, Namespace
+import json
+
+import torch
+from transformers import DetrConfig
+
+from benchmarks.common import environment, measure, random_images
+from lostpaw.data.cascade import FastPetDetector
+from lostpaw.data.extract_pets import DetrPetExtractor
+
+
+def main(args: Namespace):
+    torch.manual_seed(0)
+    # Phone photos decoded for DETR, see lostpaw.data.decode
+    images = random_images(args.images, (1066, 800), seed=6)
+
+    detr = DetrPetExtractor("", config=DetrConfig(use_pretrained_backbone=False))
+    detr.model.eval()
+    fast_detector = FastPetDetector(pretrained=False)
+    fast_detector.load()
+
+    results = dict()
+    with torch.no_grad():
+        results["detr"] = measure(lambda: detr.run_model(images), args.repeat, items=len(images))
+        results["fast"] = measure(
+            lambda: fast_detector.detect(images), args.repeat, items=len(images)
+        )
+        # Random weights send every image on to DETR, the worst case
+        cascade = DetrPetExtractor("", config=detr.config, fast_detector=fast_detector)
+        cascade.model = detr.model
+        cascade.feature_extractor = detr.feature_extractor
+        results["cascade_all_detr"] = measure(
+            lambda: cascade.detect(images), args.repeat, items=len(images)
+        )
+
+    detr_ms = results["detr"]["mean_ms"] / len(images)
+    fast_ms = results["fast"]["mean_ms"] / len(images)
+    results["cascade_estimate"] = {
+        f"fast_path_{fraction}": dict(
+            mean_ms_per_image=fast_ms + (1 - fraction) * detr_ms,
+            speedup=detr_ms / (fast_ms + (1 - fraction) * detr_ms),
+        )
+        for fraction in args.fractions
+    }
+    print(json.dumps(dict(config=vars(args), environment=environment(), results=results), indent=2))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--fractions", type=float, nargs="+", default=[0.5, 0.8, 0.9])
+
+    main(parser.parse_args())
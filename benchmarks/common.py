@@ -0,0 +1,144 @@
+"""
+Helpers shared by the benchmarks: timing statistics, synthetic images and
+datasets, and small randomly initialized models that need no downloads.
+"""
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Dict, List
+import json
+import subprocess
+
+import numpy as np
+from PIL import Image
+from PIL.Image import Image as ImageT
+
+
+def measure(
+    fn: Callable[[], Any], repeat: int = 10, warmup: int = 2, items: int = 1
+) -> Dict[str, float]:
+    """
+    Calls `fn` `warmup + repeat` times and returns latency percentiles of the
+    measured calls and the throughput in items per second, where every call
+    processes `items` items.
+    """
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        times.append(perf_counter() - start)
+
+    times_ms = np.array(times) * 1000
+    return dict(
+        p50_ms=float(np.percentile(times_ms, 50)),
+        p99_ms=float(np.percentile(times_ms, 99)),
+        mean_ms=float(times_ms.mean()),
+        items_per_sec=float(items * repeat / sum(times)),
+        repeat=repeat,
+        items=items,
+    )
+
+
+def random_image(width: int, height: int, rng: np.random.Generator) -> ImageT:
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def random_images(
+    count: int, size=(384, 384), seed: int = 0
+) -> List[ImageT]:
+    rng = np.random.default_rng(seed)
+    return [random_image(size[0], size[1], rng) for _ in range(count)]
+
+
+def letterboxed_images(count: int, size: int = 384, seed: int = 0) -> List[ImageT]:
+    """
+    Random crops of mixed aspect ratios, scaled into a black square like the
+    output of DetrPetExtractor.resize.
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        short = int(size * rng.uniform(0.4, 0.8))
+        width, height = (size, short) if rng.random() < 0.5 else (short, size)
+        square = Image.new("RGB", (size, size), (0, 0, 0))
+        square.paste(random_image(width, height, rng), ((size - width) // 2, (size - height) // 2))
+        images.append(square)
+    return images
+
+
+def synthetic_folder(
+    root: Path,
+    pets: int = 32,
+    records_per_pet: int = 3,
+    size=(384, 384),
+    seed: int = 0,
+) -> Path:
+    """
+    Writes a small dataset of random JPEGs in the layout of PetImagesFolder
+    and returns the path of its info file.
+    """
+    rng = np.random.default_rng(seed)
+    root.mkdir(parents=True, exist_ok=True)
+    info_path = root / "train.data"
+    with open(info_path, "wt") as info:
+        for pet_id in range(pets):
+            pet_folder = root / str(pet_id)
+            pet_folder.mkdir(exist_ok=True)
+            for record in range(records_per_pet):
+                path = pet_folder / f"{record}.jpg"
+                random_image(size[0], size[1], rng).save(path, quality=90)
+                info.write(json.dumps(dict(pet_id=pet_id, paths=[str(path)])) + "\n")
+    return info_path
+
+
+def small_vit_config(image_size: int = 384):
+    from transformers import ViTConfig
+
+    return ViTConfig(
+        image_size=image_size,
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=128,
+    )
+
+
+def small_detr_config():
+    from transformers import DetrConfig
+
+    return DetrConfig(
+        use_pretrained_backbone=False,
+        backbone="resnet18",
+        d_model=64,
+        encoder_layers=1,
+        decoder_layers=1,
+        encoder_attention_heads=2,
+        decoder_attention_heads=2,
+        encoder_ffn_dim=128,
+        decoder_ffn_dim=128,
+        num_queries=20,
+    )
+
+
+def environment() -> Dict[str, Any]:
+    """Describes the code and machine the benchmarks ran on."""
+    import os
+    import platform
+    import torch
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return dict(
+        commit=commit,
+        python=platform.python_version(),
+        torch=torch.__version__,
+        cpu_count=os.cpu_count(),
+        torch_threads=torch.get_num_threads(),
+    )
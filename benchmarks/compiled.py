@@ -0,0 +1,78 @@
+"""
+Compares the embedding throughput of PetViTContrastiveModel in eager mode and
+compiled with torch.compile, on the CPU.
+
+The compiled model pads every batch to one of --buckets, so batch sizes that
+are not a bucket measure the cost of the padding. The model is randomly
+initialized from a ViTConfig, so no pretrained weights are downloaded.
+
+    python -m benchmarks.compiled --batch_sizes 1 3 8 --buckets 1 4 8
+"""
+from argparse import ArgumentParser, Namespace
+from time import perf_counter
+import json
+
+import torch
+from transformers import ViTConfig
+
+from benchmarks.common import environment, measure, random_images
+from lostpaw.model import PetViTContrastiveModel
+
+
+def main(args: Namespace):
+    torch.manual_seed(0)
+    vit_config = ViTConfig(
+        image_size=args.image_size,
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+        intermediate_size=4 * args.hidden_size,
+    )
+    model = PetViTContrastiveModel("", args.latent_space_size, vit_config=vit_config)
+    model.train(False)
+    images = random_images(max(args.batch_sizes), (args.image_size, args.image_size), seed=1)
+    inputs = {size: model.preprocess(images[:size]) for size in args.batch_sizes}
+
+    results = dict(eager=dict(), compiled=dict())
+    with torch.no_grad():
+        eager_outputs = dict()
+        for size, x in inputs.items():
+            eager_outputs[size] = model.embed(x)
+            results["eager"][f"batch_{size}"] = measure(
+                lambda: model.embed(x), args.repeat, items=size
+            )
+
+        start = perf_counter()
+        compiled = model.enable_compile(args.buckets, args.mode)
+        results["compile_seconds"] = perf_counter() - start
+        results["compiled_ok"] = compiled
+
+        for size, x in inputs.items():
+            error = (model.embed(x) - eager_outputs[size]).abs().max()
+            results["compiled"][f"batch_{size}"] = dict(
+                **measure(lambda: model.embed(x), args.repeat, items=size),
+                padded_to=model.compiled.bucket(size),
+                max_abs_difference=float(error),
+            )
+
+    for size in args.batch_sizes:
+        key = f"batch_{size}"
+        results["compiled"][key]["speedup"] = (
+            results["eager"][key]["mean_ms"] / results["compiled"][key]["mean_ms"]
+        )
+    print(json.dumps(dict(config=vars(args), environment=environment(), results=results), indent=2))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 3, 8])
+    parser.add_argument("--buckets", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--mode", type=str, help="mode of torch.compile")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--image_size", type=int, default=384)
+    parser.add_argument("--hidden_size", type=int, default=192)
+    parser.add_argument("--layers", type=int, default=6)
+    parser.add_argument("--heads", type=int, default=3)
+    parser.add_argument("--latent_space_size", type=int, default=128)
+
+    main(parser.parse_args())
@@ -0,0 +1,141 @@
+"""
+Measures the training step time and memory use of PetViTContrastiveModel with
+a trainable and with a frozen ViT backbone.
+
+The model is randomly initialized from a ViTConfig, so no pretrained weights
+are downloaded. Every mode runs in its own process, which makes the peak RSS
+on the CPU comparable between the modes.
+
+    python -m benchmarks.frozen_backbone --steps 10 --batch_size 4
+"""
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from time import perf_counter
+from typing import Any, Dict
+import json
+
+import numpy as np
+import torch
+from torch.optim import AdamW
+from transformers import ViTConfig
+
+from benchmarks.common import random_images
+from lostpaw.model import PetViTContrastiveModel, PetContrastiveLoss
+from lostpaw.model.profiling import peak_rss_bytes
+
+
+def optimizer_state_bytes(optimizer: torch.optim.Optimizer) -> int:
+    return sum(
+        v.numel() * v.element_size()
+        for state in optimizer.state.values()
+        for v in state.values()
+        if isinstance(v, torch.Tensor)
+    )
+
+
+def run_mode(args: Namespace, frozen: bool) -> Dict[str, Any]:
+    torch.manual_seed(0)
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    vit_config = ViTConfig(
+        image_size=args.image_size,
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+        intermediate_size=4 * args.hidden_size,
+    )
+    model = PetViTContrastiveModel(
+        "", args.latent_space_size, device=device, vit_config=vit_config, head_rank=args.head_rank
+    ).to(device)
+    model.train()
+    if frozen:
+        model.freeze_backbone()
+
+    loss_fn = PetContrastiveLoss()
+    optimizer = AdamW(model.trainable_parameters(), lr=1e-4)
+
+    size = (args.image_size, args.image_size)
+    imgs1 = random_images(args.batch_size, size, seed=1)
+    imgs2 = random_images(args.batch_size, size, seed=2)
+    labels = torch.randint(0, 2, (args.batch_size,), dtype=torch.float32).to(device)
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+
+    times = []
+    for step in range(args.warmup + args.steps):
+        start = perf_counter()
+        optimizer.zero_grad()
+        features = torch.stack([model(imgs1), model(imgs2)], dim=1)
+        loss = loss_fn(features, labels)
+        loss.backward()
+        optimizer.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        if step >= args.warmup:
+            times.append(perf_counter() - start)
+
+    result = dict(
+        frozen=frozen,
+        device=device.type,
+        trainable_parameters=sum(p.numel() for p in model.trainable_parameters()),
+        head_checkpoint_bytes=sum(
+            v.numel() * v.element_size()
+            for v in model.model_state(include_backbone=not frozen).values()
+        ),
+        optimizer_state_bytes=optimizer_state_bytes(optimizer),
+        step_time_mean=float(np.mean(times)),
+        step_time_p50=float(np.percentile(times, 50)),
+        peak_rss_bytes=peak_rss_bytes(),
+    )
+    if device.type == "cuda":
+        result["peak_cuda_bytes"] = torch.cuda.max_memory_allocated()
+    return result
+
+
+def main(args: Namespace):
+    # Spawn a clean process per mode, so the memory high-water marks do not mix.
+    # An executor raises BrokenProcessPool if the worker is killed, for
+    # example by the OOM killer, where a Pool would wait forever.
+    context = get_context("spawn")
+    results = []
+    for frozen in [False, True]:
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            try:
+                results.append(executor.submit(run_mode, args, frozen).result())
+            except BrokenProcessPool:
+                results.append(
+                    dict(frozen=frozen, failed="the worker was killed, most likely out of memory")
+                )
+
+    trainable, frozen = results
+    summary = dict(config=vars(args), trainable=trainable, frozen=frozen)
+    if "failed" not in trainable and "failed" not in frozen:
+        summary.update(
+            step_time_speedup=trainable["step_time_mean"] / frozen["step_time_mean"],
+            peak_rss_saved_bytes=trainable["peak_rss_bytes"] - frozen["peak_rss_bytes"],
+            optimizer_state_saved_bytes=trainable["optimizer_state_bytes"]
+            - frozen["optimizer_state_bytes"],
+        )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--image_size", type=int, default=384)
+    parser.add_argument("--hidden_size", type=int, default=768)
+    parser.add_argument("--layers", type=int, default=12)
+    parser.add_argument("--heads", type=int, default=12)
+    parser.add_argument("--latent_space_size", type=int, default=512)
+    parser.add_argument(
+        "--head_rank",
+        type=int,
+        help="factorize the first layer of the head, by default it is a full matrix",
+    )
+
+    main(parser.parse_args())
@@ -0,0 +1,294 @@
+"""
+Offline CPU benchmark suite. Uses synthetic images and small randomly
+initialized ViT and DETR models, so it runs without downloads or data.
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --only embed search --quick
+
+The results are written as JSON, so they can be compared between commits.
+"""
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict
+import json
+import logging
+
+import torch
+
+from benchmarks.common import (
+    environment,
+    letterboxed_images,
+    measure,
+    random_images,
+    small_detr_config,
+    small_vit_config,
+    synthetic_folder,
+)
+
+
+def bench_embed(args: Namespace) -> Dict[str, Any]:
+    from lostpaw.model import PetViTContrastiveModel
+
+    model = PetViTContrastiveModel("", 128, vit_config=small_vit_config())
+    model.train(False)
+    images = random_images(max(args.batch_sizes), seed=1)
+
+    results = dict()
+    with torch.no_grad():
+        for batch_size in [1] + args.batch_sizes:
+            batch = images[:batch_size]
+            results[f"batch_{batch_size}"] = measure(
+                lambda: model(batch), args.repeat, items=batch_size
+            )
+    return results
+
+
+def bench_tokens(args: Namespace) -> Dict[str, Any]:
+    from lostpaw.model import PetViTContrastiveModel
+
+    from transformers import ViTConfig
+
+    # Deeper than small_vit_config, so the encoder and not the head dominates
+    vit_config = ViTConfig(
+        image_size=384,
+        hidden_size=192,
+        num_hidden_layers=6,
+        num_attention_heads=3,
+        intermediate_size=768,
+    )
+    model = PetViTContrastiveModel("", 128, vit_config=vit_config)
+    model.train(False)
+    batch_size = max(args.batch_sizes)
+    inputs = model.preprocess(letterboxed_images(batch_size, seed=5))
+
+    results = dict()
+    with torch.no_grad():
+        full = model.embed(inputs)
+        for name, drop_padding, merge_ratio in [
+            ("all_tokens", False, 0.0),
+            ("drop_padding", True, 0.0),
+            ("drop_padding_merge_0.1", True, 0.1),
+            ("drop_padding_merge_0.25", True, 0.25),
+        ]:
+            model.reduce_tokens(drop_padding, merge_ratio)
+            results[name] = measure(lambda: model.embed(inputs), args.repeat, items=batch_size)
+            # How far the embeddings move from the ones of all tokens. The
+            # model is random, the accuracy of a trained one is measured with
+            # scripts/test.py --drop_padding_tokens --token_merge_ratio.
+            error = (model.embed(inputs) - full).norm(dim=1) / full.norm(dim=1)
+            results[name]["relative_error"] = float(error.mean())
+    return results
+
+
+def bench_detr(args: Namespace) -> Dict[str, Any]:
+    from lostpaw.data.extract_pets import DetrPetExtractor
+
+    extractor = DetrPetExtractor("", config=small_detr_config())
+    extractor.model.eval()
+    # Photos of mixed orientation, like the scraped data
+    images = random_images(2, (640, 480), seed=2) + random_images(2, (480, 640), seed=3)
+
+    results = dict()
+    with torch.no_grad():
+        for batch_size in [1, len(images)]:
+            batch = images[:batch_size]
+            results[f"batch_{batch_size}"] = measure(
+                lambda: extractor.extract(
+                    batch, range(batch_size), threshold=0.0, output_size=(384, 384)
+                ),
+                args.repeat,
+                items=batch_size,
+            )
+
+        # The mixed batch in one DETR batch, padded to the largest height and width
+        extractor.input_pixels = extractor.padding_pixels = 0
+        extractor.run_model(images)
+        results[f"batch_{len(images)}"]["padding_fraction"] = extractor.padding_fraction()
+        extractor.bucket_width = 0.0
+        extractor.input_pixels = extractor.padding_pixels = 0
+        results["unbucketed"] = measure(
+            lambda: extractor.extract(images, range(len(images)), threshold=0.0, output_size=(384, 384)),
+            args.repeat,
+            items=len(images),
+        )
+        results["unbucketed"]["padding_fraction"] = extractor.padding_fraction()
+
+    # Replaying cached detections, as when extracting again with other settings
+    from lostpaw.data.detection_cache import DetectionCache
+
+    cached = DetrPetExtractor("", config=small_detr_config(), cache=DetectionCache(args.tmp / "detections"))
+    cached.detect(images)
+    results["cached"] = measure(
+        lambda: cached.extract(images, range(len(images)), threshold=0.0, output_size=(384, 384)),
+        args.repeat,
+        items=len(images),
+    )
+    return results
+
+
+def bench_decode(args: Namespace) -> Dict[str, Any]:
+    from io import BytesIO
+    import numpy as np
+    from PIL import Image
+    from lostpaw.data.decode import DETR_SHORTEST_EDGE, ScaledImage
+
+    # A smooth 12 MP photo, noise alone would make an unrealistically large JPEG
+    rng = np.random.default_rng(5)
+    y, x = np.mgrid[0:3000, 0:4000]
+    pixels = np.stack([x / 16 % 256, y / 12 % 256, (x + y) / 28 % 256], axis=-1)
+    pixels = (pixels + rng.normal(0, 8, pixels.shape)).clip(0, 255).astype(np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    data = buffer.getvalue()
+    # A pet in a quarter of the photo, cropped for a 384 pixel ViT input
+    box = (1000, 750, 2000, 1500)
+
+    results = dict(jpeg_mb=len(data) / 2**20)
+    for name, shortest_edge in [("full", None), ("detr", DETR_SHORTEST_EDGE), ("vit", 384)]:
+        scaled = ScaledImage(data, shortest_edge)
+        results[name] = dict(
+            **measure(lambda: ScaledImage(data, shortest_edge), args.repeat),
+            decoded_size=list(scaled.image.size),
+            decoded_mb=scaled.image.width * scaled.image.height * 3 / 2**20,
+        )
+
+    scaled = ScaledImage(data)
+    detr_box = [v * scaled.scale for v in box]
+    results["detr_and_crop"] = measure(
+        lambda: ScaledImage(data).crop(detr_box, 384), args.repeat
+    )
+    results["full_and_crop"] = measure(
+        lambda: ScaledImage(data, None).crop(box, 384), args.repeat
+    )
+    return results
+
+
+def bench_pairs(args: Namespace) -> Dict[str, Any]:
+    from lostpaw.data.data_folder import PetImagesFolder
+    from lostpaw.data.dataset import RandomPairDataset
+
+    info_path = synthetic_folder(args.tmp / "pairs", pets=args.pets)
+    dataset = RandomPairDataset(PetImagesFolder(info_path.parent, info_path.name), seed=0)
+
+    results = dict()
+    counter = iter(range(1 << 30))
+    results["pair"] = measure(lambda: dataset[next(counter)], args.repeat * 4)
+
+    for batch_size in args.batch_sizes:
+        batches = dataset.get_batches(batch_size)
+        results[f"batch_{batch_size}"] = measure(
+            lambda: next(batches), args.repeat, items=batch_size
+        )
+    return results
+
+
+def bench_search(args: Namespace) -> Dict[str, Any]:
+    generator = torch.Generator().manual_seed(0)
+    dim = 512
+
+    results = dict()
+    for gallery_size in args.gallery_sizes:
+        gallery = torch.randn(gallery_size, dim, generator=generator)
+        for query_count in [1, 32]:
+            queries = torch.randn(query_count, dim, generator=generator)
+
+            def search():
+                distances = torch.cdist(queries, gallery)
+                return distances.topk(min(5, gallery_size), largest=False)
+
+            results[f"gallery_{gallery_size}_queries_{query_count}"] = measure(
+                search, args.repeat, items=query_count
+            )
+    return results
+
+
+def bench_augment(args: Namespace) -> Dict[str, Any]:
+    import torchvision.transforms as T
+    from lostpaw.data.auto_augment import DataAugmenter, images_to_tensor
+
+    batch_size = max(args.batch_sizes)
+    images = random_images(batch_size, seed=4)
+    augmenter = DataAugmenter(seed=0)
+    per_image = [T.AutoAugment(policy) for policy in augmenter.policies]
+
+    results = dict()
+    results["pil_per_image"] = measure(
+        lambda: [a(image) for image in images for a in per_image],
+        args.repeat,
+        items=batch_size * len(per_image),
+    )
+    results["batched_pil"] = measure(
+        lambda: augmenter.variants(images, 1),
+        args.repeat,
+        items=batch_size * len(per_image),
+    )
+    if torch.cuda.is_available():
+        batch = images_to_tensor(images).cuda()
+
+        def augment_cuda():
+            augmenter.variants(batch, 1)
+            torch.cuda.synchronize()
+
+        results["batched_cuda"] = measure(
+            augment_cuda, args.repeat, items=batch_size * len(per_image)
+        )
+    return results
+
+
+def bench_startup(args: Namespace) -> Dict[str, Any]:
+    from benchmarks.startup import MODULES, measure_startup
+
+    return measure_startup(MODULES, max(args.repeat // 5, 1))
+
+
+BENCHMARKS: Dict[str, Callable[[Namespace], Dict[str, Any]]] = dict(
+    embed=bench_embed,
+    tokens=bench_tokens,
+    detr=bench_detr,
+    decode=bench_decode,
+    pairs=bench_pairs,
+    search=bench_search,
+    augment=bench_augment,
+    startup=bench_startup,
+)
+
+
+def main(args: Namespace):
+    logging.basicConfig(format="[%(levelname)s] %(message)s", level=logging.WARNING)
+    torch.manual_seed(0)
+
+    names = args.only or list(BENCHMARKS)
+    results: Dict[str, Any] = dict(environment=environment(), results=dict())
+    with TemporaryDirectory() as tmp:
+        args.tmp = Path(tmp)
+        for name in names:
+            print(f"Running {name}...", flush=True)
+            results["results"][name] = BENCHMARKS[name](args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "wt") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS))
+    parser.add_argument("--output", type=Path, help="path of the JSON result file")
+    parser.add_argument("--quick", action="store_true", help="fewer repetitions")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[8, 32])
+    parser.add_argument(
+        "--gallery_sizes", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument("--pets", type=int, default=32)
+
+    args = parser.parse_args()
+    if args.quick:
+        args.repeat = 3
+        args.batch_sizes = [min(args.batch_sizes)]
+        args.gallery_sizes = [min(args.gallery_sizes)]
+
+    main(args)
@@ -0,0 +1,94 @@
+"""
+Guards the startup time of the lightweight parts of lostpaw. Every module is
+imported in a fresh interpreter with `python -X importtime`, and the check
+fails when an import exceeds the time budget or loads a heavy dependency.
+
+    python -m benchmarks.startup --budget_ms 1000
+"""
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Set, Tuple
+import json
+import subprocess
+import sys
+
+# Modules used by the metadata tools, like scripts/clean_dataset.py and
+# scripts/extract_pets_merge.py, that should start quickly.
+MODULES = [
+    "lostpaw",
+    "lostpaw.config.args",
+    "lostpaw.data",
+    "lostpaw.model",
+    "lostpaw.data.data_folder",
+    "lostpaw.data.near_duplicates",
+    "lostpaw.data.merge",
+    "lostpaw.data.extract_pets",
+    "lostpaw.data.decode",
+    "lostpaw.resources",
+]
+
+# Only the models, datasets and trainer may import these
+HEAVY_MODULES = ["torch", "transformers", "wandb", "timm"]
+
+
+def import_time(module: str) -> Tuple[float, Set[str]]:
+    """
+    Returns the cumulative import time of a module in milliseconds, and the
+    names of all modules that were imported along with it.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    total_us = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        name = name.rstrip()
+        imported.add(name.strip())
+        # Nested imports are indented. Of the top level ones, only count the
+        # module and its parent packages, the others belong to the interpreter.
+        top_level = not name[1:].startswith(" ")
+        name = name.strip()
+        if top_level and (name == module or module.startswith(name + ".")):
+            total_us += int(cumulative)
+    return total_us / 1000, imported
+
+
+def measure_startup(modules: List[str], repeat: int = 3) -> Dict[str, Any]:
+    results = dict()
+    for module in modules:
+        times = []
+        for _ in range(repeat):
+            time_ms, imported = import_time(module)
+            times.append(time_ms)
+        heavy = sorted(
+            m for m in HEAVY_MODULES if any(i.split(".")[0] == m for i in imported)
+        )
+        # The fastest run has the least noise from the rest of the machine
+        results[module] = dict(import_ms=min(times), heavy_imports=heavy)
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--budget_ms", type=float, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+
+    args = parser.parse_args()
+    results = measure_startup(args.modules, args.repeat)
+    print(json.dumps(results, indent=2))
+
+    failures = [
+        module
+        for module, result in results.items()
+        if result["import_ms"] > args.budget_ms or result["heavy_imports"]
+    ]
+    if failures:
+        print(f"Startup regression in: {', '.join(failures)}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,102 @@
+"""
+Measures how the embedding throughput of worker processes scales from 1 to N
+workers on the CPU, with the thread plan of lostpaw.resources (disjoint cores
+and one torch thread per core) and with the torch defaults, where every
+worker starts a thread per core of the machine.
+
+The model is randomly initialized from a ViTConfig, so nothing is downloaded.
+
+    python -m benchmarks.workers --max_workers 8
+"""
+from argparse import ArgumentParser, Namespace
+from multiprocessing import Barrier, Process, Queue
+from time import perf_counter
+from typing import Optional
+import json
+
+from benchmarks.common import environment, random_images
+from lostpaw.resources import WorkerResources, available_cpus, physical_cores, plan_workers
+
+
+def worker(args: Namespace, resources: Optional[WorkerResources], barrier, results: Queue):
+    if resources is not None:
+        resources.apply()
+
+    import torch
+    from transformers import ViTConfig
+    from lostpaw.model import PetViTContrastiveModel
+
+    torch.manual_seed(0)
+    vit_config = ViTConfig(
+        image_size=args.image_size,
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+        intermediate_size=4 * args.hidden_size,
+    )
+    model = PetViTContrastiveModel("", 128, vit_config=vit_config)
+    model.train(False)
+    inputs = model.preprocess(random_images(args.batch_size, (args.image_size, args.image_size)))
+
+    with torch.no_grad():
+        model.embed(inputs)
+        # All workers run at the same time
+        barrier.wait()
+        start = perf_counter()
+        for _ in range(args.batches):
+            model.embed(inputs)
+        results.put(perf_counter() - start)
+
+
+def run(args: Namespace, workers: int, planned: bool) -> dict:
+    plan = plan_workers(workers) if planned else [None] * workers
+    barrier = Barrier(workers)
+    results: Queue = Queue()
+    processes = [Process(target=worker, args=(args, plan[i], barrier, results)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    times = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    images = workers * args.batches * args.batch_size
+    return dict(
+        images_per_sec=images / max(times),
+        slowest_worker_sec=max(times),
+        threads_per_worker=plan[0].threads if planned else None,
+    )
+
+
+def main(args: Namespace):
+    cores = len(physical_cores(available_cpus()))
+    max_workers = args.max_workers or cores
+    results = dict(planned=dict(), default=dict())
+    for workers in range(1, max_workers + 1):
+        for name in ("planned", "default"):
+            results[name][f"workers_{workers}"] = run(args, workers, name == "planned")
+
+    for key, planned in results["planned"].items():
+        planned["speedup"] = planned["images_per_sec"] / results["default"][key]["images_per_sec"]
+    print(
+        json.dumps(
+            dict(
+                config=vars(args),
+                environment=dict(**environment(), physical_cores=cores, cpus=len(available_cpus())),
+                results=results,
+            ),
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--max_workers", type=int, help="by default the number of physical cores")
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--image_size", type=int, default=224)
+    parser.add_argument("--hidden_size", type=int, default=192)
+    parser.add_argument("--layers", type=int, default=6)
+    parser.add_argument("--heads", type=int, default=3)
+
+    main(parser.parse_args())
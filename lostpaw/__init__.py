@@ -1,5 +1,26 @@
-# from lostpaw.utils.extract_pets import DetrPetExtractor
-# from lostpaw.data.dataset import PetImagesDataset, RandomPairDataset
-# from lostpaw.loss import PetContrastiveLoss
-# from lostpaw.model import PetViTContrastiveModel
-# from lostpaw.trainer import Trainer, TrainConfig, OptimizerConfig
+from typing import TYPE_CHECKING
+
+from ._lazy import lazy_exports
+from .config import OptimizerConfig, SchedulerConfig, TrainConfig
+
+# The models, datasets and trainer import torch, transformers and wandb,
+# which take seconds to load. They are only imported on first access.
+_lazy_exports = {
+    "DetrPetExtractor": "lostpaw.data.extract_pets",
+    "PetImagesFolder": "lostpaw.data.data_folder",
+    "RandomPairDataset": "lostpaw.data.dataset",
+    "PetContrastiveLoss": "lostpaw.model.loss",
+    "PetViTContrastiveModel": "lostpaw.model.model",
+    "Trainer": "lostpaw.model.trainer",
+}
+lazy_exports(globals(), _lazy_exports)
+
+if TYPE_CHECKING:
+    from .data.data_folder import PetImagesFolder
+    from .data.dataset import RandomPairDataset
+    from .data.extract_pets import DetrPetExtractor
+    from .model.loss import PetContrastiveLoss
+    from .model.model import PetViTContrastiveModel
+    from .model.trainer import Trainer
+
+__all__ = ["OptimizerConfig", "SchedulerConfig", "TrainConfig", *_lazy_exports]
@@ -0,0 +1,21 @@
+from importlib import import_module
+from typing import Any, Dict
+
+
+def lazy_exports(namespace: Dict[str, Any], exports: Dict[str, str]):
+    """
+    Installs a module __getattr__ in `namespace`, the globals() of a package,
+    that imports every name of `exports` from its module on first access.
+
+    Args:
+        namespace: globals() of the package.
+        exports: The module every exported name is imported from.
+    """
+    module_name = namespace["__name__"]
+
+    def __getattr__(name: str) -> Any:
+        if name in exports:
+            return getattr(import_module(exports[name]), name)
+        raise AttributeError(f"module {module_name!r} has no attribute {name!r}")
+
+    namespace["__getattr__"] = __getattr__
@@ -1,3 +1,3 @@
-from .config import OptimizerConfig, TrainConfig
+from .config import OptimizerConfig, SchedulerConfig, TrainConfig
 
-__all__ = ["OptimizerConfig", "TrainConfig"]
+__all__ = ["OptimizerConfig", "SchedulerConfig", "TrainConfig"]
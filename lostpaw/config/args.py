@@ -29,6 +29,12 @@ def _parse_args(parser, config_parser):
     return args
 
 
+def _parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ["true", "1", "yes", "y"]
+
+
 def get_args():
     # The first arg parser parses out only the --config argument, this argument is used to
     # load a yaml file containing key-values that override the defaults for the main parser below
@@ -60,6 +66,39 @@ def get_args():
         help="Probability of a pair being similar",
     )
 
+    parser.add_argument(
+        "--image_cache_mb",
+        type=int,
+        default=0,
+        help="""Memory budget in MiB for keeping decoded training images in
+        memory. 0 disables the cache.""",
+    )
+
+    parser.add_argument(
+        "--image_cache_shared",
+        type=_parse_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Keep the image cache in shared memory, so data loading processes share it.",
+    )
+
+    parser.add_argument(
+        "--augment_probability",
+        type=float,
+        default=0.0,
+        help="""Probability that a training image is augmented with an
+        AutoAugment policy when it is loaded. 0 disables augmentation.""",
+    )
+
+    parser.add_argument(
+        "--augment_policies",
+        type=str,
+        nargs="+",
+        choices=["imagenet", "cifar10", "svhn"],
+        help="AutoAugment policies to sample from, all of them by default.",
+    )
+
     parser.add_argument(
         "--batches_per_epoch",
         type=int,
@@ -74,6 +113,13 @@ def get_args():
         help="Number of cross validation folds, each fold will be an individual run",
     )
 
+    parser.add_argument(
+        "--fold_path",
+        type=str,
+        help="""Fold assignment file written by scripts/clean_dataset.py --folds-to.
+        The test pairs of a fold then come from the pets of that fold.""",
+    )
+
     parser.add_argument(
         "--model_path",
         type=str,
@@ -100,6 +146,125 @@ def get_args():
         help="Value to add to the euclidean distance to improve numerical stability",
     )
 
+    parser.add_argument(
+        "--freeze_backbone",
+        type=_parse_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="""Only train the latent space head. The ViT gets no gradients,
+        no optimizer state and is left out of the checkpoints.""",
+    )
+
+    parser.add_argument(
+        "--head_rank",
+        type=int,
+        help="""Rank of the factorized first layer of the latent space head,
+        as written by scripts/compress_model.py. By default the layer is not factorized.""",
+    )
+
+    parser.add_argument(
+        "--vit_name",
+        type=str,
+        default="google/vit-base-patch16-384",
+        help="""Pretrained ViT that is downloaded when model_path has none, for
+        example google/vit-base-patch16-224 or WinKawaks/vit-small-patch16-224
+        for a smaller student model.""",
+    )
+
+    # Inference
+    parser.add_argument(
+        "--drop_padding_tokens",
+        type=_parse_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="""Skip the black letterbox patches of the crops in the ViT when
+        embedding images for evaluation and serving.""",
+    )
+
+    parser.add_argument(
+        "--token_merge_ratio",
+        type=float,
+        default=0.0,
+        help="""Fraction of the ViT tokens merged into similar tokens after every
+        layer when embedding images for evaluation and serving. 0 disables merging.""",
+    )
+
+    parser.add_argument(
+        "--compile_model",
+        type=_parse_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="""Run the model with torch.compile. The graphs are compiled at
+        startup, if compiling fails the model runs in eager mode.""",
+    )
+
+    parser.add_argument(
+        "--compile_batch_sizes",
+        type=int,
+        nargs="+",
+        help="""Batch sizes the compiled model pads its batches to, so only one
+        graph per size is compiled. By default the configured batch sizes.""",
+    )
+
+    parser.add_argument(
+        "--cpu_threads",
+        type=int,
+        help="""Intra-op threads of torch. By default one per physical core of
+        the CPUs the process may use, see lostpaw.resources.""",
+    )
+
+    parser.add_argument(
+        "--detector_cascade",
+        type=_parse_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="""Detect pets in uploads with a small Faster R-CNN first and only
+        run DETR when it is uncertain or finds several animals.""",
+    )
+
+    parser.add_argument(
+        "--cascade_confidence",
+        type=float,
+        default=0.9,
+        help="Smallest score of the single pet found by the fast detector to skip DETR.",
+    )
+
+    parser.add_argument(
+        "--cascade_uncertainty",
+        type=float,
+        default=0.3,
+        help="""Smallest score of the animals the fast detector counts, several
+        of them send the image to DETR.""",
+    )
+
+    # Distillation
+    parser.add_argument(
+        "--teacher_path",
+        type=str,
+        help="""Model file of a trained teacher. When given, the model is
+        trained to reproduce the embeddings and pair distances of the teacher.
+        Use another model_path than the teacher, the ViT is stored there.""",
+    )
+
+    parser.add_argument(
+        "--distill_embedding_weight",
+        type=float,
+        default=1.0,
+        help="""Weight of the mean squared error between the embeddings of the
+        model and the teacher. Needs the latent space size of the teacher.""",
+    )
+
+    parser.add_argument(
+        "--distill_distance_weight",
+        type=float,
+        default=1.0,
+        help="Weight of the mean squared error between the pair distances of the model and the teacher.",
+    )
+
     # Training parameters
     parser.add_argument(
         "--epochs",
@@ -126,6 +291,28 @@ def get_args():
         help="Number of batches for testing.",
     )
 
+    parser.add_argument(
+        "--eval_info_path",
+        type=str,
+        help="""Path to the info file of the held-out data. When given, every
+        held-out image is embedded once and the test metrics are computed over
+        all pairs, instead of over test_batch_count random batches.""",
+    )
+
+    parser.add_argument(
+        "--eval_batch_size",
+        type=int,
+        default=32,
+        help="Number of images embedded at once during evaluation.",
+    )
+
+    parser.add_argument(
+        "--eval_negatives_per_image",
+        type=int,
+        help="""Sample this many pairs of different pets per held-out image,
+        instead of using all pairs.""",
+    )
+
     parser.add_argument(
         "--save_model_every",
         type=int,
@@ -138,6 +325,40 @@ def get_args():
         help="How many epochs without improving accuracy before we stop.",
     )
 
+    # Checkpoints
+    parser.add_argument(
+        "--keep_checkpoints",
+        type=int,
+        default=3,
+        help="Number of full training checkpoints to keep. 0 keeps all of them.",
+    )
+
+    parser.add_argument(
+        "--async_checkpoints",
+        type=_parse_bool,
+        nargs="?",
+        const=True,
+        default=True,
+        help="Whether to write checkpoints from a background thread.",
+    )
+
+    parser.add_argument(
+        "--checkpoint_exclude_backbone",
+        type=_parse_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="""Leave the ViT weights out of the checkpoints. Only use this
+        when the backbone is not trained, it is restored from the pretrained model.""",
+    )
+
+    parser.add_argument(
+        "--early_stopping_start_epoch",
+        type=int,
+        default=50,
+        help="Epoch after which early stopping starts counting epochs without improvement.",
+    )
+
     # Otpimizer parameters
     parser.add_argument(
         "--optimizer",
@@ -155,6 +376,24 @@ def get_args():
         Example: --optimizer_params lr=0.001""",
     )
 
+    # Learning rate schedule
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        help="""Learning rate schedule: constant, linear, cosine, onecycle
+        or plateau (reduce on plateau of the test accuracy).""",
+    )
+
+    parser.add_argument(
+        "--scheduler_params",
+        type=str,
+        nargs="+",
+        action="extend",
+        help="""Scheduler settings: warmup_steps, warmup_start_factor, min_lr,
+        pct_start, div_factor, final_div_factor, factor, patience, threshold.
+        Example: --scheduler_params warmup_steps=500""",
+    )
+
     # Logging
     parser.add_argument(
         "--run_name",
@@ -179,6 +418,30 @@ def get_args():
         help="Whether to use tqdm for progress bar.",
     )
 
+
+    # Profiling
+    parser.add_argument(
+        "--profile",
+        type=_parse_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="""Time every stage of the training steps and track memory use.
+        The times are logged and appended to a Chrome trace every epoch.""",
+    )
+    parser.add_argument(
+        "--torch_profiler_start",
+        type=int,
+        default=10,
+        help="First training step captured by torch.profiler.",
+    )
+    parser.add_argument(
+        "--torch_profiler_steps",
+        type=int,
+        default=0,
+        help="Number of training steps captured by torch.profiler. 0 disables it.",
+    )
+
     args = _parse_args(parser, config_parser)
 
     if args.run_name is None:
@@ -186,6 +449,13 @@ def get_args():
 
         args.run_name = "{}".format(time.strftime("%Y_%m_%d_%H%M%S"))
 
+    # Convert scheduler params to dict, SchedulerConfig casts the integer values
+    if type(args.scheduler_params) is list:
+        args.scheduler_params = {
+            key: float(value)
+            for key, value in (param.split("=") for param in args.scheduler_params)
+        }
+
     # Convert optimizer params to dict
     if type(args.optimizer_params) is list:
         args.optimizer_params = dict(
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import List, Optional, Tuple
 from dataclasses import dataclass
 
 
@@ -28,6 +28,27 @@ class OptimizerConfig:
             }
 
 
+@dataclass
+class SchedulerConfig:
+    # Linear warmup, used by all schedules except onecycle which has its own
+    warmup_steps: int = 0
+    warmup_start_factor: float = 0.01
+    # linear and cosine
+    min_lr: float = 0.0
+    # onecycle
+    pct_start: float = 0.3
+    div_factor: float = 25.0
+    final_div_factor: float = 1e4
+    # plateau
+    factor: float = 0.5
+    patience: int = 5
+    threshold: float = 1e-3
+
+    def __post_init__(self):
+        self.warmup_steps = int(self.warmup_steps)
+        self.patience = int(self.patience)
+
+
 @dataclass
 class TrainConfig:
     info_path: str
@@ -37,15 +58,46 @@ class TrainConfig:
     optimizer_params: dict
     similarity_probability: float = 0.5
     cross_validiton_k_fold: int = 1
+    fold_path: Optional[str] = None
     batches_per_epoch: int = 128
     epochs: int = 100
     batch_size: int = 16
     test_batch_size: int = 16
     test_batch_count: int = 8
+    eval_info_path: Optional[str] = None
+    eval_batch_size: int = 32
+    eval_negatives_per_image: Optional[int] = None
     save_model_every: int = 10
     early_stopping_epochs: int = 15
+    early_stopping_start_epoch: int = 50
+    scheduler: Optional[str] = None
+    scheduler_params: Optional[dict] = None
     contrastive_margin: float = 1.25
     contrastive_epsilon: float = 1e-8
     use_wandb: bool = False
     use_tqdm: bool = False
+    profile: bool = False
+    torch_profiler_start: int = 10
+    torch_profiler_steps: int = 0
     latent_space_size: int = 1024
+    image_cache_mb: int = 0
+    image_cache_shared: bool = False
+    augment_probability: float = 0.0
+    augment_policies: Optional[List[str]] = None
+    freeze_backbone: bool = False
+    head_rank: Optional[int] = None
+    vit_name: str = "google/vit-base-patch16-384"
+    teacher_path: Optional[str] = None
+    distill_embedding_weight: float = 1.0
+    distill_distance_weight: float = 1.0
+    drop_padding_tokens: bool = False
+    token_merge_ratio: float = 0.0
+    compile_model: bool = False
+    compile_batch_sizes: Optional[List[int]] = None
+    cpu_threads: Optional[int] = None
+    detector_cascade: bool = False
+    cascade_confidence: float = 0.9
+    cascade_uncertainty: float = 0.3
+    keep_checkpoints: int = 3
+    async_checkpoints: bool = True
+    checkpoint_exclude_backbone: bool = False
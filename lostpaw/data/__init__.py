@@ -1,4 +1,18 @@
-from .extract_pets import DetrPetExtractor
-from .dataset import RandomPairDataset
+from typing import TYPE_CHECKING
 
-__all__ = ["DetrPetExtractor", "RandomPairDataset"]
\ No newline at end of file
+from .._lazy import lazy_exports
+
+# Imported on first access, the extractor and datasets import torch and
+# transformers while the metadata tools only need data_folder.
+_lazy_exports = {
+    "DetrPetExtractor": "lostpaw.data.extract_pets",
+    "PetImageDataset": "lostpaw.data.dataset",
+    "RandomPairDataset": "lostpaw.data.dataset",
+}
+lazy_exports(globals(), _lazy_exports)
+
+if TYPE_CHECKING:
+    from .dataset import PetImageDataset, RandomPairDataset
+    from .extract_pets import DetrPetExtractor
+
+__all__ = ["DetrPetExtractor", "PetImageDataset", "RandomPairDataset"]
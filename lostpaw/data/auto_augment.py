@@ -1,24 +1,338 @@
 # https://pytorch.org/vision/master/auto_examples/plot_transforms.html#sphx-glr-auto-examples-plot-transforms-py
 # https://github.com/GuillaumeErhard/Supervised_contrastive_loss_pytorch/blob/main/data_augmentation/auto_augment.py
 
-from typing import List, Optional
-import torchvision.transforms as T
+from collections import defaultdict
+from math import atan, degrees
+from typing import Callable, Dict, List, Optional, Tuple, Union
+import numpy as np
+import torch
+import torchvision.transforms.v2 as T
+import torchvision.transforms.v2.functional as F
+from PIL import Image as PILImage
 from PIL.Image import Image
 
+Batch = Union[torch.Tensor, List[Image]]
+# (operation, probability, magnitude bin) of both operations of a sub-policy
+SubPolicy = Tuple[Tuple[str, float, Optional[int]], Tuple[str, float, Optional[int]]]
+
+# The sub-policies of "AutoAugment: Learning Augmentation Strategies from
+# Data" (Cubuk et al., 2019), as in torchvision.transforms.v2.AutoAugment.
+# torchvision keeps them private, so they are copied here.
+POLICIES: Dict[T.AutoAugmentPolicy, List[SubPolicy]] = {
+    T.AutoAugmentPolicy.IMAGENET: [
+        (("Posterize", 0.4, 8), ("Rotate", 0.6, 9)),
+        (("Solarize", 0.6, 5), ("AutoContrast", 0.6, None)),
+        (("Equalize", 0.8, None), ("Equalize", 0.6, None)),
+        (("Posterize", 0.6, 7), ("Posterize", 0.6, 6)),
+        (("Equalize", 0.4, None), ("Solarize", 0.2, 4)),
+        (("Equalize", 0.4, None), ("Rotate", 0.8, 8)),
+        (("Solarize", 0.6, 3), ("Equalize", 0.6, None)),
+        (("Posterize", 0.8, 5), ("Equalize", 1.0, None)),
+        (("Rotate", 0.2, 3), ("Solarize", 0.6, 8)),
+        (("Equalize", 0.6, None), ("Posterize", 0.4, 6)),
+        (("Rotate", 0.8, 8), ("Color", 0.4, 0)),
+        (("Rotate", 0.4, 9), ("Equalize", 0.6, None)),
+        (("Equalize", 0.0, None), ("Equalize", 0.8, None)),
+        (("Invert", 0.6, None), ("Equalize", 1.0, None)),
+        (("Color", 0.6, 4), ("Contrast", 1.0, 8)),
+        (("Rotate", 0.8, 8), ("Color", 1.0, 2)),
+        (("Color", 0.8, 8), ("Solarize", 0.8, 7)),
+        (("Sharpness", 0.4, 7), ("Invert", 0.6, None)),
+        (("ShearX", 0.6, 5), ("Equalize", 1.0, None)),
+        (("Color", 0.4, 0), ("Equalize", 0.6, None)),
+        (("Equalize", 0.4, None), ("Solarize", 0.2, 4)),
+        (("Solarize", 0.6, 5), ("AutoContrast", 0.6, None)),
+        (("Invert", 0.6, None), ("Equalize", 1.0, None)),
+        (("Color", 0.6, 4), ("Contrast", 1.0, 8)),
+        (("Equalize", 0.8, None), ("Equalize", 0.6, None)),
+    ],
+    T.AutoAugmentPolicy.CIFAR10: [
+        (("Invert", 0.1, None), ("Contrast", 0.2, 6)),
+        (("Rotate", 0.7, 2), ("TranslateX", 0.3, 9)),
+        (("Sharpness", 0.8, 1), ("Sharpness", 0.9, 3)),
+        (("ShearY", 0.5, 8), ("TranslateY", 0.7, 9)),
+        (("AutoContrast", 0.5, None), ("Equalize", 0.9, None)),
+        (("ShearY", 0.2, 7), ("Posterize", 0.3, 7)),
+        (("Color", 0.4, 3), ("Brightness", 0.6, 7)),
+        (("Sharpness", 0.3, 9), ("Brightness", 0.7, 9)),
+        (("Equalize", 0.6, None), ("Equalize", 0.5, None)),
+        (("Contrast", 0.6, 7), ("Sharpness", 0.6, 5)),
+        (("Color", 0.7, 7), ("TranslateX", 0.5, 8)),
+        (("Equalize", 0.3, None), ("AutoContrast", 0.4, None)),
+        (("TranslateY", 0.4, 3), ("Sharpness", 0.2, 6)),
+        (("Brightness", 0.9, 6), ("Color", 0.2, 8)),
+        (("Solarize", 0.5, 2), ("Invert", 0.0, None)),
+        (("Equalize", 0.2, None), ("AutoContrast", 0.6, None)),
+        (("Equalize", 0.2, None), ("Equalize", 0.6, None)),
+        (("Color", 0.9, 9), ("Equalize", 0.6, None)),
+        (("AutoContrast", 0.8, None), ("Solarize", 0.2, 8)),
+        (("Brightness", 0.1, 3), ("Color", 0.7, 0)),
+        (("Solarize", 0.4, 5), ("AutoContrast", 0.9, None)),
+        (("TranslateY", 0.9, 9), ("TranslateY", 0.7, 9)),
+        (("AutoContrast", 0.9, None), ("Solarize", 0.8, 3)),
+        (("Equalize", 0.8, None), ("Invert", 0.1, None)),
+        (("TranslateY", 0.7, 9), ("AutoContrast", 0.9, None)),
+    ],
+    T.AutoAugmentPolicy.SVHN: [
+        (("ShearX", 0.9, 4), ("Invert", 0.2, None)),
+        (("ShearY", 0.9, 8), ("Invert", 0.7, None)),
+        (("Equalize", 0.6, None), ("Solarize", 0.6, 6)),
+        (("Invert", 0.9, None), ("Equalize", 0.6, None)),
+        (("Equalize", 0.6, None), ("Rotate", 0.9, 3)),
+        (("ShearX", 0.9, 4), ("AutoContrast", 0.8, None)),
+        (("ShearY", 0.9, 8), ("Invert", 0.4, None)),
+        (("ShearY", 0.9, 5), ("Solarize", 0.2, 6)),
+        (("Invert", 0.9, None), ("AutoContrast", 0.8, None)),
+        (("Equalize", 0.6, None), ("Rotate", 0.9, 3)),
+        (("ShearX", 0.9, 4), ("Solarize", 0.3, 3)),
+        (("ShearY", 0.8, 8), ("Invert", 0.7, None)),
+        (("Equalize", 0.9, None), ("TranslateY", 0.6, 6)),
+        (("Invert", 0.9, None), ("Equalize", 0.6, None)),
+        (("Contrast", 0.3, 3), ("Rotate", 0.8, 4)),
+        (("Invert", 0.8, None), ("TranslateY", 0.0, 2)),
+        (("ShearY", 0.7, 6), ("Solarize", 0.4, 8)),
+        (("Invert", 0.6, None), ("Rotate", 0.8, 4)),
+        (("ShearY", 0.3, 7), ("TranslateX", 0.9, 3)),
+        (("ShearX", 0.1, 6), ("Invert", 0.6, None)),
+        (("Solarize", 0.7, 2), ("TranslateY", 0.6, 7)),
+        (("ShearY", 0.8, 4), ("Invert", 0.8, None)),
+        (("ShearX", 0.7, 9), ("TranslateY", 0.8, 3)),
+        (("ShearY", 0.8, 5), ("AutoContrast", 0.7, None)),
+        (("ShearX", 0.7, 2), ("Invert", 0.1, None)),
+    ],
+}
+
+# The magnitudes of the 10 bins of every operation for an image of the given
+# height and width, and whether they are negated with probability 0.5
+MAGNITUDES: Dict[str, Tuple[Callable[[int, int], Optional[torch.Tensor]], bool]] = {
+    "ShearX": (lambda height, width: torch.linspace(0.0, 0.3, 10), True),
+    "ShearY": (lambda height, width: torch.linspace(0.0, 0.3, 10), True),
+    "TranslateX": (lambda height, width: torch.linspace(0.0, 150.0 / 331.0 * width, 10), True),
+    "TranslateY": (lambda height, width: torch.linspace(0.0, 150.0 / 331.0 * height, 10), True),
+    "Rotate": (lambda height, width: torch.linspace(0.0, 30.0, 10), True),
+    "Brightness": (lambda height, width: torch.linspace(0.0, 0.9, 10), True),
+    "Color": (lambda height, width: torch.linspace(0.0, 0.9, 10), True),
+    "Contrast": (lambda height, width: torch.linspace(0.0, 0.9, 10), True),
+    "Sharpness": (lambda height, width: torch.linspace(0.0, 0.9, 10), True),
+    "Posterize": (lambda height, width: (8 - torch.arange(10) / (9 / 4)).round().int(), False),
+    "Solarize": (lambda height, width: torch.linspace(1.0, 0.0, 10), False),
+    "AutoContrast": (lambda height, width: None, False),
+    "Equalize": (lambda height, width: None, False),
+    "Invert": (lambda height, width: None, False),
+}
+
+
+def images_to_tensor(images: List[Image]) -> torch.Tensor:
+    """Stacks images of the same size into a uint8 tensor of shape (B,3,H,W)."""
+    pixels = np.stack([np.asarray(image.convert("RGB")) for image in images])
+    return torch.from_numpy(pixels).permute(0, 3, 1, 2).contiguous()
+
+
+def tensor_to_images(images: torch.Tensor) -> List[Image]:
+    pixels = images.permute(0, 2, 3, 1).cpu().numpy()
+    return [PILImage.fromarray(p) for p in pixels]
+
+
+def parse_policies(names: Optional[List[str]]) -> Optional[List[T.AutoAugmentPolicy]]:
+    """Converts policy names like "imagenet" or "svhn" to AutoAugment policies."""
+    if not names:
+        return None
+    return [T.AutoAugmentPolicy(name.lower()) for name in names]
+
+
 class DataAugmenter:
-    def __init__(self, policies: Optional[List[T.AutoAugmentPolicy]] = None) -> None:
+    def __init__(
+        self,
+        policies: Optional[List[T.AutoAugmentPolicy]] = None,
+        seed: Optional[int] = None,
+        probability: float = 1.0,
+    ) -> None:
+        """
+        Applies the AutoAugment policies to batches of images.
+
+        Every image gets its own random sub-policy, but the images that end
+        up with the same operation and magnitude are grouped, so on a GPU
+        the work is done by a few batched tensor operations instead of one
+        operation per image.
+
+        Args:
+            policies: The AutoAugment policy families to sample from, every
+                      family is equally likely.
+            seed: Seed of the generator that draws the sub-policies, for
+                  reproducible augmentations.
+            probability: Probability that an image is augmented at all, the
+                         others are returned unchanged.
+        """
         policies = policies or [
             T.AutoAugmentPolicy.CIFAR10,
             T.AutoAugmentPolicy.IMAGENET,
             T.AutoAugmentPolicy.SVHN,
         ]
-        self.augmenters = [T.AutoAugment(policy) for policy in policies]
+        self.policies = policies
+        self.sub_policies = [POLICIES[policy] for policy in policies]
+        self.probability = probability
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
 
-    def get_transforms(self, orig_img: Image, count=4):
-        imgs = [
-            augmenter(orig_img) for _ in range(count) for augmenter in self.augmenters
+    def manual_seed(self, seed: int):
+        self.generator.manual_seed(seed)
+
+    def augment(self, images: Batch, policy: Optional[int] = None) -> Batch:
+        """
+        Returns an augmented copy of a batch of images.
+
+        Args:
+            images: A (B,3,H,W) uint8 tensor on any device, or a list of
+                    images.
+            policy: Index of the policy family to use for all images, by
+                    default every image gets a random family.
+        """
+        batch_size = len(images)
+        if batch_size == 0:
+            return images
+
+        if policy is None:
+            families = torch.randint(
+                len(self.sub_policies), (batch_size,), generator=self.generator
+            ).tolist()
+        else:
+            families = [policy] * batch_size
+        choices = torch.rand(batch_size, generator=self.generator).tolist()
+        augmented = torch.rand(batch_size, generator=self.generator).tolist()
+        sub_policies = []
+        for family, choice, draw in zip(families, choices, augmented):
+            family_policies = self.sub_policies[family]
+            sub_policy = family_policies[int(choice * len(family_policies))]
+            sub_policies.append(sub_policy if draw < self.probability else None)
+
+        # On the CPU the uint8 kernels of PIL are several times faster than
+        # the float tensor kernels, so there the images are transformed one
+        # by one. Elsewhere every group of images is transformed at once.
+        batched = isinstance(images, torch.Tensor) and images.device.type != "cpu"
+        if batched:
+            output = images.clone()
+        elif isinstance(images, torch.Tensor):
+            output = tensor_to_images(images)
+        else:
+            output = list(images)
+        if isinstance(images, torch.Tensor):
+            sizes = [tuple(images.shape[-2:])] * batch_size
+        else:
+            # Images that are not cached can differ in size
+            sizes = [(image.height, image.width) for image in images]
+
+        # All AutoAugment sub-policies are two operations long
+        for stage in range(2):
+            applied = torch.rand(batch_size, generator=self.generator).tolist()
+            signs = torch.rand(batch_size, generator=self.generator).tolist()
+
+            groups: Dict[Tuple[str, float], List[int]] = defaultdict(list)
+            for i, sub_policy in enumerate(sub_policies):
+                if sub_policy is None:
+                    continue
+                transform_id, probability, magnitude_idx = sub_policy[stage]
+                if not applied[i] <= probability:
+                    continue
+                magnitude = self._magnitude(
+                    transform_id, magnitude_idx, signs[i], *sizes[i]
+                )
+                groups[(transform_id, magnitude)].append(i)
+
+            for (transform_id, magnitude), indices in groups.items():
+                if batched:
+                    index = torch.tensor(indices, device=output.device)
+                    output[index] = self._apply(output[index], transform_id, magnitude)
+                else:
+                    for i in indices:
+                        output[i] = self._apply(output[i], transform_id, magnitude)
+
+        if isinstance(images, torch.Tensor) and not batched:
+            return images_to_tensor(output)
+        return output
+
+    def variants(self, images: Batch, count: int = 4) -> Batch:
+        """
+        Returns `count` augmented copies of every image for every policy
+        family, ordered by copy, then family, then image.
+        """
+        copies = [
+            self.augment(images, policy)
+            for _ in range(count)
+            for policy in range(len(self.sub_policies))
         ]
-        # row_title = [str(policy).split('.')[-1] for policy in policies]
-        # plot(imgs, row_title=row_title)
+        if isinstance(images, torch.Tensor):
+            return torch.cat(copies)
+        return [image for copy in copies for image in copy]
+
+    def get_transforms(self, orig_img: Image, count=4):
+        return self.variants([orig_img], count)
+
+    def _magnitude(
+        self,
+        transform_id: str,
+        magnitude_idx: Optional[int],
+        sign: float,
+        height: int,
+        width: int,
+    ) -> float:
+        magnitudes_fn, signed = MAGNITUDES[transform_id]
+        magnitudes = magnitudes_fn(height, width)
+        if magnitudes is None:
+            return 0.0
+        magnitude = float(magnitudes[magnitude_idx])
+        if signed and sign <= 0.5:
+            magnitude *= -1
+        return magnitude
 
-        return imgs
+    def _apply(self, images: Union[torch.Tensor, Image], transform_id: str, magnitude: float):
+        # The functional operations work on PIL images and on batched tensors,
+        # with the nearest interpolation and black fill of AutoAugment
+        nearest = T.InterpolationMode.NEAREST
+        if transform_id in ("ShearX", "ShearY"):
+            # Like torchvision, the magnitude is the tangent of the shear angle
+            angle = degrees(atan(magnitude))
+            shear = [angle, 0.0] if transform_id == "ShearX" else [0.0, angle]
+            return F.affine(
+                images,
+                angle=0.0,
+                translate=[0, 0],
+                scale=1.0,
+                shear=shear,
+                interpolation=nearest,
+                center=[0, 0],
+            )
+        if transform_id in ("TranslateX", "TranslateY"):
+            translate = [int(magnitude), 0] if transform_id == "TranslateX" else [0, int(magnitude)]
+            return F.affine(
+                images,
+                angle=0.0,
+                translate=translate,
+                scale=1.0,
+                shear=[0.0, 0.0],
+                interpolation=nearest,
+            )
+        if transform_id == "Rotate":
+            return F.rotate(images, angle=magnitude, interpolation=nearest)
+        if transform_id == "Brightness":
+            return F.adjust_brightness(images, brightness_factor=1.0 + magnitude)
+        if transform_id == "Color":
+            return F.adjust_saturation(images, saturation_factor=1.0 + magnitude)
+        if transform_id == "Contrast":
+            return F.adjust_contrast(images, contrast_factor=1.0 + magnitude)
+        if transform_id == "Sharpness":
+            return F.adjust_sharpness(images, sharpness_factor=1.0 + magnitude)
+        if transform_id == "Posterize":
+            return F.posterize(images, bits=int(magnitude))
+        if transform_id == "Solarize":
+            # The images are uint8 tensors or PIL images
+            return F.solarize(images, threshold=255.0 * magnitude)
+        if transform_id == "AutoContrast":
+            return F.autocontrast(images)
+        if transform_id == "Equalize":
+            return F.equalize(images)
+        if transform_id == "Invert":
+            return F.invert(images)
+        raise ValueError(f"Unknown AutoAugment operation {transform_id}")
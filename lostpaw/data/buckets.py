@@ -0,0 +1,72 @@
+from math import log
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
+
+Size = Tuple[int, int]
+
+
+def aspect_bucket(size: Size, width: float = 0.1) -> int:
+    """
+    Returns the bucket of the aspect ratio of a (width, height) size. The
+    buckets are `width` wide on a log scale, so portrait and landscape ratios
+    are symmetric.
+
+    DETR resizes the shortest edge of every image to 800 pixels (the longest
+    to at most 1333), so images with the same aspect ratio get the same input
+    size whatever their resolution, and a batch of them needs no padding.
+    """
+    return round(log(size[0] / size[1]) / width)
+
+
+def group_by_aspect(sizes: Sequence[Size], width: float = 0.1) -> List[List[int]]:
+    """Returns the indices of the sizes, grouped by their aspect ratio bucket."""
+    if width <= 0:
+        return [list(range(len(sizes)))]
+    groups: Dict[int, List[int]] = dict()
+    for i, size in enumerate(sizes):
+        groups.setdefault(aspect_bucket(size, width), []).append(i)
+    return list(groups.values())
+
+
+def bucketed_batches(
+    items: Iterable[T],
+    size_of: Callable[[T], Size],
+    batch_size: int,
+    width: float = 0.1,
+) -> Iterator[List[T]]:
+    """
+    Regroups a stream of items into batches whose images have about the same
+    aspect ratio. Every bucket holds back its items until it has a full batch,
+    at the end the remaining items are batched in order of their aspect ratio.
+    The order of the items changes, so they should carry their own labels.
+
+    Args:
+        items: The items, for example (image, label) tuples.
+        size_of: Returns the (width, height) of the image of an item.
+        batch_size: Number of items per batch.
+        width: Width of the aspect ratio buckets, 0 keeps the stream as is.
+    """
+    if width <= 0:
+        batch: List[T] = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        return
+
+    buckets: Dict[int, List[T]] = dict()
+    for item in items:
+        key = aspect_bucket(size_of(item), width)
+        bucket = buckets.setdefault(key, [])
+        bucket.append(item)
+        if len(bucket) == batch_size:
+            yield bucket
+            buckets[key] = []
+
+    remaining = [item for key in sorted(buckets) for item in buckets[key]]
+    for start in range(0, len(remaining), batch_size):
+        yield remaining[start : start + batch_size]
@@ -5,9 +5,10 @@ from typing import Any, Dict, List, Optional, Tuple, Union
 from PIL import Image
 from PIL.Image import Image as ImageT
 import pandas as pd
-import numpy as np
 
 from lostpaw.data.extract_pets import lookup_next_image_name
+from lostpaw.data.image_cache import ImageCache, SharedImageCache
+from lostpaw.data.splits import pet_sizes, size_histogram
 
 
 class PetImagesFolder:
@@ -17,9 +18,15 @@ class PetImagesFolder:
     folder: Path
     info_file: Path
 
-    def __init__(self, folder: Path, info_file_name: str = "train.data"):
+    def __init__(
+        self,
+        folder: Path,
+        info_file_name: str = "train.data",
+        image_cache: Optional[Union[ImageCache, SharedImageCache]] = None,
+    ):
         self.folder = folder
         self.info_file = folder / info_file_name
+        self.image_cache = image_cache
 
         self.folder.mkdir(exist_ok=True)
         self.info_file.touch(exist_ok=True)
@@ -45,11 +52,15 @@ class PetImagesFolder:
         paths, pet_id, _ = self.get_record(idx)
         images = []
         for image_path in paths:
-            image = Image.open(image_path).convert("RGB")
-            images.append((image, image_path))
+            images.append((self.load_image(image_path), image_path))
 
         return images, pet_id
 
+    def load_image(self, path: Path) -> ImageT:
+        if self.image_cache is not None:
+            return self.image_cache.get(path)
+        return Image.open(path).convert("RGB")
+
     def data_frame(self) -> pd.DataFrame:
         data = dict(paths=self.paths, pet_id=self.pet_ids)
         if self.sources:
@@ -94,16 +105,15 @@ class PetImagesFolder:
     def describe(self, print=False, drop_duplicates=True) -> Dict[str, Any]:
         df = self.data_frame()
 
-        if drop_duplicates:
-            df.drop_duplicates(subset=["source"], inplace=True)
+        if drop_duplicates and "source" in df.columns:
+            df = df.drop_duplicates(subset=["source"])
 
-        grouped = df.groupby("pet_id")["paths"]
-        sizes = grouped.apply(lambda x: len(x))
+        _, _, counts = pet_sizes(df)
 
         info = {
-            "average images per pet": grouped.count().mean(),
-            # "average images per pet >1": filtered_grouped.count().mean(),
-            "sizes": np.bincount(sizes, minlength=6)[1:6].tolist(),
+            "average images per pet": float(counts.mean()) if len(counts) else 0.0,
+            # Pets with 1, 2, 3, 4 and 5 or more images
+            "sizes": size_histogram(counts).tolist(),
         }
 
         if print:
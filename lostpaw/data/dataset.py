@@ -4,18 +4,27 @@ from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 from PIL.Image import Image as ImageT
 import pandas as pd
-from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Set, Tuple, Union
 from sys import maxsize
+import logging
 import random
 import numpy as np
 
 from lostpaw.data.data_folder import PetImagesFolder
+from lostpaw.data.decode import ScaledImage
+from lostpaw.data.image_cache import ImageCache, SharedImageCache
+
+if TYPE_CHECKING:
+    from lostpaw.data.auto_augment import DataAugmenter
 
 
 class PetImageDataset(Dataset):
     @classmethod
     def load_from_file(
-        cls, info_file: Path, ignore: Set[str] = set()
+        cls,
+        info_file: Path,
+        ignore: Set[str] = set(),
+        shortest_edge: Optional[int] = None,
     ) -> "PetImageDataset":
         image_root = info_file.parent
         try:
@@ -26,7 +35,7 @@ class PetImageDataset(Dataset):
             imgs_and_labels_filtered = imgs_and_labels[imgs_and_labels["isProcessed"]]
             img_paths = imgs_and_labels_filtered["savedPath"]
             img_labels = imgs_and_labels_filtered["petId"]
-            return PetImageDataset(image_root, img_paths, img_labels)
+            return PetImageDataset(image_root, img_paths, img_labels, shortest_edge)
 
         except ValueError:
             print(
@@ -35,11 +44,25 @@ class PetImageDataset(Dataset):
             exit()
 
     def __init__(
-        self, image_root: Path, image_paths: pd.Series, image_labels: pd.Series
+        self,
+        image_root: Path,
+        image_paths: pd.Series,
+        image_labels: pd.Series,
+        shortest_edge: Optional[int] = None,
     ):
+        """
+        Args:
+            image_root: Folder the image paths are relative to.
+            image_paths: Paths of the images.
+            image_labels: Pet ids of the images.
+            shortest_edge: Decode JPEGs at the lowest resolution with at least
+                           this shortest edge, see lostpaw.data.decode.
+                           By default images are decoded at full size.
+        """
         self.image_root = image_root
         self.image_paths = image_paths
         self.image_labels = image_labels
+        self.shortest_edge = shortest_edge
 
     def __len__(self) -> int:
         return len(self.image_paths)
@@ -54,23 +77,28 @@ class PetImageDataset(Dataset):
             yield i, l, self.image_paths[idx]
 
     def __getitem__(self, idx) -> Tuple[Image.Image, str]:
-        img_path = self.image_root / self.image_paths[idx]
-        image = Image.open(img_path).convert("RGB")
-        label = self.image_labels[idx]
+        return self.load_scaled(idx).image, self.image_labels[idx]
 
-        return image, label
+    def load_scaled(self, idx) -> ScaledImage:
+        return ScaledImage(self.image_root / self.image_paths[idx], self.shortest_edge)
 
     def get_batches(self, batch_size=32) -> Iterator[Dict[str, Any]]:
-        images, labels, paths = [], [], []
+        """
+        Yields batches of images, labels and paths. The sources are the
+        decoded images, from which crops can be taken at a higher resolution.
+        """
+        images, labels, paths, sources = [], [], [], []
 
-        for img, label, path in self.iter_with_path():
-            images.append(img)
-            labels.append(label)
-            paths.append(path)
+        for idx in range(len(self)):
+            source = self.load_scaled(idx)
+            images.append(source.image)
+            labels.append(self.image_labels[idx])
+            paths.append(self.image_paths[idx])
+            sources.append(source)
 
             if len(images) == batch_size:
-                yield dict(images=images, labels=labels, paths=paths)
-                images, labels, paths = [], [], []
+                yield dict(images=images, labels=labels, paths=paths, sources=sources)
+                images, labels, paths, sources = [], [], [], []
 
     def split(self, count: int) -> Iterator["PetImageDataset"]:
         chunk_length = ceil(len(self) / count)
@@ -80,7 +108,7 @@ class PetImageDataset(Dataset):
             end = end if end < len(self) else len(self)
             paths = self.image_paths[start:end].reset_index(drop=True)
             labels = self.image_labels[start:end].reset_index(drop=True)
-            yield PetImageDataset(self.image_root, paths, labels)
+            yield PetImageDataset(self.image_root, paths, labels, self.shortest_edge)
 
 
 class RandomPairDataset(Dataset):
@@ -90,31 +118,93 @@ class RandomPairDataset(Dataset):
         same_probability=0.5,
         fold_count: Optional[int] = None,
         seed: Optional[int] = None,
+        image_cache: Optional[Union[ImageCache, SharedImageCache]] = None,
+        augmenter: Optional["DataAugmenter"] = None,
+        folds: Optional[Dict[int, int]] = None,
     ):
+        """
+        Args:
+            folder: The training data.
+            same_probability: Probability that a pair shows the same pet.
+            fold_count: Number of cross validation folds.
+            seed: Seed of the pairs, a random seed by default.
+            image_cache: Cache of decoded images, the cache of the folder by
+                         default.
+            augmenter: Augments the training batches when they are loaded.
+            folds: The fold of every pet id, as read by
+                   lostpaw.data.splits.load_folds. With folds, the test pairs
+                   of a fold are drawn from the pets of that fold and the
+                   training pairs from the other pets. Otherwise the folds
+                   take every fold_count-th pair index.
+        """
         self.seed = seed or random.randint(0, maxsize)
         self.folder = folder
+        # Pairs of a pet are drawn from few images, so the same images are
+        # decoded many times per epoch. The cache keeps them in memory.
+        self.image_cache = image_cache if image_cache is not None else folder.image_cache
+        # Training batches are augmented when they are loaded, instead of
+        # storing augmented copies of every image
+        self.augmenter = augmenter
         self.same_probability = same_probability
         df = folder.data_frame()
         self.pets = df.groupby("pet_id").agg(dict(paths=list))
         self.pets = self.pets[self.pets["paths"].map(lambda p: len(p) > 1)]
         self.fold_count = fold_count
-        self.current_fold = 0 if fold_count is not None else None
+        self.folds = folds
+        if folds is not None:
+            if fold_count is None or fold_count <= 1:
+                raise ValueError("a fold assignment needs a fold_count above 1")
+            self.pet_folds = self.pets.index.map(lambda pet_id: folds.get(int(pet_id), -1)).to_numpy()
+            if self.pet_folds.max(initial=-1) >= fold_count:
+                raise ValueError(f"the fold assignment has more than {fold_count} folds")
+            if (self.pet_folds < 0).any():
+                logging.warning(f"{np.count_nonzero(self.pet_folds < 0)} pets have no fold, they are only used for training")
+            # Fail at the start instead of in the middle of cross validation
+            for fold in range(fold_count):
+                self.fold_pets(fold)
+        self.set_fold(0 if fold_count is not None else None)
 
     def __len__(self) -> int:
         return maxsize
 
     def __iter__(self) -> Iterator[Tuple[ImageT, ImageT, int]]:
-        for idx in range(len(self)):
+        return self.iter_items()
+
+    def iter_items(self, start: int = 0) -> Iterator[Tuple[ImageT, ImageT, int]]:
+        for idx in range(start, len(self)):
             yield self.__getitem__(idx)
 
-    def iter_test_items(self) -> Iterator[Tuple[ImageT, ImageT, int]]:
-        for idx in range(len(self)):
+    def iter_test_items(self, start: int = 0) -> Iterator[Tuple[ImageT, ImageT, int]]:
+        for idx in range(start, len(self)):
             yield self.get_test_item(idx)
 
-    def _get_item(self, idx: int) -> Tuple[ImageT, ImageT, int]:
+    def fold_pets(self, fold: Optional[int]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Returns the training and test pets of a fold. Negative pairs need a
+        second pet, so both need at least two pets with two or more records.
+        """
+        train_pets = test_pets = self.pets
+        if self.folds is not None:
+            in_fold = self.pet_folds == fold
+            train_pets = self.pets[~in_fold]
+            test_pets = self.pets[in_fold]
+        for name, pets in (("training", train_pets), ("test", test_pets)):
+            if len(pets) < 2:
+                where = f" of fold {fold}" if self.folds is not None else ""
+                raise ValueError(
+                    f"The {name} set{where} has {len(pets)} pets with at least two "
+                    "records, pairs need at least 2"
+                )
+        return train_pets, test_pets
+
+    def set_fold(self, fold: Optional[int]):
+        self.current_fold = fold
+        self.train_pets, self.test_pets = self.fold_pets(fold)
+
+    def _get_item(self, idx: int, pets: pd.DataFrame) -> Tuple[ImageT, ImageT, int]:
         rand_state = random.getstate()
         random.seed(idx ^ self.seed)
-        data_length = len(self.pets)
+        data_length = len(pets)
         idx = random.randint(0, data_length - 1)
         is_same = random.random() < self.same_probability
 
@@ -122,7 +212,7 @@ class RandomPairDataset(Dataset):
         img_path2 = None
         img_list1: List[str]
         img_list2: List[str]
-        image_paths_of_pet: List[List[str]] = self.pets.iloc[idx]["paths"]
+        image_paths_of_pet: List[List[str]] = pets.iloc[idx]["paths"]
         if is_same:
             if len(image_paths_of_pet) == 1:
                 raise RuntimeError("There is only one image for this pet. Please ensure there are at least 2 images per pet.")
@@ -142,36 +232,42 @@ class RandomPairDataset(Dataset):
             while idx2 == idx:
                 idx2 = random.randint(0, data_length - 1)
 
-            img_list2 = random.choice(self.pets.iloc[idx2]["paths"])
+            img_list2 = random.choice(pets.iloc[idx2]["paths"])
 
             img_path1 = random.choice(img_list1)
             img_path2 = random.choice(img_list2)
 
-        img1 = Image.open(img_path1).convert("RGB")
-        img2 = Image.open(img_path2).convert("RGB")
+        img1 = self.load_image(img_path1)
+        img2 = self.load_image(img_path2)
 
         random.setstate(rand_state)
 
         return img1, img2, is_same
 
+    def load_image(self, path: str) -> ImageT:
+        if self.image_cache is not None:
+            return self.image_cache.get(path)
+        return Image.open(path).convert("RGB")
+
     def __getitem__(self, idx: int) -> Tuple[ImageT, ImageT, int]:
         # To implement K-fold validation, we simply skip every Kth index.
-        if self.fold_count is not None and self.fold_count > 1:
+        if self.folds is None and self.fold_count is not None and self.fold_count > 1:
             fold_number = self.fold_count - 1
             idx = idx + int(idx % fold_number >= self.current_fold) + idx // fold_number
 
-        return self._get_item(idx)
+        return self._get_item(idx, self.train_pets)
 
     def get_test_item(self, idx: int) -> Tuple[ImageT, ImageT, int]:
         if self.fold_count is None or self.fold_count <= 1:
             raise RuntimeError("no test items in dataset, specify k-fold")
 
-        idx = self.current_fold + idx * self.fold_count
+        if self.folds is None:
+            idx = self.current_fold + idx * self.fold_count
 
-        return self._get_item(idx)
+        return self._get_item(idx, self.test_pets)
 
     def next_fold(self):
-        self.current_fold = (self.current_fold + 1) % self.fold_count
+        self.set_fold((self.current_fold + 1) % self.fold_count)
 
     def visualize_batch(
         self,
@@ -212,16 +308,34 @@ class RandomPairDataset(Dataset):
         self,
         batch_size=8,
         test=False,
+        start: int = 0,
+        augment: Optional[bool] = None,
     ) -> Iterator[Tuple[List[ImageT], List[ImageT], List[int]]]:
+        """
+        Yields batches of pairs. `start` is the index of the first pair, which
+        allows a resumed run to continue the stream where it stopped.
+
+        With an augmenter, the batches are augmented unless `augment` is
+        False. By default only the training batches are augmented.
+        """
         img0s, img1s, labels = [], [], []
 
-        source = self.iter_test_items() if test else self
+        source = self.iter_test_items(start) if test else self.iter_items(start)
+        if augment is None:
+            augment = not test
+        augment = augment and self.augmenter is not None
 
-        for img0, img1, label in source:
+        for idx, (img0, img1, label) in enumerate(source, start):
             img0s.append(img0)
             img1s.append(img1)
             labels.append(label)
 
             if len(img0s) == batch_size:
+                if augment:
+                    # Seeded by the position in the stream like the pairs,
+                    # so a resumed run sees the same augmentations
+                    self.augmenter.manual_seed(idx ^ self.seed)
+                    augmented = self.augmenter.augment(img0s + img1s)
+                    img0s, img1s = augmented[:batch_size], augmented[batch_size:]
                 yield img0s, img1s, labels
                 img0s, img1s, labels = [], [], []
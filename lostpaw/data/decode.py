@@ -0,0 +1,92 @@
+from io import BytesIO
+from math import ceil
+from pathlib import Path
+from typing import BinaryIO, Optional, Sequence, Tuple, Union
+from PIL import Image
+from PIL.Image import Image as ImageT
+
+# DetrFeatureExtractor resizes the shortest edge of every image to this size
+DETR_SHORTEST_EDGE = 800
+
+Source = Union[str, Path, bytes, bytearray]
+Box = Sequence[float]
+
+
+def _open(source: Source, formats: Optional[Sequence[str]] = None) -> ImageT:
+    file: Union[str, Path, BinaryIO] = (
+        source if isinstance(source, (str, Path)) else BytesIO(source)
+    )
+    return Image.open(file, formats=formats)
+
+
+def decode(image: ImageT, scale: float = 1.0) -> ImageT:
+    """
+    Decodes an opened image to RGB. JPEGs are decoded with the scaled IDCT of
+    libjpeg at 1/2, 1/4 or 1/8 of their size, the smallest of these that is
+    at least `scale` times the original size. That is several times faster
+    and needs a fraction of the memory of decoding at full size. Other
+    formats are decoded at full size.
+    """
+    if scale < 1.0:
+        width, height = image.size
+        image.draft("RGB", (ceil(width * scale), ceil(height * scale)))
+    return image.convert("RGB")
+
+
+def open_image(path: Source, size: Optional[Tuple[int, int]] = None) -> ImageT:
+    """Decodes an image to RGB, at reduced resolution if only `size` is needed."""
+    with _open(path) as image:
+        scale = 1.0
+        if size is not None:
+            scale = max(size[0] / image.size[0], size[1] / image.size[1])
+        return decode(image, scale)
+
+
+class ScaledImage:
+    def __init__(
+        self,
+        source: Source,
+        shortest_edge: Optional[int] = DETR_SHORTEST_EDGE,
+        formats: Optional[Sequence[str]] = None,
+    ):
+        """
+        An image decoded at the lowest resolution with a shortest edge of at
+        least `shortest_edge` pixels, the size DETR runs at. Crops of regions
+        that need more pixels are decoded again at a higher resolution.
+
+        Args:
+            source: Path or encoded bytes of the image.
+            shortest_edge: Smallest size of the shortest edge of the decoded
+                           image. None decodes at full size.
+            formats: Formats that are allowed to be opened, all by default.
+        """
+        self.source = source
+        self.formats = formats
+        with _open(source, formats) as image:
+            self.original_size: Tuple[int, int] = image.size
+            scale = 1.0
+            if shortest_edge is not None:
+                scale = shortest_edge / min(image.size)
+            self.image = decode(image, scale)
+        # Size of the decoded image relative to the original
+        self.scale = self.image.size[0] / self.original_size[0]
+
+    def crop(self, box: Box, min_size: Optional[int] = None) -> ImageT:
+        """
+        Crops a (left, top, right, bottom) box given in the coordinates of
+        `self.image`, like the DETR detections on it.
+
+        The crop comes from the lowest resolution at which its longest side
+        has at least `min_size` pixels, by default from the full resolution.
+        """
+        original_box = [v / self.scale for v in box]
+        longest_side = max(original_box[2] - original_box[0], original_box[3] - original_box[1], 1)
+        scale = 1.0 if min_size is None else min(min_size / longest_side, 1.0)
+
+        if scale <= self.scale:
+            return self.image.crop([int(v) for v in box])
+
+        with _open(self.source, self.formats) as image:
+            image = decode(image, scale)
+        scale = image.size[0] / self.original_size[0]
+        return image.crop([int(v * scale) for v in original_box])
@@ -0,0 +1,147 @@
+from hashlib import blake2b
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import json
+import os
+import numpy as np
+from PIL.Image import Image
+
+Detections = Dict[str, np.ndarray]
+
+_COLUMNS = ["keys", "offsets", "sizes", "scores", "labels", "boxes"]
+
+
+def image_key(image: Image) -> bytes:
+    """Hash of the decoded pixels, the same image has the same key at any path."""
+    digest = blake2b(digest_size=16)
+    digest.update(f"{image.mode}{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.digest()
+
+
+class DetectionCache:
+    def __init__(self, folder: Path, min_score: float = 0.5, flush_every: int = 4096):
+        """
+        Stores the DETR detections of images on disk, so the crops can be
+        extracted again with another threshold, label set or output size
+        without running the model.
+
+        The detections are saved in shards of columnar .npy files, which are
+        memory mapped when the cache is opened. Every process writes its own
+        shards, so the extraction processes can share one cache folder.
+
+        Args:
+            folder: Folder of the cache.
+            min_score: Detections with a lower score are not stored, crops
+                       can be replayed with any threshold above it.
+            flush_every: Number of images after which a new shard is written.
+        """
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.min_score = min_score
+        self.flush_every = flush_every
+        self.shards: List[Dict[str, np.ndarray]] = []
+        self.index: Dict[bytes, Tuple[int, int]] = dict()
+        self.pending: Dict[bytes, Tuple[Tuple[int, int], Detections]] = dict()
+        self.hits = 0
+        self.misses = 0
+
+        meta_path = self.folder / "cache.json"
+        if meta_path.exists():
+            with open(meta_path, "rt") as f:
+                self.min_score = max(self.min_score, json.load(f)["min_score"])
+        else:
+            with open(meta_path, "wt") as f:
+                json.dump(dict(min_score=min_score), f)
+
+        for shard_path in sorted(self.folder.glob("shard_*")):
+            if (shard_path / "boxes.npy").exists():
+                self._load_shard(shard_path)
+
+    def _load_shard(self, path: Path):
+        shard = {c: np.load(path / f"{c}.npy", mmap_mode="r") for c in _COLUMNS}
+        shard_index = len(self.shards)
+        self.shards.append(shard)
+        for i, key in enumerate(shard["keys"]):
+            self.index[bytes(key)] = (shard_index, i)
+
+    def __len__(self) -> int:
+        return len(self.index) + len(self.pending)
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self.index or key in self.pending
+
+    def get(self, key: bytes, size: Tuple[int, int]) -> Optional[Detections]:
+        """
+        Returns the detections of an image of (width, height) `size`, or None
+        when they are not cached.
+        """
+        if key in self.pending:
+            cached_size, detections = self.pending[key]
+        elif key in self.index:
+            shard_index, i = self.index[key]
+            shard = self.shards[shard_index]
+            start, end = shard["offsets"][i], shard["offsets"][i + 1]
+            cached_size = tuple(shard["sizes"][i].tolist())
+            detections = dict(
+                scores=np.asarray(shard["scores"][start:end]),
+                labels=np.asarray(shard["labels"][start:end]),
+                boxes=np.asarray(shard["boxes"][start:end]),
+            )
+        else:
+            self.misses += 1
+            return None
+
+        if cached_size != tuple(size):
+            # A collision or another image, the boxes would not fit
+            self.misses += 1
+            return None
+        self.hits += 1
+        return detections
+
+    def put(self, key: bytes, size: Tuple[int, int], detections: Detections):
+        keep = np.asarray(detections["scores"]) >= self.min_score
+        self.pending[key] = (
+            tuple(size),
+            dict(
+                scores=np.asarray(detections["scores"], dtype=np.float32)[keep],
+                labels=np.asarray(detections["labels"], dtype=np.int16)[keep],
+                boxes=np.asarray(detections["boxes"], dtype=np.float32).reshape(-1, 4)[keep],
+            ),
+        )
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        items = list(self.pending.items())
+        counts = [len(d["scores"]) for _, (_, d) in items]
+        columns = dict(
+            keys=np.array([np.frombuffer(k, dtype=np.uint8) for k, _ in items]),
+            offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            sizes=np.array([size for _, (size, _) in items], dtype=np.int32),
+            scores=np.concatenate([d["scores"] for _, (_, d) in items]),
+            labels=np.concatenate([d["labels"] for _, (_, d) in items]),
+            boxes=np.concatenate([d["boxes"] for _, (_, d) in items]).reshape(-1, 4),
+        )
+
+        # Written under a temporary name, a shard is complete once it is renamed
+        name = f"shard_{os.getpid()}_{len(self.shards):05d}_{os.urandom(4).hex()}"
+        partial = self.folder / f".{name}"
+        partial.mkdir()
+        for column, values in columns.items():
+            np.save(partial / f"{column}.npy", values)
+        os.replace(partial, self.folder / name)
+
+        self.pending.clear()
+        self._load_shard(self.folder / name)
+
+    def stats(self) -> Dict[str, float]:
+        requests = self.hits + self.misses
+        return dict(
+            images=len(self),
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / requests if requests else 0.0,
+        )
@@ -1,17 +1,69 @@
-from transformers import DetrFeatureExtractor, DetrForObjectDetection
-from typing import Iterable, List, Optional, Sequence, Sized, Tuple, TypeVar
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Sequence, Sized, Tuple, TypeVar
 from pathlib import Path
 from PIL.Image import Image, new as newImage
 import logging
-import torch
+
+from lostpaw.data.buckets import group_by_aspect
+from lostpaw.data.cascade import FastPetDetector
+from lostpaw.data.decode import ScaledImage
+from lostpaw.data.detection_cache import DetectionCache, image_key
+
+# torch and transformers are slow to import, they are imported on first use
+# so tools that only need lookup_next_image_name start quickly.
+if TYPE_CHECKING:
+    from transformers import DetrConfig, DetrFeatureExtractor, DetrForObjectDetection
 
 L = TypeVar('L') 
 
 class DetrPetExtractor:
-    def __init__(self, path: Path):
-        self.feature_extractor: DetrFeatureExtractor = None
-        self.model: DetrForObjectDetection = None
-        self.load_extractor(path)
+    def __init__(
+        self,
+        path: Path,
+        config: Optional["DetrConfig"] = None,
+        cache: Optional[DetectionCache] = None,
+        bucket_width: float = 0.1,
+        fast_detector: Optional[FastPetDetector] = None,
+    ):
+        """
+        Args:
+            path: Folder of the saved DETR model, it is downloaded when missing.
+            config: Builds a randomly initialized model instead, for testing.
+            cache: Stores the detections per image, the model only runs on
+                   images that are not in the cache. With a cache the model
+                   is loaded when it is first needed.
+            bucket_width: The images of a call are run in batches of about the
+                   same aspect ratio, see lostpaw.data.buckets. A batch is
+                   padded to its largest height and width, mixing portrait
+                   and landscape images wastes most of the compute on
+                   padding. 0 runs all images in one batch.
+            fast_detector: Runs first on the images, DETR only runs on the
+                   images it is not confident about. Most uploads are close
+                   ups of a single pet, they skip DETR.
+        """
+        self.feature_extractor: "DetrFeatureExtractor" = None
+        self.model: "DetrForObjectDetection" = None
+        self.path = path
+        self.config = config
+        self.cache = cache
+        self.bucket_width = bucket_width
+        self.fast_detector = fast_detector
+        # Pixels of the model inputs, and how many of them are padding
+        self.input_pixels = 0
+        self.padding_pixels = 0
+        if cache is None:
+            self.load()
+
+    def load(self):
+        if self.model is not None:
+            return
+        if self.config is None:
+            self.load_extractor(self.path)
+        else:
+            from transformers import DetrFeatureExtractor, DetrForObjectDetection
+
+            # Randomly initialized model, nothing is downloaded or saved
+            self.model = DetrForObjectDetection(self.config)
+            self.feature_extractor = DetrFeatureExtractor()
 
     def extract(
         self,
@@ -19,6 +71,7 @@ class DetrPetExtractor:
         labels: Iterable[L],
         threshold: float = 0.9,
         output_size: Optional[tuple] = None,
+        sources: Optional[Sequence[ScaledImage]] = None,
     ) -> List[Tuple[Image, L]]:
         """
         Extract pets from images.
@@ -28,47 +81,106 @@ class DetrPetExtractor:
             labels: List of labels for each image. If provided, the output will be a list of tuples (image, (label, pet)).
             threshold: Threshold for the model to consider a prediction as valid.
             output_size: Size of the output images. If None, the output images will have the same size as the input images.
+            sources: The reduced resolution decodes the images come from. The
+                     pets are then cropped at the resolution the output size
+                     needs, instead of from the reduced images.
 
         Returns:
             List of images or List of tuples (image, (label, pet)).
         """
 
-        inputs = self.feature_extractor(images=images, return_tensors="pt")
-        outputs = self.model(**inputs)
-
-        # Get the predicted bounding boxes and labels
-        target_sizes = torch.tensor([i.size[::-1] for i in images])
-        results = self.feature_extractor.post_process_object_detection(
-            outputs, target_sizes=target_sizes
-        )
+        results = self.detect(images)
 
         cropped_images = []
 
-        for result, image, pet_label in zip(results, images, labels):
-            imgs = self.parse_result(result, image, threshold, output_size)
+        for i, (result, image, pet_label) in enumerate(zip(results, images, labels)):
+            source = sources[i] if sources is not None else None
+            imgs = self.parse_result(result, image, threshold, output_size, source)
             imgs_with_labels = [(img, pet_label) for img in imgs]
             cropped_images.extend(imgs_with_labels)
 
         logging.info(f"Found {len(cropped_images)} pets in {len(images)} images.")
         return cropped_images
 
+    def detect(self, images: Sequence[Image]) -> List[Dict[str, Any]]:
+        """
+        Returns the scores, labels and boxes of the detections in every image,
+        from the cache or the fast detector when possible.
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(images)
+        keys = []
+        if self.cache is not None:
+            keys = [image_key(image) for image in images]
+            results = [self.cache.get(k, i.size) for k, i in zip(keys, images)]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing and self.fast_detector is not None:
+            # The cache only holds DETR detections, the fast path results
+            # depend on the cascade settings and are cheap to compute again
+            selected = self.fast_detector.select([images[i] for i in missing])
+            for i, result in zip(missing, selected):
+                results[i] = result
+            missing = [i for i, result in zip(missing, selected) if result is None]
+
+        if missing:
+            detected = self.run_model([images[i] for i in missing])
+            for i, result in zip(missing, detected):
+                results[i] = result
+                if self.cache is not None:
+                    self.cache.put(keys[i], images[i].size, result)
+        return results
+
+    def run_model(self, images: Sequence[Image]) -> List[Dict[str, Any]]:
+        """Runs DETR on the images, grouped by aspect ratio, in their original order."""
+        results: List[Any] = [None] * len(images)
+        for group in group_by_aspect([i.size for i in images], self.bucket_width):
+            detected = self.run_batch([images[i] for i in group])
+            for i, result in zip(group, detected):
+                results[i] = result
+        return results
+
+    def run_batch(self, images: Sequence[Image]) -> List[Dict[str, Any]]:
+        import torch
+
+        self.load()
+        inputs = self.feature_extractor(images=images, return_tensors="pt")
+        mask = inputs["pixel_mask"]
+        self.input_pixels += mask.numel()
+        self.padding_pixels += mask.numel() - int(mask.sum())
+        with torch.no_grad():
+            outputs = self.model(**inputs)
+
+        # Get the predicted bounding boxes and labels
+        target_sizes = torch.tensor([i.size[::-1] for i in images])
+        threshold = self.cache.min_score if self.cache is not None else 0.5
+        results = self.feature_extractor.post_process_object_detection(
+            outputs, threshold=threshold, target_sizes=target_sizes
+        )
+        return [{k: v.numpy() for k, v in result.items()} for result in results]
+
+    def padding_fraction(self) -> float:
+        """Fraction of the pixels DETR ran on that were padding."""
+        return self.padding_pixels / self.input_pixels if self.input_pixels else 0.0
+
     def parse_result(
         self,
         result,
         image: Image,
         threshold: float = 0.9,
         output_size: Optional[tuple] = None,
+        source: Optional[ScaledImage] = None,
     ):
         imgs = []
         for score, label, box in zip(
             result["scores"], result["labels"], result["boxes"]
         ):
-            box = [int(x) for x in box]
-
             if score > threshold:
                 # Save only if the label is "cat" or "dog"
                 if (label == 17) or (label == 18):
-                    img_crop = image.crop(box)
+                    if source is not None:
+                        img_crop = source.crop(box, max(output_size) if output_size else None)
+                    else:
+                        img_crop = image.crop([int(x) for x in box])
                     if output_size:
                         img_crop = self.resize(img_crop, output_size)
 
@@ -98,6 +210,8 @@ class DetrPetExtractor:
         return new_image
 
     def load_extractor(self, path: Path):
+        from transformers import DetrFeatureExtractor, DetrForObjectDetection
+
         model_path = Path(path) / "extractor_model"
         feature_path = Path(path) / "extractor_feature"
         if model_path.exists():
@@ -0,0 +1,238 @@
+from collections import OrderedDict
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Optional, Tuple, Union
+import multiprocessing
+import weakref
+import numpy as np
+from PIL import Image
+from PIL.Image import Image as ImageT
+
+from lostpaw.data.decode import open_image
+
+PathLike = Union[str, Path]
+
+
+def load_image(path: PathLike, size: Optional[Tuple[int, int]] = None) -> ImageT:
+    # JPEGs much larger than `size` are decoded at a fraction of their size
+    image = open_image(path, size)
+    if size is not None and image.size != tuple(size):
+        # Bilinear, like the resize of the ViT feature extractor
+        image = image.resize(size, Image.BILINEAR)
+    return image
+
+
+class ImageCache:
+    def __init__(self, max_bytes: int, size: Optional[Tuple[int, int]] = None):
+        """
+        Keeps decoded images in memory, evicting the least recently used
+        ones when the cache grows beyond `max_bytes`.
+
+        The cached images are shared between callers, they must not be
+        modified in place.
+
+        Args:
+            max_bytes: Memory budget of the decoded pixels.
+            size: When given, images are resized to (width, height) before
+                  they are cached.
+        """
+        self.max_bytes = max_bytes
+        self.size = tuple(size) if size is not None else None
+        self.images: "OrderedDict[str, ImageT]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, path: PathLike) -> ImageT:
+        key = str(path)
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        # Decode outside of the lock, so other threads are not blocked
+        image = load_image(path, self.size)
+        image_bytes = image.width * image.height * 3
+        if image_bytes > self.max_bytes:
+            return image
+
+        with self.lock:
+            if key not in self.images:
+                self.images[key] = image
+                self.bytes += image_bytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.bytes -= evicted.width * evicted.height * 3
+                self.evictions += 1
+        return image
+
+    def stats(self) -> Dict[str, float]:
+        requests = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            hit_rate=self.hits / requests if requests else 0.0,
+            images=len(self.images),
+            bytes=self.bytes,
+        )
+
+    def __getstate__(self):
+        # Worker processes start with an empty cache of their own
+        state = self.__dict__.copy()
+        state["images"] = OrderedDict()
+        state["bytes"] = 0
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+
+class SharedImageCache:
+    def __init__(self, max_bytes: int, size: Tuple[int, int]):
+        """
+        Image cache in shared memory, so the processes that load data share
+        the decoded images. The images all have the same size, every image
+        takes one fixed slot and slots are reused with clock eviction.
+
+        The cache is shared with processes that receive it as an argument
+        when they are started, like the workers of a torch DataLoader.
+
+        Args:
+            max_bytes: Memory budget of the decoded pixels.
+            size: Images are resized to (width, height) before they are cached.
+        """
+        from multiprocessing.shared_memory import SharedMemory
+
+        self.size = (int(size[0]), int(size[1]))
+        self.shape = (self.size[1], self.size[0], 3)
+        slot_bytes = int(np.prod(self.shape))
+        self.slot_count = max(max_bytes // slot_bytes, 1)
+
+        self.pixel_memory = SharedMemory(create=True, size=self.slot_count * slot_bytes)
+        # Per slot the key and the reference bit, then the clock hand and the
+        # hit, miss and eviction counters.
+        self.counter_offset = (9 * self.slot_count + 7) // 8 * 8
+        self.meta_memory = SharedMemory(create=True, size=self.counter_offset + 8 * 4)
+        self.lock = multiprocessing.Lock()
+        self._attach()
+        self.keys[:] = 0
+        self.referenced[:] = 0
+        self.counters[:] = 0
+
+        # The creating process removes the shared memory when it is done
+        self._finalizer = weakref.finalize(
+            self, SharedImageCache._release, self.pixel_memory, self.meta_memory
+        )
+
+    def _attach(self):
+        n = self.slot_count
+        self.pixels = np.ndarray(
+            (n, *self.shape), dtype=np.uint8, buffer=self.pixel_memory.buf
+        )
+        meta = self.meta_memory.buf
+        self.keys = np.ndarray((n,), dtype=np.int64, buffer=meta)
+        self.referenced = np.ndarray((n,), dtype=np.uint8, buffer=meta, offset=8 * n)
+        # hand, hits, misses, evictions
+        self.counters = np.ndarray(
+            (4,), dtype=np.int64, buffer=meta, offset=self.counter_offset
+        )
+
+    @staticmethod
+    def _release(pixel_memory, meta_memory):
+        for memory in [pixel_memory, meta_memory]:
+            try:
+                memory.close()
+            except BufferError:
+                # Arrays still point into the memory, it is freed with them
+                pass
+            memory.unlink()
+
+    @staticmethod
+    def _key(path: PathLike) -> int:
+        # 0 marks an empty slot
+        digest = blake2b(str(path).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little", signed=True) or 1
+
+    def get(self, path: PathLike) -> ImageT:
+        key = self._key(path)
+        with self.lock:
+            slots = np.flatnonzero(self.keys == key)
+            if len(slots) > 0:
+                slot = slots[0]
+                self.referenced[slot] = 1
+                self.counters[1] += 1
+                # Copy while holding the lock, the slot may be reused afterwards
+                return Image.fromarray(self.pixels[slot].copy())
+            self.counters[2] += 1
+
+        image = load_image(path, self.size)
+        pixels = np.asarray(image)
+
+        with self.lock:
+            if not np.any(self.keys == key):
+                slot = self._evict()
+                self.pixels[slot] = pixels
+                self.keys[slot] = key
+                self.referenced[slot] = 1
+        return image
+
+    def _evict(self) -> int:
+        """Advances the clock hand to a slot that was not recently used."""
+        while True:
+            slot = int(self.counters[0])
+            self.counters[0] = (slot + 1) % self.slot_count
+            if self.keys[slot] == 0:
+                return slot
+            if self.referenced[slot]:
+                self.referenced[slot] = 0
+            else:
+                self.counters[3] += 1
+                return slot
+
+    def stats(self) -> Dict[str, float]:
+        _, hits, misses, evictions = self.counters.tolist()
+        requests = hits + misses
+        return dict(
+            hits=hits,
+            misses=misses,
+            evictions=evictions,
+            hit_rate=hits / requests if requests else 0.0,
+            images=int(np.count_nonzero(self.keys)),
+            bytes=int(np.count_nonzero(self.keys)) * int(np.prod(self.shape)),
+        )
+
+    def close(self):
+        for name in ["pixels", "keys", "referenced", "counters"]:
+            self.__dict__.pop(name, None)
+        self._finalizer()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ["pixels", "keys", "referenced", "counters", "_finalizer"]:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Only the creating process releases the memory
+        self._finalizer = weakref.finalize(self, lambda: None)
+        self._attach()
+
+
+def create_image_cache(
+    max_bytes: int, size: Optional[Tuple[int, int]] = None, shared: bool = False
+) -> Union[ImageCache, SharedImageCache]:
+    if shared:
+        if size is None:
+            raise ValueError("a shared image cache needs a fixed image size")
+        return SharedImageCache(max_bytes, size)
+    return ImageCache(max_bytes, size)
@@ -0,0 +1,244 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+import errno
+import json
+import logging
+import os
+import shutil
+
+LINK_MODES = ["auto", "reflink", "hardlink", "copy"]
+
+
+@dataclass
+class PlannedRecord:
+    pet_id: int
+    source: Optional[str]
+    sources: List[str]
+    paths: List[str]
+
+
+def read_records(info_file: Path) -> Iterator[Dict]:
+    """
+    Streams the records of an info file. Records written by
+    scripts/extract_pets.py name their keys source_path and augmented.
+    """
+    if not info_file.exists():
+        return
+    with open(info_file, "rt") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield dict(
+                pet_id=int(record["pet_id"]),
+                source=record.get("source", record.get("source_path")),
+                paths=record.get("paths", record.get("augmented", [])),
+            )
+
+
+def read_lines(path: Path) -> List[str]:
+    """Returns the non-empty lines of a file like processed.txt, if it exists."""
+    if not path.exists():
+        return []
+    with open(path, "rt") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+class _NameAllocator:
+    # Hands out the names lookup_next_image_name would give, without
+    # listing the folder for every image
+    def __init__(self, folder: Path):
+        existing = set(os.listdir(folder)) if folder.exists() else set()
+        self.taken = existing
+        self.next = sum(1 for name in existing if name.endswith(".jpg"))
+
+    def __call__(self) -> str:
+        while f"{self.next}.jpg" in self.taken:
+            self.next += 1
+        name = f"{self.next}.jpg"
+        self.taken.add(name)
+        return name
+
+
+def plan_merge(sources: List[Path], target: Path) -> List[PlannedRecord]:
+    """
+    Assigns a destination in the target folder to every image of the source
+    folders, without touching the file system. Records of which the source
+    image is already in the target are skipped, so a finished merge is not
+    repeated.
+    """
+    merged = set(
+        record["source"]
+        for record in read_records(target / "train.data")
+        if record["source"] is not None
+    )
+    allocators: Dict[int, _NameAllocator] = dict()
+    plan = []
+    for source in sources:
+        for record in read_records(source / "train.data"):
+            if record["source"] in merged:
+                continue
+            pet_id = record["pet_id"]
+            if pet_id not in allocators:
+                allocators[pet_id] = _NameAllocator(target / str(pet_id))
+            source_paths = [str(_resolve(source, p)) for p in record["paths"]]
+            paths = [
+                str((target / str(pet_id) / allocators[pet_id]()).resolve())
+                for _ in source_paths
+            ]
+            plan.append(PlannedRecord(pet_id, record["source"], source_paths, paths))
+    return plan
+
+
+def _resolve(folder: Path, path: str) -> Path:
+    return Path(path) if Path(path).is_absolute() else folder / path
+
+
+def link_or_copy(source: Path, destination: Path, mode: str = "auto") -> str:
+    """
+    Places a copy of `source` at `destination` and returns how: with a
+    reflink (copy on write clone), a hardlink or a regular copy. "auto" tries
+    them in that order, the links only work within one file system.
+    """
+    if mode in ["auto", "reflink"]:
+        try:
+            _reflink(source, destination)
+            return "reflink"
+        except OSError:
+            if mode == "reflink":
+                raise
+    if mode in ["auto", "hardlink"]:
+        try:
+            os.link(source, destination)
+            return "hardlink"
+        except OSError as e:
+            if mode == "hardlink" or e.errno == errno.EEXIST:
+                raise
+    shutil.copyfile(source, destination)
+    return "copy"
+
+
+def _reflink(source: Path, destination: Path):
+    import fcntl
+
+    # FICLONE from linux/fs.h, supported by btrfs, xfs and others
+    ficlone = 0x40049409
+    with open(source, "rb") as src:
+        with open(destination, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(destination)
+                raise
+
+
+class FolderMerger:
+    def __init__(
+        self,
+        sources: List[Path],
+        target: Path,
+        workers: int = 16,
+        link: str = "auto",
+    ):
+        """
+        Merges the outputs of scripts/extract_pets.py, like its thread_*
+        folders, into one dataset folder.
+
+        The destination of every image is planned up front and saved in the
+        target folder, the files are copied in parallel, and the records are
+        appended to the info file in one write. An interrupted merge is
+        resumed from the saved plan: existing files are not copied again,
+        and records already in the info file and lines already in
+        processed.txt are not appended again.
+
+        Args:
+            sources: Folders with a train.data and processed.txt file.
+            target: The merged dataset folder.
+            workers: Number of threads that copy the images.
+            link: How to copy: auto, reflink, hardlink or copy.
+        """
+        if link not in LINK_MODES:
+            raise ValueError(f"unknown link mode: {link}")
+        self.sources = sources
+        self.target = target
+        self.workers = workers
+        self.link = link
+        self.info_file = target / "train.data"
+        self.plan_file = target / "merge_plan.jsonl"
+
+    def plan(self) -> List[PlannedRecord]:
+        if self.plan_file.exists():
+            logging.info(f"Resuming the merge planned in {self.plan_file}")
+            with open(self.plan_file, "rt") as f:
+                return [PlannedRecord(**json.loads(line)) for line in f]
+        return plan_merge(self.sources, self.target)
+
+    def merge(self, dry_run: bool = False) -> Dict[str, int]:
+        plan = self.plan()
+        stats = dict(records=len(plan), images=sum(len(r.paths) for r in plan))
+        if dry_run:
+            return stats
+
+        self.target.mkdir(parents=True, exist_ok=True)
+        if not self.plan_file.exists():
+            self._write_lines(self.plan_file, [asdict(r) for r in plan], "wt")
+
+        for pet_id in set(record.pet_id for record in plan):
+            (self.target / str(pet_id)).mkdir(exist_ok=True)
+
+        pairs = [
+            (Path(source), Path(path))
+            for record in plan
+            for source, path in zip(record.sources, record.paths)
+            if not Path(path).exists()
+        ]
+        stats["skipped"] = stats["images"] - len(pairs)
+        with ThreadPoolExecutor(self.workers) as pool:
+            for method in pool.map(lambda p: self._copy(*p), pairs):
+                stats[method] = stats.get(method, 0) + 1
+
+        merged = set(
+            path for record in read_records(self.info_file) for path in record["paths"]
+        )
+        new_records = [
+            dict(paths=record.paths, pet_id=record.pet_id, source=record.source)
+            for record in plan
+            if not all(path in merged for path in record.paths)
+        ]
+        self._write_lines(self.info_file, new_records, "at")
+        stats["appended"] = len(new_records)
+
+        # Like the records, lines a previous attempt already appended are skipped
+        target_processed = self.target / "processed.txt"
+        seen = set(read_lines(target_processed))
+        processed = []
+        for source in self.sources if plan else []:
+            for line in read_lines(source / "processed.txt"):
+                if line not in seen:
+                    seen.add(line)
+                    processed.append(line)
+        with open(target_processed, "at") as f:
+            f.writelines(f"{line}\n" for line in processed)
+
+        self.plan_file.unlink()
+        return stats
+
+    def _copy(self, source: Path, destination: Path) -> str:
+        # Copy to a temporary name, so an interrupted copy is not mistaken
+        # for a finished one when resuming
+        partial = destination.with_suffix(".partial")
+        if partial.exists():
+            partial.unlink()
+        method = link_or_copy(source, partial, self.link)
+        os.replace(partial, destination)
+        return method
+
+    @staticmethod
+    def _write_lines(path: Path, records: List[Dict], mode: str):
+        with open(path, mode) as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+            f.flush()
+            os.fsync(f.fileno())
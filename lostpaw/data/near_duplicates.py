@@ -0,0 +1,331 @@
+from dataclasses import dataclass, field
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+import logging
+import numpy as np
+from PIL import Image
+
+from lostpaw.data.data_folder import PetImagesFolder
+
+PathLike = Union[str, Path]
+
+# Set bits of every byte value, to count the bits of 64 bit hashes
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def dhash(path: PathLike) -> Optional[int]:
+    """
+    Computes the 64 bit difference hash of an image: the signs of the
+    horizontal gradients of a 9x8 grayscale thumbnail. Resized and
+    re-encoded copies of an image get the same or a very similar hash.
+
+    Returns None when the image cannot be read.
+    """
+    try:
+        with Image.open(path) as image:
+            # Lets the JPEG decoder skip most of the pixels
+            image.draft("L", (64, 64))
+            thumbnail = image.convert("L").resize((9, 8), Image.BILINEAR)
+    except (OSError, ValueError):
+        return None
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int(bits.view(">u8")[0])
+
+
+def compute_hashes(
+    paths: Sequence[PathLike], workers: int = 4, chunk_size: int = 256
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Hashes the images in `workers` processes. Returns the hashes and a mask
+    of the images that could be read.
+    """
+    if workers > 1:
+        with Pool(workers) as pool:
+            hashes = pool.map(dhash, paths, chunksize=chunk_size)
+    else:
+        hashes = [dhash(path) for path in paths]
+
+    valid = np.array([h is not None for h in hashes], dtype=bool)
+    values = np.array([h or 0 for h in hashes], dtype=np.uint64)
+    return values, valid
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    xor = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64)
+    return _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _bands(max_distance: int, bits: Sequence[int]) -> List[np.ndarray]:
+    # Hashes within max_distance bits of each other have at least one of
+    # max_distance + 1 disjoint bands in common, pigeonhole principle
+    count = max_distance + 1
+    if count > len(bits):
+        raise ValueError(f"max_distance must be smaller than {len(bits)}")
+    edges = np.linspace(0, len(bits), count + 1).astype(int)
+    return [np.asarray(bits[start:end]) for start, end in zip(edges[:-1], edges[1:])]
+
+
+def _band_values(hashes: np.ndarray, band: np.ndarray) -> np.ndarray:
+    if np.array_equal(band, np.arange(band[0], band[0] + len(band))):
+        # Contiguous bits, the common case
+        return (hashes >> np.uint64(band[0])) & np.uint64((1 << len(band)) - 1)
+    values = np.zeros(len(hashes), dtype=np.uint64)
+    for i, bit in enumerate(band.tolist()):
+        values |= ((hashes >> np.uint64(bit)) & np.uint64(1)) << np.uint64(i)
+    return values
+
+
+def _all_pairs(
+    hashes: np.ndarray, max_distance: int, chunk_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Compares every pair, `chunk_size` rows at a time
+    found_first, found_second = [], []
+    for start in range(0, len(hashes), chunk_size):
+        rows = np.arange(start, min(start + chunk_size, len(hashes)))
+        first, second = np.meshgrid(rows, np.arange(len(hashes)), indexing="ij")
+        first, second = first[first < second], second[first < second]
+        close = hamming_distance(hashes[first], hashes[second]) <= max_distance
+        found_first.append(first[close])
+        found_second.append(second[close])
+    return np.concatenate(found_first), np.concatenate(found_second)
+
+
+def candidate_pairs(
+    hashes: np.ndarray,
+    max_distance: int,
+    max_bucket: int = 1024,
+    stats: Optional[Dict[str, int]] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds all pairs of distinct hashes within `max_distance` bits, with a
+    multi-index: for every band of the hashes, hashes with the same band value
+    are bucketed together and only hashes in the same bucket are compared.
+
+    Buckets larger than `max_bucket` would make the comparison quadratic.
+    Their hashes are indexed again on max_distance + 1 bands of the other
+    bits, which finds all their close pairs too. Buckets of that second
+    index that are still too large are compared in chunks. Near duplicates
+    share most bands, so indexing deeper would visit them exponentially often.
+
+    Args:
+        hashes: The 64 bit hashes.
+        max_distance: Maximum number of differing bits of a pair.
+        max_bucket: Largest bucket that is compared directly.
+        stats: Counts the buckets that were split, and their hashes.
+
+    Returns the index pairs (first < second) into `hashes`.
+    """
+    return _index_pairs(hashes, max_distance, max_bucket, stats, list(range(64)), True)
+
+
+def _index_pairs(
+    hashes: np.ndarray,
+    max_distance: int,
+    max_bucket: int,
+    stats: Optional[Dict[str, int]],
+    bits: List[int],
+    split: bool,
+) -> Tuple[np.ndarray, np.ndarray]:
+    found_first, found_second = [], []
+    for band_bits in _bands(max_distance, bits):
+        band = _band_values(hashes, band_bits)
+        order = np.argsort(band, kind="stable")
+        sorted_band = band[order]
+
+        # Position of every hash within its bucket, and the size of the bucket
+        boundaries = np.flatnonzero(np.diff(sorted_band)) + 1
+        bucket_starts = np.concatenate([[0], boundaries]).astype(np.int64)
+        bucket_sizes = np.diff(np.concatenate([bucket_starts, [len(band)]]))
+        size = np.repeat(bucket_sizes, bucket_sizes)
+        position = np.arange(len(band)) - np.repeat(bucket_starts, bucket_sizes)
+
+        # The hashes of an oversized bucket agree on this band, a close pair
+        # of them agrees on one of max_distance + 1 bands of the other bits
+        other_bits = [bit for bit in bits if bit not in set(band_bits.tolist())]
+        for start in bucket_starts[bucket_sizes > max_bucket].tolist():
+            members = order[start : start + size[start]]
+            if split and len(other_bits) > max_distance:
+                if stats is not None:
+                    stats["split_buckets"] = stats.get("split_buckets", 0) + 1
+                    stats["split_hashes"] = stats.get("split_hashes", 0) + len(members)
+                first, second = _index_pairs(
+                    hashes[members], max_distance, max_bucket, stats, other_bits, False
+                )
+            else:
+                if stats is not None:
+                    stats["chunked_buckets"] = stats.get("chunked_buckets", 0) + 1
+                    stats["chunked_hashes"] = stats.get("chunked_hashes", 0) + len(members)
+                first, second = _all_pairs(hashes[members], max_distance, max_bucket)
+            found_first.append(np.minimum(members[first], members[second]))
+            found_second.append(np.maximum(members[first], members[second]))
+
+        # Compare every hash with the hash `offset` places further in its
+        # bucket, the number of iterations is the size of the largest bucket
+        active = np.flatnonzero((size > 1) & (size <= max_bucket))
+        offset = 1
+        while len(active) > 0:
+            active = active[position[active] + offset < size[active]]
+            first, second = order[active], order[active + offset]
+            close = hamming_distance(hashes[first], hashes[second]) <= max_distance
+            found_first.append(np.minimum(first[close], second[close]))
+            found_second.append(np.maximum(first[close], second[close]))
+            offset += 1
+
+    if not found_first:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # Pairs that share more than one band are found more than once
+    pairs = np.unique(
+        np.stack([np.concatenate(found_first), np.concatenate(found_second)], axis=1),
+        axis=0,
+    )
+    return pairs[:, 0], pairs[:, 1]
+
+
+def connected_components(count: int, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Labels every node with the smallest node of its component."""
+    labels = np.arange(count)
+    while True:
+        linked = np.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        np.minimum.at(updated, first, linked)
+        np.minimum.at(updated, second, linked)
+        # Pointer jumping, so long chains take few iterations
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+@dataclass
+class DuplicateCluster:
+    records: List[int]
+    pet_ids: List[int]
+    paths: List[str]
+    max_distance: int
+    keep: int = field(init=False)
+
+    def __post_init__(self):
+        self.keep = self.records[0]
+
+    def to_dict(self) -> Dict:
+        return dict(
+            keep=self.keep,
+            records=self.records,
+            pet_ids=self.pet_ids,
+            paths=self.paths,
+            max_distance=self.max_distance,
+        )
+
+
+def find_near_duplicates(
+    folder: PetImagesFolder,
+    max_distance: int = 3,
+    workers: int = 4,
+    max_bucket: int = 1024,
+    stats: Optional[Dict[str, int]] = None,
+) -> List[DuplicateCluster]:
+    """
+    Groups the records of a folder whose images are near duplicates: the
+    same photo re-uploaded, resized or scraped under another pet id.
+
+    The first path of a record is hashed, the other paths are augmentations
+    of the same image. Records with identical hashes are grouped directly,
+    the distinct hashes are compared with a multi-index, so memory and time
+    grow with the number of images and near duplicates, not with the number
+    of pairs.
+
+    Args:
+        folder: The dataset to search.
+        max_distance: Maximum number of differing bits of the 64 bit hashes.
+        workers: Number of processes that hash the images.
+        max_bucket: Buckets of the multi-index larger than this are indexed
+                    again on the other bits of the hashes.
+        stats: Filled with the number of images, unreadable images, and
+               oversized buckets that were split or compared in chunks.
+    """
+    df = folder.data_frame()
+    paths = [str(p[0]) for p in df["paths"]]
+    pet_ids = df["pet_id"].to_numpy()
+
+    hashes, valid = compute_hashes(paths, workers)
+    if not valid.all():
+        logging.warning(f"Could not read {np.count_nonzero(~valid)} images")
+    records = np.flatnonzero(valid)
+    hashes = hashes[records]
+
+    # Exact copies share one entry in the index
+    unique_hashes, inverse = np.unique(hashes, return_inverse=True)
+    if stats is not None:
+        stats.update(
+            images=len(paths),
+            unreadable=int(np.count_nonzero(~valid)),
+            split_buckets=0,
+            split_hashes=0,
+            chunked_buckets=0,
+            chunked_hashes=0,
+        )
+    first, second = candidate_pairs(unique_hashes, max_distance, max_bucket, stats)
+    labels = connected_components(len(unique_hashes), first, second)[inverse]
+
+    order = np.argsort(labels, kind="stable")
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    clusters = []
+    for group in np.split(order, boundaries):
+        if len(group) < 2:
+            continue
+        group_hashes = hashes[group]
+        # Distance to the kept record, all pairs would be quadratic
+        distance = hamming_distance(group_hashes, group_hashes[:1])
+        members = records[group].tolist()
+        clusters.append(
+            DuplicateCluster(
+                records=members,
+                pet_ids=pet_ids[members].tolist(),
+                paths=[paths[i] for i in members],
+                max_distance=int(distance.max()),
+            )
+        )
+    logging.info(
+        f"Found {len(clusters)} groups of near duplicates with "
+        f"{sum(len(c.records) - 1 for c in clusters)} redundant records"
+    )
+    return clusters
+
+
+def resolve_near_duplicates(
+    folder: PetImagesFolder, clusters: List[DuplicateCluster], action: str
+) -> Tuple[np.ndarray, Dict[int, int]]:
+    """
+    Decides which records to drop and which pets to relabel.
+
+    With "remove" every group keeps its first record. With "merge" the pets
+    that share a duplicate are also assumed to be the same pet, and all their
+    records get the smallest of their pet ids.
+
+    Returns the mask of records to keep and the map of relabeled pet ids.
+    """
+    if action not in ["remove", "merge"]:
+        raise ValueError(f"unknown action: {action}")
+
+    keep = np.ones(len(folder), dtype=bool)
+    for cluster in clusters:
+        keep[cluster.records[1:]] = False
+
+    relabel: Dict[int, int] = dict()
+    if action == "merge":
+        # Pets can be linked through several groups, so merge them as a graph
+        pet_ids = np.unique([p for c in clusters for p in c.pet_ids])
+        index = {pet_id: i for i, pet_id in enumerate(pet_ids.tolist())}
+        first = [index[c.pet_ids[0]] for c in clusters for _ in c.pet_ids[1:]]
+        second = [index[p] for c in clusters for p in c.pet_ids[1:]]
+        labels = connected_components(
+            len(pet_ids), np.array(first, dtype=np.int64), np.array(second, dtype=np.int64)
+        )
+        relabel = {
+            int(pet_id): int(pet_ids[label])
+            for pet_id, label in zip(pet_ids.tolist(), labels)
+            if pet_id != pet_ids[label]
+        }
+    return keep, relabel
@@ -0,0 +1,103 @@
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+# Pets with at least this many records share the last stratum and bin
+MAX_SIZE = 5
+
+
+def pet_sizes(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the unique pet ids, the index of every row into them, and the
+    number of records of every pet.
+    """
+    pet_ids, inverse, counts = np.unique(
+        df["pet_id"].to_numpy(), return_inverse=True, return_counts=True
+    )
+    return pet_ids, inverse.reshape(-1), counts
+
+
+def size_histogram(counts: np.ndarray, max_size: int = MAX_SIZE) -> np.ndarray:
+    """Number of pets with 1, 2, ..., max_size or more records."""
+    return np.bincount(np.minimum(counts, max_size), minlength=max_size + 1)[1:]
+
+
+def _stratified_ranks(
+    counts: np.ndarray, rng: np.random.Generator, max_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Random rank of every pet among the pets with the same number of
+    # records, and the stratum of every pet
+    strata = np.minimum(counts, max_size)
+    order = np.lexsort((rng.random(len(counts)), strata))
+    starts = np.searchsorted(strata[order], strata[order], side="left")
+    ranks = np.empty(len(counts), dtype=np.int64)
+    ranks[order] = np.arange(len(counts)) - starts
+    return ranks, strata
+
+
+def split_pets(
+    df: pd.DataFrame,
+    test_fraction: float,
+    seed: Optional[int] = None,
+    max_size: int = MAX_SIZE,
+) -> np.ndarray:
+    """
+    Splits the pets into a train and a test set, stratified by their number of
+    records so both sets have the same distribution of images per pet. All
+    records of a pet end up in the same set.
+
+    Returns a boolean mask of the rows that belong to the test set.
+    """
+    _, inverse, counts = pet_sizes(df)
+    ranks, strata = _stratified_ranks(counts, np.random.default_rng(seed), max_size)
+    stratum_sizes = np.bincount(strata, minlength=max_size + 1)
+    quota = np.round(stratum_sizes * test_fraction).astype(np.int64)
+    is_test_pet = ranks < quota[strata]
+    return is_test_pet[inverse]
+
+
+def assign_folds(
+    df: pd.DataFrame,
+    fold_count: int,
+    seed: Optional[int] = None,
+    max_size: int = MAX_SIZE,
+) -> pd.DataFrame:
+    """
+    Assigns every pet to one of `fold_count` folds, stratified by the number
+    of records per pet.
+
+    Returns a data frame with the pet_id and fold columns.
+    """
+    pet_ids, _, counts = pet_sizes(df)
+    rng = np.random.default_rng(seed)
+    ranks, strata = _stratified_ranks(counts, rng, max_size)
+    # Start every stratum at another fold, so the remainders are spread
+    offsets = rng.integers(0, fold_count, max_size + 1)
+    folds = (ranks + offsets[strata]) % fold_count
+    return pd.DataFrame(dict(pet_id=pet_ids, fold=folds))
+
+
+def save_folds(folds: pd.DataFrame, path: Path):
+    folds.to_json(path, orient="records", lines=True)
+
+
+def load_folds(path: Path) -> Dict[int, int]:
+    """Reads a fold assignment file into a map of pet ids to folds."""
+    folds = pd.read_json(path, lines=True)
+    return dict(zip(folds["pet_id"].astype(int).tolist(), folds["fold"].astype(int).tolist()))
+
+
+def dataset_stats(df: pd.DataFrame, max_size: int = MAX_SIZE) -> Dict[str, Any]:
+    """Summary statistics of an info file, computed with numpy only."""
+    _, _, counts = pet_sizes(df)
+    images_per_record = df["paths"].map(len).to_numpy()
+    return {
+        "pets": int(len(counts)),
+        "records": int(len(df)),
+        "images": int(images_per_record.sum()),
+        "average records per pet": float(counts.mean()) if len(counts) else 0.0,
+        "average images per record": float(images_per_record.mean()) if len(df) else 0.0,
+        "records per pet": size_histogram(counts, max_size).tolist(),
+        "trainable pets": int(np.count_nonzero(counts > 1)),
+    }
@@ -1,4 +1,18 @@
-from .model import PetViTContrastiveModel
-from .loss import PetContrastiveLoss
+from typing import TYPE_CHECKING
 
-__all__ = ["PetViTContrastiveModel", "PetContrastiveLoss"]
+from .._lazy import lazy_exports
+
+# Imported on first access, both import torch and the model imports transformers
+_lazy_exports = {
+    "PetViTContrastiveModel": "lostpaw.model.model",
+    "PetContrastiveLoss": "lostpaw.model.loss",
+    "load_inference_model": "lostpaw.model.inference",
+}
+lazy_exports(globals(), _lazy_exports)
+
+if TYPE_CHECKING:
+    from .inference import load_inference_model
+    from .loss import PetContrastiveLoss
+    from .model import PetViTContrastiveModel
+
+__all__ = ["PetViTContrastiveModel", "PetContrastiveLoss", "load_inference_model"]
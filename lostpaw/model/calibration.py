@@ -0,0 +1,100 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import numpy as np
+import torch
+
+from lostpaw.model.evaluation import Embeddings
+
+
+@dataclass
+class DistanceHistogram:
+    # Bin edges, of length bins + 1
+    edges: np.ndarray
+    # Number of pairs of the same pet in each bin
+    positive: np.ndarray
+    # Number of pairs of different pets in each bin
+    negative: np.ndarray
+
+    def rates(self):
+        """
+        Returns the true and false positive rates when the right edge of each
+        bin is used as the threshold.
+        """
+        tpr = np.cumsum(self.positive) / max(self.positive.sum(), 1)
+        fpr = np.cumsum(self.negative) / max(self.negative.sum(), 1)
+        return tpr, fpr
+
+
+def distance_histogram(
+    embeddings: Embeddings,
+    bins: int = 4096,
+    max_distance: Optional[float] = None,
+    chunk_size: int = 1024,
+) -> DistanceHistogram:
+    """
+    Computes the distance distribution of all pairs of embeddings, split in
+    pairs of the same and of different pets. The distances are binned chunk
+    by chunk, so the memory use does not grow with the number of pairs.
+    """
+    features = torch.tensor(embeddings.embeddings, dtype=torch.float32)
+    pet_ids = torch.tensor(embeddings.pet_ids, dtype=torch.int64)
+    count = len(pet_ids)
+    columns = torch.arange(count)
+
+    if max_distance is None:
+        # No pair can be further apart than twice the largest norm
+        max_distance = 2 * float(features.norm(dim=1).max()) if count > 0 else 1.0
+    max_distance = max(max_distance, 1e-6)
+
+    positive = torch.zeros(bins, dtype=torch.int64)
+    negative = torch.zeros(bins, dtype=torch.int64)
+    for start in range(0, count, chunk_size):
+        end = min(start + chunk_size, count)
+        distances = torch.cdist(features[start:end], features)
+        same = pet_ids[start:end, None] == pet_ids[None, :]
+        upper = torch.arange(start, end)[:, None] < columns[None, :]
+
+        index = (distances / max_distance * bins).long().clamp_(0, bins - 1)
+        positive += torch.bincount(index[same & upper], minlength=bins)
+        negative += torch.bincount(index[~same & upper], minlength=bins)
+
+    edges = np.linspace(0, max_distance, bins + 1)
+    return DistanceHistogram(edges, positive.numpy(), negative.numpy())
+
+
+def thresholds_for_fpr(
+    histogram: DistanceHistogram, target_fprs: List[float]
+) -> Dict[float, Dict[str, float]]:
+    """
+    Picks the largest threshold whose false positive rate stays at or below
+    each target rate, and reports the rates at that threshold.
+    """
+    tpr, fpr = histogram.rates()
+    result = dict()
+    for target in target_fprs:
+        # fpr is non-decreasing, so this is the last bin within the target
+        idx = int(np.searchsorted(fpr, target, side="right")) - 1
+        if idx < 0:
+            result[target] = dict(threshold=0.0, tpr=0.0, fpr=0.0)
+        else:
+            result[target] = dict(
+                threshold=float(histogram.edges[idx + 1]),
+                tpr=float(tpr[idx]),
+                fpr=float(fpr[idx]),
+            )
+    return result
+
+
+def best_accuracy_threshold(
+    histogram: DistanceHistogram, same_probability: float = 0.5
+) -> Dict[str, float]:
+    """Picks the threshold with the highest weighted accuracy."""
+    tpr, fpr = histogram.rates()
+    accuracy = same_probability * tpr + (1 - same_probability) * (1 - fpr)
+    idx = int(np.argmax(accuracy))
+    return dict(
+        threshold=float(histogram.edges[idx + 1]),
+        accuracy=float(accuracy[idx]),
+        tpr=float(tpr[idx]),
+        fpr=float(fpr[idx]),
+    )
@@ -0,0 +1,195 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import logging
+import os
+import re
+import torch
+from torch import Tensor
+
+
+def snapshot_state(state: Any) -> Any:
+    """
+    Recursively copies every tensor of a (nested) state dict to the CPU, so
+    the copy can be serialized while training keeps updating the originals.
+    """
+    if isinstance(state, Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot_state(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(v) for v in state)
+    return state
+
+
+# Model files with this suffix are stored as safetensors, others are pickled
+SAFETENSORS_SUFFIX = ".safetensors"
+
+
+def is_safetensors(path: Path) -> bool:
+    return Path(path).suffix == SAFETENSORS_SUFFIX
+
+
+def find_state_file(path: Path) -> Path:
+    """
+    Returns `path`, or the .pt file with the same name when only that exists,
+    so model files saved before the switch to safetensors are still found.
+    """
+    path = Path(path)
+    legacy_path = path.with_suffix(".pt")
+    if not path.exists() and is_safetensors(path) and legacy_path.exists():
+        return legacy_path
+    return path
+
+
+def save_state_file(state: Dict[str, Tensor], path: Path):
+    """Saves a state dict of tensors, as safetensors if the path ends with .safetensors."""
+    if is_safetensors(path):
+        from safetensors.torch import save_file
+
+        # safetensors only stores contiguous tensors that do not share memory
+        save_file({k: v.contiguous() for k, v in state.items()}, str(path))
+    else:
+        torch.save(state, path)
+
+
+def load_state_file(path: Path) -> Dict[str, Tensor]:
+    """
+    Loads a state dict of tensors without reading the file. The tensors are
+    memory mapped, their pages are read from disk when they are first used.
+    Only tensors are loaded, pickled .pt files can not run code.
+    """
+    path = Path(path)
+    if is_safetensors(path):
+        from safetensors.torch import load_file
+
+        return load_file(str(path), device="cpu")
+
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError:
+        # Files in the legacy (non zip) format of torch.save can not be mapped
+        return torch.load(path, map_location="cpu", weights_only=True)
+
+
+def atomic_save(state: Any, path: Path):
+    """
+    Writes the state to a temporary file next to `path` and renames it into
+    place, so a crash during saving never leaves a truncated checkpoint.
+    """
+    path = Path(path)
+    # The temporary file keeps the suffix, which decides the format
+    tmp_path = path.with_name(".tmp_" + path.name)
+    if is_safetensors(path):
+        save_state_file(state, tmp_path)
+        with open(tmp_path, "rb+") as f:
+            os.fsync(f.fileno())
+    else:
+        with open(tmp_path, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager:
+    def __init__(
+        self,
+        folder: Path,
+        prefix: str,
+        keep_last: int = 3,
+        use_async: bool = True,
+    ):
+        """
+        Saves training checkpoints named `<prefix>_epoch<N>.pt` in `folder`,
+        keeping only the last `keep_last` of them.
+
+        Args:
+            folder: Directory the checkpoints are written to.
+            prefix: Name shared by all checkpoints of one run.
+            keep_last: Number of checkpoints to keep, older ones are removed.
+                       Values smaller than 1 keep all checkpoints.
+            use_async: Serialize the checkpoints on a background thread.
+        """
+        self.folder = Path(folder)
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.folder.mkdir(exist_ok=True, parents=True)
+        self.pattern = re.compile(re.escape(prefix) + r"_epoch(\d+)\.pt")
+
+        self.executor = (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+            if use_async
+            else None
+        )
+        self.pending: List[Future] = []
+
+    def checkpoints(self) -> List[Path]:
+        """Returns the checkpoints of this run, ordered from old to new."""
+        found = []
+        for path in self.folder.iterdir():
+            match = self.pattern.fullmatch(path.name)
+            if match:
+                found.append((int(match.group(1)), path))
+        return [path for _, path in sorted(found)]
+
+    def latest(self) -> Optional[Path]:
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def load_latest(self, map_location="cpu") -> Optional[Dict[str, Any]]:
+        path = self.latest()
+        if path is None:
+            return None
+        logging.info(f"Loading checkpoint {path}")
+        return torch.load(path, map_location=map_location)
+
+    def save(self, state: Dict[str, Any], epoch: int):
+        """Saves a checkpoint for the given epoch and rotates old ones."""
+        path = self.folder / f"{self.prefix}_epoch{epoch:04d}.pt"
+        self._submit(state, path, rotate=True)
+
+    def save_file(self, state: Any, path: Path):
+        """Saves any state to the given path, outside of the rotation."""
+        self._submit(state, Path(path), rotate=False)
+
+    def wait(self):
+        """Blocks until all pending saves are written to disk."""
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+    def _submit(self, state: Any, path: Path, rotate: bool):
+        # Copy the state before returning, the caller will keep training and
+        # modify the tensors while the background thread is writing.
+        state = snapshot_state(state)
+
+        if self.executor is None:
+            self._write(state, path, rotate)
+            return
+
+        self.pending = [f for f in self.pending if not self._finished(f)]
+        self.pending.append(self.executor.submit(self._write, state, path, rotate))
+
+    def _finished(self, future: Future) -> bool:
+        if not future.done():
+            return False
+        # Surface errors of earlier saves instead of silently dropping them
+        future.result()
+        return True
+
+    def _write(self, state: Any, path: Path, rotate: bool):
+        atomic_save(state, path)
+        logging.info(f"Saved {path}")
+
+        if rotate and self.keep_last > 0:
+            for old_path in self.checkpoints()[: -self.keep_last]:
+                if old_path.exists():
+                    old_path.unlink()
@@ -0,0 +1,109 @@
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Sequence
+import logging
+import torch
+from torch import Tensor
+
+if TYPE_CHECKING:
+    from lostpaw.model.model import PetViTContrastiveModel
+
+DEFAULT_BATCH_SIZES = (1, 2, 4, 8, 16, 32)
+
+
+def _raise_recompile_limit(count: int):
+    # Every batch size and grad mode is its own graph of the same function,
+    # the default limit of 8 would send the later ones back to eager
+    import torch._dynamo.config as dynamo_config
+
+    for name in ("recompile_limit", "cache_size_limit"):
+        if hasattr(dynamo_config, name):
+            setattr(dynamo_config, name, max(getattr(dynamo_config, name), count))
+
+
+class CompiledEmbedder:
+    def __init__(
+        self,
+        model: "PetViTContrastiveModel",
+        batch_sizes: Sequence[int] = DEFAULT_BATCH_SIZES,
+        mode: Optional[str] = None,
+    ):
+        """
+        Runs the ViT and the head of a model compiled with torch.compile.
+
+        Batches are zero padded to the next of a few fixed `batch_sizes`, so
+        only one graph per size is compiled instead of one per batch size
+        seen. Larger batches are split into chunks of the largest size. When
+        compiling or running the compiled model fails, the model falls back to
+        eager mode for good.
+
+        Args:
+            model: The model, embed_eager is compiled.
+            batch_sizes: Sizes the batches are padded to.
+            mode: Mode of torch.compile, for example "max-autotune".
+        """
+        self.model = model
+        self.batch_sizes = sorted(set(batch_sizes))
+        self.failed = False
+        self.function: Optional[Callable[[Dict[str, Tensor]], Tensor]] = None
+        try:
+            _raise_recompile_limit(2 * len(self.batch_sizes) + 2)
+            self.function = torch.compile(model.embed_eager, mode=mode, dynamic=False)
+        except Exception as e:
+            # For example a Python version torch.compile does not support yet
+            logging.warning(f"torch.compile is not available, using eager mode: {e}")
+            self.failed = True
+
+    def bucket(self, count: int) -> int:
+        """Returns the batch size a batch of `count` images is padded to."""
+        for size in self.batch_sizes:
+            if size >= count:
+                return size
+        return self.batch_sizes[-1]
+
+    def __call__(self, inputs: Dict[str, Tensor]) -> Tensor:
+        # The token reducer keeps a data dependent number of tokens, every
+        # batch would be a new graph
+        if self.failed or self.model.token_reducer is not None:
+            return self.model.embed_eager(inputs)
+
+        try:
+            return self._run(inputs["pixel_values"])
+        except Exception as e:
+            logging.warning(f"Compiled model failed, falling back to eager mode: {e}")
+            self.failed = True
+            return self.model.embed_eager(inputs)
+
+    def _run(self, pixel_values: Tensor) -> Tensor:
+        outputs = []
+        largest = self.batch_sizes[-1]
+        for start in range(0, len(pixel_values), largest):
+            chunk = pixel_values[start : start + largest]
+            padding = self.bucket(len(chunk)) - len(chunk)
+            if padding > 0:
+                chunk = torch.cat([chunk, chunk.new_zeros((padding, *chunk.shape[1:]))])
+            outputs.append(self.function(dict(pixel_values=chunk))[: len(chunk) - padding])
+        return torch.cat(outputs) if len(outputs) > 1 else outputs[0]
+
+    def warmup(self, grad: bool = False) -> bool:
+        """
+        Compiles the graphs of all batch sizes, so no request or training
+        step waits for a compilation. Returns False if the model fell back
+        to eager mode.
+
+        Args:
+            grad: Also compile the graphs with gradients, for training. The
+                  graphs without them are always compiled, testing and
+                  evaluation run under no_grad.
+        """
+        config = self.model.vit_model.config
+        device = next(self.model.parameters()).device
+        for size in self.batch_sizes:
+            pixel_values = torch.zeros(
+                size, config.num_channels, config.image_size, config.image_size, device=device
+            )
+            for enabled in (False, True) if grad else (False,):
+                with torch.set_grad_enabled(enabled):
+                    self(dict(pixel_values=pixel_values))
+                if self.failed:
+                    return False
+        logging.info(f"Compiled the model for batch sizes {self.batch_sizes}")
+        return True
@@ -0,0 +1,104 @@
+from typing import Any, Dict, Optional, Tuple
+import logging
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from lostpaw.model.model import LowRankLinear, PetViTContrastiveModel
+
+
+def left_singular_vectors(weight: Tensor, chunk_size: int = 65536) -> Tuple[Tensor, Tensor]:
+    """
+    Returns the singular values and left singular vectors of an (out, in)
+    weight, largest first.
+
+    They are computed from the (out, out) Gram matrix of the rows, which is
+    accumulated in float64 over chunks of columns. The first layer of the
+    head has far more inputs than outputs, an SVD of the full weight would
+    need several copies of it in memory.
+    """
+    out_features, in_features = weight.shape
+    gram = torch.zeros(out_features, out_features, dtype=torch.float64)
+    for start in range(0, in_features, chunk_size):
+        chunk = weight[:, start : start + chunk_size].to(torch.float64)
+        gram += chunk @ chunk.T
+
+    eigenvalues, eigenvectors = torch.linalg.eigh(gram)
+    # eigh sorts ascending
+    singular_values = eigenvalues.flip(0).clamp(min=0).sqrt()
+    return singular_values, eigenvectors.flip(1)
+
+
+def select_rank(
+    singular_values: Tensor, rank: Optional[int] = None, energy: Optional[float] = None
+) -> int:
+    """
+    Returns the given rank, or the smallest rank that keeps at least the
+    `energy` fraction of the squared singular values.
+    """
+    if rank is not None:
+        return max(1, min(rank, len(singular_values)))
+    if energy is None:
+        raise ValueError("either a rank or an energy fraction is needed")
+
+    cumulative = (singular_values**2).cumsum(0)
+    kept = cumulative / cumulative[-1]
+    return int(torch.searchsorted(kept, torch.tensor(energy, dtype=kept.dtype))) + 1
+
+
+def factorize_linear(linear: nn.Linear, basis: Tensor) -> LowRankLinear:
+    """
+    Projects the weight W of a linear layer on the columns of `basis` (the
+    top left singular vectors), W ~= basis @ (basis.T @ W).
+    """
+    rank = basis.shape[1]
+    weight = linear.weight.detach()
+    basis = basis.to(weight.dtype)
+    factorized = LowRankLinear(
+        linear.in_features, linear.out_features, rank, bias=linear.bias is not None
+    )
+    with torch.no_grad():
+        factorized.down.weight.copy_(basis.T @ weight)
+        factorized.up.weight.copy_(basis)
+        if linear.bias is not None:
+            factorized.up.bias.copy_(linear.bias)
+    return factorized
+
+
+def count_parameters(module: nn.Module) -> int:
+    return sum(p.numel() for p in module.parameters())
+
+
+def factorize_head(
+    model: PetViTContrastiveModel,
+    rank: Optional[int] = None,
+    energy: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Replaces the first layer of the latent space head by a truncated SVD of
+    a fixed `rank`, or of the smallest rank that keeps the `energy` fraction
+    of the squared singular values.
+
+    Returns the chosen rank, the kept energy and the parameter counts.
+    """
+    linear = model.latent_space[0]
+    if not isinstance(linear, nn.Linear):
+        raise ValueError("the head of the model is already factorized")
+
+    singular_values, vectors = left_singular_vectors(linear.weight.detach())
+    rank = select_rank(singular_values, rank, energy)
+    squared = singular_values**2
+
+    params_before = count_parameters(model.latent_space)
+    model.latent_space[0] = factorize_linear(linear, vectors[:, :rank])
+    model.head_rank = rank
+    info = dict(
+        rank=rank,
+        energy=float(squared[:rank].sum() / squared.sum()),
+        head_parameters_before=params_before,
+        head_parameters_after=count_parameters(model.latent_space),
+    )
+    logging.info(
+        f"Factorized the head to rank {rank}, keeping {info['energy']:.2%} of the energy"
+    )
+    return info
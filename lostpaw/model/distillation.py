@@ -0,0 +1,85 @@
+from typing import List, Optional, Tuple
+import logging
+import torch
+import torch.nn.functional as F
+from PIL.Image import Image
+
+from lostpaw.config import TrainConfig
+from lostpaw.data import RandomPairDataset
+from lostpaw.model.inference import load_inference_model
+from lostpaw.model.trainer import Trainer, device
+
+
+class DistillationTrainer(Trainer):
+    def __init__(
+        self,
+        config: TrainConfig,
+        data: Optional[RandomPairDataset] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        """
+        Trains a student model, usually with a smaller or lower resolution
+        ViT, to reproduce the embeddings of a trained teacher model. The loss
+        is the contrastive loss plus the mean squared errors between the
+        embeddings and between the pair distances of the student and the
+        teacher, weighted by config.distill_embedding_weight and
+        config.distill_distance_weight.
+
+        The student is saved like any other model, with a manifest, and is
+        loaded with lostpaw.model.inference.load_inference_model.
+        """
+        if config.teacher_path is None:
+            raise ValueError("distillation needs a teacher_path")
+
+        self.teacher, teacher_manifest = load_inference_model(
+            config.teacher_path, device, threshold=config.contrastive_margin
+        )
+        if (
+            config.distill_embedding_weight > 0
+            and teacher_manifest.latent_space_size != config.latent_space_size
+        ):
+            raise ValueError(
+                f"The teacher has a latent space size of {teacher_manifest.latent_space_size}, "
+                f"the student {config.latent_space_size}. Embeddings of different sizes "
+                "can not be compared, set distill_embedding_weight to 0."
+            )
+
+        super().__init__(config, data, seed)
+        logging.info(f"Distilling {config.teacher_path}")
+
+    def cache_image_size(self) -> int:
+        # The teacher embeds the cached images too, at the student size its
+        # targets would come from upscaled images
+        return max(super().cache_image_size(), self.teacher.vit_model.config.image_size)
+
+    def teacher_pairs(self, imgs1: List[Image], imgs2: List[Image]) -> torch.Tensor:
+        # no_grad instead of inference_mode, the outputs are targets of a loss
+        # that is backpropagated
+        with torch.no_grad():
+            features1 = self.teacher(imgs1)
+            features2 = self.teacher(imgs2)
+        return torch.stack([features1, features2], dim=1).to(device)
+
+    def pair_loss(
+        self, imgs1: List[Image], imgs2: List[Image], given_labels: List[int]
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        features = self.embed_pairs(imgs1, imgs2)
+
+        with self.profiler.stage("teacher"):
+            teacher_features = self.teacher_pairs(imgs1, imgs2)
+
+        with self.profiler.stage("forward"):
+            labels = torch.tensor(given_labels, dtype=torch.float32).to(device)
+            distance = self.contrastive_loss.euclidean_distance(features)
+            loss: torch.Tensor = self.contrastive_loss(features, labels, distance)
+
+            if self.config.distill_embedding_weight > 0:
+                loss = loss + self.config.distill_embedding_weight * F.mse_loss(
+                    features, teacher_features
+                )
+            if self.config.distill_distance_weight > 0:
+                teacher_distance = self.contrastive_loss.euclidean_distance(teacher_features)
+                loss = loss + self.config.distill_distance_weight * F.mse_loss(
+                    distance, teacher_distance
+                )
+        return loss, distance, labels
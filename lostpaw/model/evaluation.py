@@ -0,0 +1,229 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import logging
+import numpy as np
+import torch
+from PIL import Image
+
+from lostpaw.data.data_folder import PetImagesFolder
+from lostpaw.model.model import PetViTContrastiveModel
+
+
+@dataclass
+class Embeddings:
+    paths: List[str]
+    pet_ids: np.ndarray
+    embeddings: np.ndarray
+
+    def save(self, path: Path):
+        np.savez(
+            path,
+            paths=np.array(self.paths),
+            pet_ids=self.pet_ids,
+            embeddings=self.embeddings,
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "Embeddings":
+        with np.load(path) as data:
+            return cls(
+                data["paths"].tolist(), data["pet_ids"], data["embeddings"]
+            )
+
+
+@dataclass
+class PairDistances:
+    # Distances of all pairs of images of the same pet
+    positive: np.ndarray
+    # Distances of all, or a sample of, the pairs of images of different pets
+    negative: np.ndarray
+
+
+def held_out_images(folder: PetImagesFolder, min_images_per_pet: int = 2):
+    """
+    Returns the first image path of every record and its pet id. The other
+    paths of a record are augmentations of the same image and are skipped.
+    Like RandomPairDataset, pets with fewer than `min_images_per_pet` records
+    are left out.
+    """
+    df = folder.data_frame()
+    sizes = df.groupby("pet_id")["pet_id"].transform("size")
+    df = df[sizes >= min_images_per_pet]
+    paths = df["paths"].str[0].astype(str).tolist()
+    return paths, df["pet_id"].to_numpy(dtype=np.int64)
+
+
+def embed_images(
+    model: PetViTContrastiveModel, paths: List[str], batch_size: int = 32
+) -> np.ndarray:
+    """Embeds every image exactly once, in batches."""
+    was_training = model.training
+    model.train(False)
+
+    embeddings = []
+    with torch.no_grad():
+        for start in range(0, len(paths), batch_size):
+            images = [
+                Image.open(path).convert("RGB")
+                for path in paths[start : start + batch_size]
+            ]
+            embeddings.append(model(images).cpu().numpy().astype(np.float32))
+
+    model.train(was_training)
+    if not embeddings:
+        return np.zeros([0, 0], dtype=np.float32)
+    return np.concatenate(embeddings)
+
+
+def pair_distances(
+    embeddings: Embeddings,
+    negatives_per_image: Optional[int] = None,
+    chunk_size: int = 1024,
+    seed: int = 0,
+) -> PairDistances:
+    """
+    Computes the euclidean distance of every pair of images of the same pet,
+    and of every pair of different pets. With `negatives_per_image` only that
+    many pairs of different pets are sampled for every image instead, so each
+    image contributes equally and memory stays linear in the image count.
+    """
+    features = torch.tensor(embeddings.embeddings, dtype=torch.float32)
+    pet_ids = torch.tensor(embeddings.pet_ids, dtype=torch.int64)
+    count = len(pet_ids)
+    columns = torch.arange(count)
+    generator = torch.Generator().manual_seed(seed)
+
+    positive, negative = [], []
+    for start in range(0, count, chunk_size):
+        end = min(start + chunk_size, count)
+        distances = torch.cdist(features[start:end], features)
+        same = pet_ids[start:end, None] == pet_ids[None, :]
+        # Only count every unordered pair once and skip the diagonal
+        upper = torch.arange(start, end)[:, None] < columns[None, :]
+
+        positive.append(distances[same & upper])
+        if negatives_per_image is None:
+            negative.append(distances[~same & upper])
+        elif (~same).any():
+            weights = (~same).to(torch.float32)
+            has_negatives = weights.sum(1) > 0
+            sampled = torch.multinomial(
+                weights[has_negatives],
+                negatives_per_image,
+                replacement=True,
+                generator=generator,
+            )
+            negative.append(distances[has_negatives].gather(1, sampled).flatten())
+
+    return PairDistances(
+        torch.cat(positive).numpy() if positive else np.zeros([0], np.float32),
+        torch.cat(negative).numpy() if negative else np.zeros([0], np.float32),
+    )
+
+
+def pair_metrics(
+    distances: PairDistances, threshold: float, same_probability: float = 0.5
+) -> Dict[str, float]:
+    """
+    Computes the metrics of the Trainer for a decision threshold. The rates
+    are weighted by `same_probability`, so they are comparable with the
+    metrics of randomly drawn pairs of the RandomPairDataset.
+    """
+    tpr = float(np.mean(distances.positive <= threshold)) if len(distances.positive) else 0.0
+    fpr = float(np.mean(distances.negative <= threshold)) if len(distances.negative) else 0.0
+
+    same = same_probability * tpr
+    err2 = same_probability * (1 - tpr)
+    err1 = (1 - same_probability) * fpr
+    diff = (1 - same_probability) * (1 - fpr)
+    f1_denominator = 2 * same + err1 + err2
+
+    return dict(
+        accuracy=same + diff,
+        diff=diff,
+        same=same,
+        err1=err1,
+        err2=err2,
+        f1=2 * same / f1_denominator if f1_denominator > 0 else 0.0,
+        tpr=tpr,
+        fpr=fpr,
+    )
+
+
+def threshold_sweep(
+    distances: PairDistances,
+    thresholds: Optional[np.ndarray] = None,
+    same_probability: float = 0.5,
+    count: int = 1024,
+) -> Dict[str, Any]:
+    """
+    Computes the ROC curve and the accuracy for many thresholds at once.
+    Without thresholds, `count` evenly spaced thresholds between zero and the
+    largest distance are used.
+    """
+    positive = np.sort(distances.positive)
+    negative = np.sort(distances.negative)
+    if thresholds is None:
+        largest = max(positive[-1:].max(initial=0), negative[-1:].max(initial=0))
+        thresholds = np.linspace(0, largest, count)
+
+    tpr = np.searchsorted(positive, thresholds, side="right") / max(len(positive), 1)
+    fpr = np.searchsorted(negative, thresholds, side="right") / max(len(negative), 1)
+    accuracy = same_probability * tpr + (1 - same_probability) * (1 - fpr)
+
+    # Area under the ROC curve, starting the curve at (0, 0)
+    roc_x = np.concatenate([[0], fpr])
+    roc_y = np.concatenate([[0], tpr])
+    auc = float(np.sum(np.diff(roc_x) * (roc_y[1:] + roc_y[:-1]) / 2))
+
+    return dict(thresholds=thresholds, tpr=tpr, fpr=fpr, accuracy=accuracy, auc=auc)
+
+
+class Evaluator:
+    def __init__(
+        self,
+        folder: PetImagesFolder,
+        batch_size: int = 32,
+        negatives_per_image: Optional[int] = None,
+        same_probability: float = 0.5,
+        min_images_per_pet: int = 2,
+        seed: int = 0,
+    ):
+        """
+        Evaluates a model on every held-out image, instead of on randomly
+        drawn pairs. Each image is embedded once and the metrics are computed
+        over all pairs of the embeddings.
+
+        Args:
+            folder: The held-out data.
+            batch_size: Number of images embedded at once.
+            negatives_per_image: Sample this many different-pet pairs per
+                       image instead of using all of them.
+            same_probability: Weight of the same-pet pairs in the metrics.
+            min_images_per_pet: Pets with fewer images are skipped.
+            seed: Seed for sampling the different-pet pairs.
+        """
+        self.paths, self.pet_ids = held_out_images(folder, min_images_per_pet)
+        self.batch_size = batch_size
+        self.negatives_per_image = negatives_per_image
+        self.same_probability = same_probability
+        self.seed = seed
+        logging.info(
+            f"Evaluating on {len(self.paths)} images of {len(np.unique(self.pet_ids))} pets"
+        )
+
+    def embed(self, model: PetViTContrastiveModel) -> Embeddings:
+        embeddings = embed_images(model, self.paths, self.batch_size)
+        return Embeddings(self.paths, self.pet_ids, embeddings)
+
+    def pair_distances(self, embeddings: Embeddings) -> PairDistances:
+        return pair_distances(embeddings, self.negatives_per_image, seed=self.seed)
+
+    def evaluate(
+        self, model: PetViTContrastiveModel, threshold: float
+    ) -> Dict[str, float]:
+        distances = self.pair_distances(self.embed(model))
+        metrics = pair_metrics(distances, threshold, self.same_probability)
+        metrics["auc"] = threshold_sweep(distances, same_probability=self.same_probability)["auc"]
+        return metrics
@@ -0,0 +1,106 @@
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+import logging
+import numpy as np
+import torch
+from PIL.Image import Image
+
+from lostpaw.config import TrainConfig
+from lostpaw.model.checkpoint import find_state_file, load_state_file
+from lostpaw.model.manifest import ModelManifest, load_manifest
+from lostpaw.model.model import PetViTContrastiveModel
+
+
+def model_file(config: TrainConfig, fold: int = 0) -> Path:
+    """
+    Returns the path the Trainer saves the model of a config to, or the .pt
+    file of a model saved by an older version.
+    """
+    run_name = config.run_name
+    if config.cross_validiton_k_fold > 1:
+        run_name += f" kfold-{fold}of{config.cross_validiton_k_fold}"
+    return find_state_file(Path(config.model_path) / f"model_{run_name}.safetensors")
+
+
+def _head_shape(path: Path) -> Tuple[int, Optional[int]]:
+    # The output size of the last layer of the head and the rank of the
+    # first one, the state is memory mapped so only the header is read
+    state = load_state_file(path)
+    rank = state.get("latent_space.0.down.weight")
+    return (
+        state["latent_space.4.weight"].shape[0],
+        None if rank is None else rank.shape[0],
+    )
+
+
+def load_inference_model(
+    path: Path,
+    device: Union[str, torch.device] = "cpu",
+    latent_space_size: Optional[int] = None,
+    threshold: Optional[float] = None,
+    drop_padding_tokens: bool = False,
+    token_merge_ratio: float = 0.0,
+    compile_batch_sizes: Optional[Sequence[int]] = None,
+) -> Tuple[PetViTContrastiveModel, ModelManifest]:
+    """
+    Loads a trained model for inference, without the optimizer, dataset and
+    logging of the Trainer. The model is in eval mode and needs no gradients.
+
+    The ViT backbone and its preprocessing are loaded from the folder of the
+    model file, a FileNotFoundError is raised when they are missing. The
+    latent space size and the match threshold come from the manifest next
+    to it.
+
+    Args:
+        path: The model file saved by the Trainer.
+        device: Device to run the model on.
+        latent_space_size: Used when the model has no manifest, by default it
+                           is read from the weights, like the head rank.
+        threshold: Used when the model has no manifest.
+        drop_padding_tokens: Skip the black letterbox patches in the ViT.
+        token_merge_ratio: Fraction of the tokens merged after every ViT layer.
+        compile_batch_sizes: Compile the model with torch.compile for these
+                             batch sizes, the graphs are compiled before
+                             returning. By default the model is not compiled.
+    """
+    path = Path(path)
+    manifest = load_manifest(path)
+    if manifest is None:
+        if threshold is None:
+            raise ValueError(f"{path} has no manifest, a threshold is needed")
+        saved_size, head_rank = _head_shape(path)
+        manifest = ModelManifest(
+            latent_space_size or saved_size, threshold, head_rank=head_rank
+        )
+
+    model = PetViTContrastiveModel(
+        path.parent,
+        manifest.latent_space_size,
+        device=device,
+        empty_head=True,
+        head_rank=manifest.head_rank,
+        # A serving process never downloads or writes model files
+        local_files_only=True,
+    )
+    image_size = model.vit_model.config.image_size
+    if manifest.image_size is not None and manifest.image_size != image_size:
+        logging.warning(
+            f"The model was trained on images of {manifest.image_size} pixels, the ViT in {path.parent} takes {image_size}"
+        )
+    manifest.image_size = image_size
+
+    model.load_model(path)
+    model.reduce_tokens(drop_padding_tokens, token_merge_ratio)
+    model.requires_grad_(False)
+    model.train(False)
+    model.to(device)
+    if compile_batch_sizes:
+        model.enable_compile(compile_batch_sizes)
+    return model, manifest
+
+
+def embed(model: PetViTContrastiveModel, images: List[Image]) -> np.ndarray:
+    """Returns the embeddings of the images as an (N, latent_space_size) array."""
+    with torch.inference_mode():
+        features = model(images)
+    return features.float().cpu().numpy()
@@ -0,0 +1,41 @@
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Optional
+import json
+
+
+@dataclass
+class ModelManifest:
+    """
+    Describes how a saved model is used. It is stored as a JSON file next to
+    the model weights, so inference code does not need the training config.
+    """
+
+    latent_space_size: int
+    # Two images show the same pet when their distance is at most this value
+    threshold: float
+    # Calibrated thresholds, keyed by the false positive rate they target
+    thresholds: Dict[str, float] = field(default_factory=dict)
+    # Input size of the ViT, the size the pet crops are resized to
+    image_size: Optional[int] = None
+    # Rank of the factorized first layer of the head, None when it is not factorized
+    head_rank: Optional[int] = None
+
+    def save(self, path: Path):
+        with open(path, "wt") as f:
+            json.dump(asdict(self), f, indent=2)
+
+    @classmethod
+    def load(cls, path: Path) -> "ModelManifest":
+        with open(path, "rt") as f:
+            return cls(**json.load(f))
+
+
+def manifest_path(model_state_path: Path) -> Path:
+    """Returns the path of the manifest belonging to a model file."""
+    return Path(model_state_path).with_suffix(".json")
+
+
+def load_manifest(model_state_path: Path) -> Optional[ModelManifest]:
+    path = manifest_path(model_state_path)
+    return ModelManifest.load(path) if path.exists() else None
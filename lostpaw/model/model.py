@@ -1,9 +1,35 @@
-from transformers import ViTFeatureExtractor, ViTModel
+from typing import TYPE_CHECKING, Dict, Iterator, Optional, Sequence
 import torch
 import torch.nn as nn
 from torch import Tensor
 from pathlib import Path
 
+from lostpaw.model.checkpoint import load_state_file, save_state_file
+from lostpaw.model.token_reduction import TokenReducer
+
+if TYPE_CHECKING:
+    from transformers import ViTConfig
+
+    from lostpaw.model.compiled import CompiledEmbedder
+
+
+class LowRankLinear(nn.Module):
+    def __init__(self, in_features: int, out_features: int, rank: int, bias: bool = True):
+        """
+        Linear layer whose weight is the product of two thin matrices, it has
+        rank * (in_features + out_features) instead of in_features * out_features
+        weights. Built from a trained layer by lostpaw.model.compression.
+        """
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.down = nn.Linear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features, bias=bias)
+
+    def forward(self, x: Tensor) -> Tensor:
+        return self.up(self.down(x))
+
 
 class PetViTContrastiveModel(nn.Module):
     def __init__(
@@ -11,59 +37,204 @@ class PetViTContrastiveModel(nn.Module):
         model_path: Path,
         output_dim: int = 1024,  # Output dimension of the model, latent space size
         device="cpu",
+        vit_config: Optional["ViTConfig"] = None,  # Randomly initialized ViT, no download
+        empty_head: bool = False,  # Head weights are not initialized, load_model must be called
+        head_rank: Optional[int] = None,  # Rank of the factorized first layer of the head
+        vit_name: str = "google/vit-base-patch16-384",  # Downloaded when model_path has no ViT
+        local_files_only: bool = False,  # Raise FileNotFoundError instead of downloading the ViT
     ):
         super(PetViTContrastiveModel, self).__init__()
         self.vit_encoder = None
         self.vit_model = None
         self.model_path = Path(model_path)
-        self.fetch_vit()
+        self.vit_name = vit_name
+        if vit_config is None:
+            self.fetch_vit(local_files_only)
+        else:
+            # transformers is imported here, it is slow to import
+            from transformers import ViTFeatureExtractor, ViTModel
+
+            self.vit_model = ViTModel(vit_config)
+            self.vit_encoder = ViTFeatureExtractor(size=vit_config.image_size)
 
         self.device = device
+        self.backbone_frozen = False
+        self.head_rank = head_rank
+        self.token_reducer: Optional[TokenReducer] = None
+        self.compiled: Optional["CompiledEmbedder"] = None
 
-        self.latent_space = nn.Sequential(
-            # 577 = 384 / 16 * 384 / 16 + 1 (cls token)
-            nn.Linear(self.vit_model.config.hidden_size * 577, 2 * output_dim),
-            nn.ELU(),
-            nn.Linear(2 * output_dim, 2 * output_dim),
-            nn.ELU(),
-            nn.Linear(2 * output_dim, output_dim),
-        )
+        # 577 = 384 / 16 * 384 / 16 + 1 (cls token)
+        vit_config = self.vit_model.config
+        self.token_count = (vit_config.image_size // vit_config.patch_size) ** 2 + 1
+
+        # The first layer alone has hidden_size * token_count * 2 * output_dim
+        # weights. On the meta device no memory is allocated or initialized
+        # for weights that are replaced by the saved ones.
+        in_features = vit_config.hidden_size * self.token_count
+        with torch.device("meta" if empty_head else "cpu"):
+            self.latent_space = nn.Sequential(
+                nn.Linear(in_features, 2 * output_dim)
+                if head_rank is None
+                else LowRankLinear(in_features, 2 * output_dim, head_rank),
+                nn.ELU(),
+                nn.Linear(2 * output_dim, 2 * output_dim),
+                nn.ELU(),
+                nn.Linear(2 * output_dim, output_dim),
+            )
 
     def forward(self, x: Tensor):
-        x = self.vit_encoder(x, return_tensors="pt").to(self.device)
-        x = self.vit_model(**x)[0]
+        return self.embed(self.preprocess(x))
+
+    def preprocess(self, images) -> Dict[str, Tensor]:
+        """Resizes and normalizes the images into the inputs of the ViT."""
+        return self.vit_encoder(images, return_tensors="pt").to(self.device)
+
+    def embed(self, x: Dict[str, Tensor]) -> Tensor:
+        """Computes the latent space embeddings of preprocessed images."""
+        if self.compiled is not None:
+            return self.compiled(x)
+        return self.embed_eager(x)
+
+    def embed_eager(self, x: Dict[str, Tensor]) -> Tensor:
+        if self.backbone_frozen:
+            with torch.inference_mode():
+                x = self.encode(x)
+            if torch.is_grad_enabled():
+                # Inference tensors can not be saved for the backward pass of
+                # the head, a clone turns it into a normal tensor.
+                x = x.clone()
+        else:
+            x = self.encode(x)
         x = x.flatten(1)
         x = self.latent_space(x)
         return x
 
+    def encode(self, x: Dict[str, Tensor]) -> Tensor:
+        """Returns the last hidden state of the ViT, with all tokens."""
+        if self.token_reducer is not None:
+            return self.token_reducer.encode(x["pixel_values"])
+        return self.vit_model(**x)[0]
+
+    def enable_compile(
+        self,
+        batch_sizes: Optional[Sequence[int]] = None,
+        mode: Optional[str] = None,
+        warmup: bool = True,
+        grad: bool = False,
+    ) -> bool:
+        """
+        Runs embed with torch.compile, see lostpaw.model.compiled. Returns
+        False if compiling failed and the model stays in eager mode.
+
+        Args:
+            batch_sizes: Sizes the batches are padded to, to limit recompiles.
+            mode: Mode of torch.compile.
+            warmup: Compile the graphs of all batch sizes now.
+            grad: Also warm up with gradients, for training.
+        """
+        from lostpaw.model.compiled import DEFAULT_BATCH_SIZES, CompiledEmbedder
+
+        self.compiled = CompiledEmbedder(self, batch_sizes or DEFAULT_BATCH_SIZES, mode)
+        if warmup:
+            return self.compiled.warmup(grad)
+        return True
+
+    def reduce_tokens(
+        self,
+        drop_padding: bool = True,
+        merge_ratio: float = 0.0,
+        padding_tolerance: int = 8,
+    ):
+        """
+        Runs the ViT on fewer tokens for faster inference, see
+        lostpaw.model.token_reduction.TokenReducer. Without dropping and
+        merging, all tokens are used again.
+        """
+        if not drop_padding and merge_ratio <= 0:
+            self.token_reducer = None
+            return
+        self.token_reducer = TokenReducer(
+            self.vit_model, self.vit_encoder, drop_padding, merge_ratio, padding_tolerance
+        )
+
     def train(self, train=True):
         super().train(train)
         self.vit_model.train(False)
+        return self
+
+    def freeze_backbone(self, freeze: bool = True):
+        """
+        Stops training of the ViT. Its parameters no longer require gradients
+        and its forward pass runs in inference mode, so no activations are
+        kept for the backward pass.
+        """
+        self.backbone_frozen = freeze
+        self.vit_model.requires_grad_(not freeze)
+
+    def trainable_parameters(self) -> Iterator[nn.Parameter]:
+        return (p for p in self.parameters() if p.requires_grad)
+
+    def fetch_vit(self, local_files_only: bool = False):
+        from transformers import ViTFeatureExtractor, ViTModel
 
-    def fetch_vit(self):
         model_path = self.model_path / "model"
         encoder_path = self.model_path / "encoder"
 
+        if local_files_only and not (model_path.exists() and encoder_path.exists()):
+            raise FileNotFoundError(
+                f"No ViT in {self.model_path}, it needs the model and encoder folders saved by the Trainer"
+            )
         if model_path.exists() and encoder_path.exists():
             self.vit_encoder = ViTFeatureExtractor.from_pretrained(
                 encoder_path, local_files_only=True
             )
             self.vit_model = ViTModel.from_pretrained(model_path, local_files_only=True)
         else:
-            self.vit_model = ViTModel.from_pretrained("google/vit-base-patch16-384")
-            self.vit_encoder: ViTFeatureExtractor = ViTFeatureExtractor.from_pretrained(
-                "google/vit-base-patch16-384"
-            )
+            self.vit_model = ViTModel.from_pretrained(self.vit_name)
+            self.vit_encoder = ViTFeatureExtractor.from_pretrained(self.vit_name)
             model_path.mkdir(exist_ok=True, parents=True)
             encoder_path.mkdir(exist_ok=True, parents=True)
             self.vit_model.save_pretrained(model_path)
             self.vit_encoder.save_pretrained(encoder_path)
 
 
+    def model_state(self, include_backbone: bool = True) -> Dict[str, Tensor]:
+        """
+        Returns the state dict of the model. Without the backbone only the
+        latent space head is returned, the ViT weights are then restored
+        from the pretrained model in `model_path`.
+        """
+        state = self.state_dict()
+        if not include_backbone:
+            state = {k: v for k, v in state.items() if not k.startswith("vit_model.")}
+        return state
+
+    def load_model_state(self, state: Dict[str, Tensor], assign: bool = False):
+        """
+        Args:
+            state: State dict, with or without the backbone.
+            assign: Use the tensors of the state as parameters instead of
+                    copying them into the existing parameters.
+        """
+        missing, unexpected = self.load_state_dict(state, strict=False, assign=assign)
+        # The backbone is optional, it may have been left out of the state
+        missing = [k for k in missing if not k.startswith("vit_model.")]
+        if missing or unexpected:
+            raise RuntimeError(
+                f"Error loading model state. Missing keys: {missing}, unexpected keys: {unexpected}"
+            )
+
     def load_model(self, path: Path):
-        state = torch.load(path)
-        self.load_state_dict(state)
+        """
+        Loads a model file, .safetensors or .pt. The file is memory mapped,
+        on the CPU its tensors become the parameters without being copied.
+        """
+        state = load_state_file(path)
+        devices = {p.device.type for p in self.parameters()}
+        # Meta parameters have no memory the weights could be copied into
+        assign = devices <= {"cpu", "meta"} or "meta" in devices
+        self.load_model_state(state, assign=assign)
 
-    def save_model(self, path: Path):
-        state = self.state_dict()
-        torch.save(state, path)
+    def save_model(self, path: Path, include_backbone: bool = True):
+        state = self.model_state(include_backbone)
+        save_state_file(state, path)
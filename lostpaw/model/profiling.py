@@ -0,0 +1,191 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TypeVar
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import torch
+
+T = TypeVar("T")
+
+
+def peak_rss_bytes() -> int:
+    """Returns the memory high-water mark of this process."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class TrainProfiler:
+    def __init__(
+        self,
+        enabled: bool = False,
+        device: torch.device = torch.device("cpu"),
+        torch_profiler_start: int = 0,
+        torch_profiler_steps: int = 0,
+        torch_profiler_path: Optional[Path] = None,
+        trace_path: Optional[Path] = None,
+    ):
+        """
+        Times the stages of every training step (data, preprocess, forward,
+        backward, optimizer, metrics) and tracks the memory high-water marks.
+
+        Args:
+            enabled: Measure the stages. When disabled, stage() does nothing.
+            device: Device the model runs on. CUDA is synchronized at the end
+                    of every stage, so the time is attributed to the right stage.
+            torch_profiler_start: First step captured by torch.profiler.
+            torch_profiler_steps: Number of steps captured by torch.profiler,
+                                  0 disables it.
+            torch_profiler_path: Folder the torch.profiler trace is written to.
+            trace_path: File the stages are written to as a trace for
+                        chrome://tracing or Perfetto, with every summary.
+        """
+        self.enabled = enabled
+        self.trace_path = Path(trace_path) if enabled and trace_path is not None else None
+        self.trace_started = False
+        self.sync_cuda = enabled and device.type == "cuda"
+        self.step_count = 0
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.trace_events: List[Dict[str, Any]] = []
+        self.origin = perf_counter()
+        self.last_peak_rss = 0
+
+        self.torch_profiler: Optional[torch.profiler.profile] = None
+        if torch_profiler_steps > 0:
+            path = Path(torch_profiler_path or "profiles")
+            path.mkdir(exist_ok=True, parents=True)
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(
+                    wait=max(torch_profiler_start - 1, 0),
+                    warmup=min(torch_profiler_start, 1),
+                    active=torch_profiler_steps,
+                    repeat=1,
+                ),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(str(path)),
+                record_shapes=True,
+                profile_memory=True,
+            )
+            self.torch_profiler.start()
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            end = perf_counter()
+            self.durations[name].append(end - start)
+            self.trace_events.append(
+                dict(
+                    name=name,
+                    ph="X",
+                    ts=(start - self.origin) * 1e6,
+                    dur=(end - start) * 1e6,
+                    pid=os.getpid(),
+                    tid=threading.get_ident(),
+                    args=dict(step=self.step_count),
+                )
+            )
+
+    def timed(self, iterable: Iterable[T], name: str = "data") -> Iterator[T]:
+        """Wraps an iterable, timing how long every item takes to arrive."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self):
+        """Marks the end of a training step."""
+        self.step_count += 1
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Returns the mean duration of every stage since the last summary, then
+        starts a new measuring period. The CUDA high-water mark is reset with
+        every period, the peak RSS can not be reset and is the high-water mark
+        of the whole process, peak_rss_growth is how much it rose this period.
+        """
+        info: Dict[str, float] = dict()
+        if not self.enabled:
+            return info
+
+        for name, durations in self.durations.items():
+            info[f"time_{name}"] = sum(durations) / len(durations)
+            info[f"time_{name}_total"] = sum(durations)
+        info["peak_rss"] = peak_rss_bytes()
+        info["peak_rss_growth"] = info["peak_rss"] - self.last_peak_rss
+        self.last_peak_rss = info["peak_rss"]
+        if torch.cuda.is_available():
+            info["peak_cuda"] = torch.cuda.max_memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+
+        self.durations = defaultdict(list)
+        self.write_trace()
+        return info
+
+    def log_summary(self, info: Dict[str, float]):
+        if not info:
+            return
+        stages = ", ".join(
+            f"{k[5:]}: {v * 1000:.1f}ms"
+            for k, v in info.items()
+            if k.startswith("time_") and not k.endswith("_total")
+        )
+        memory = (
+            f"peak RSS: {info['peak_rss'] / 2**20:.0f}MiB "
+            f"(+{info['peak_rss_growth'] / 2**20:.0f}MiB)"
+        )
+        if "peak_cuda" in info:
+            memory += f", peak CUDA: {info['peak_cuda'] / 2**20:.0f}MiB"
+        logging.info(f"Step times - {stages} - {memory}")
+
+    def write_trace(self):
+        """
+        Appends the stages measured since the last call to the trace file and
+        drops them from memory. The file uses the JSON array format of the
+        trace viewers, which also opens a trace without the closing bracket,
+        the trace of an interrupted run.
+        """
+        if self.trace_path is None or not self.trace_events:
+            return
+        with open(self.trace_path, "at" if self.trace_started else "wt") as f:
+            for event in self.trace_events:
+                f.write(",\n" if self.trace_started else "[\n")
+                f.write(json.dumps(event))
+                self.trace_started = True
+        self.trace_events = []
+
+    def close(self):
+        """Stops torch.profiler and completes the trace file."""
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+        if self.trace_path is not None:
+            self.write_trace()
+            if self.trace_started:
+                with open(self.trace_path, "at") as f:
+                    f.write("\n]\n")
+                logging.info(f"Saved trace to {self.trace_path}")
+            self.trace_path = None
@@ -0,0 +1,144 @@
+from typing import Any, Dict, List, Optional
+import logging
+from torch.optim import Optimizer
+from torch.optim.lr_scheduler import (
+    CosineAnnealingLR,
+    LinearLR,
+    OneCycleLR,
+    ReduceLROnPlateau,
+    SequentialLR,
+)
+
+from lostpaw.config import SchedulerConfig
+
+SCHEDULERS = ["constant", "linear", "cosine", "onecycle", "plateau"]
+
+
+class TrainScheduler:
+    def __init__(
+        self,
+        optimizer: Optimizer,
+        name: Optional[str],
+        config: SchedulerConfig,
+        steps_per_epoch: int,
+        epochs: int,
+    ):
+        """
+        Learning rate schedule of the Trainer. Step based schedules (warmup,
+        linear, cosine and onecycle) advance after every batch, the plateau
+        schedule advances after every epoch using the test accuracy.
+
+        Args:
+            optimizer: The optimizer whose learning rate is scheduled. Its
+                       learning rate is the peak learning rate of the schedule.
+            name: One of constant, linear, cosine, onecycle or plateau.
+                  None is the same as constant.
+            config: Settings of the schedule.
+            steps_per_epoch: Number of optimizer steps per epoch.
+            epochs: Number of epochs the run trains for.
+        """
+        self.name = (name or "constant").lower()
+        if self.name not in SCHEDULERS:
+            raise ValueError(f"Scheduler {name} not supported")
+
+        self.optimizer = optimizer
+        self.config = config
+        total_steps = max(steps_per_epoch * epochs, 1)
+        warmup_steps = min(config.warmup_steps, total_steps)
+        decay_steps = max(total_steps - warmup_steps, 1)
+        base_lr = optimizer.param_groups[0]["lr"]
+
+        self.plateau: Optional[ReduceLROnPlateau] = None
+        self.step_scheduler: Any = None
+        # Step schedulers stop being advanced after this many steps
+        self.step_limit = total_steps
+
+        if self.name == "onecycle":
+            pct_start = (
+                warmup_steps / total_steps if warmup_steps > 0 else config.pct_start
+            )
+            self.step_scheduler = OneCycleLR(
+                optimizer,
+                max_lr=[group["lr"] for group in optimizer.param_groups],
+                total_steps=total_steps,
+                pct_start=pct_start,
+                div_factor=config.div_factor,
+                final_div_factor=config.final_div_factor,
+            )
+        else:
+            schedulers: List[Any] = []
+            if warmup_steps > 0:
+                schedulers.append(
+                    LinearLR(
+                        optimizer,
+                        start_factor=config.warmup_start_factor,
+                        total_iters=warmup_steps,
+                    )
+                )
+
+            if self.name == "linear":
+                schedulers.append(
+                    LinearLR(
+                        optimizer,
+                        start_factor=1.0,
+                        end_factor=config.min_lr / base_lr if base_lr > 0 else 0.0,
+                        total_iters=decay_steps,
+                    )
+                )
+            elif self.name == "cosine":
+                schedulers.append(
+                    CosineAnnealingLR(optimizer, T_max=decay_steps, eta_min=config.min_lr)
+                )
+            else:
+                # Constant and plateau only use the step scheduler for warmup,
+                # afterwards it would overwrite the plateau decay.
+                self.step_limit = warmup_steps
+
+            if len(schedulers) == 1:
+                self.step_scheduler = schedulers[0]
+            elif len(schedulers) > 1:
+                self.step_scheduler = SequentialLR(
+                    optimizer, schedulers, milestones=[warmup_steps]
+                )
+
+            if self.name == "plateau":
+                self.plateau = ReduceLROnPlateau(
+                    optimizer,
+                    mode="max",
+                    factor=config.factor,
+                    patience=config.patience,
+                    threshold=config.threshold,
+                )
+
+        self.steps = 0
+        logging.info(f"Scheduler {self.name}: {config}")
+
+    def step(self):
+        """Advances the schedule by one optimizer step."""
+        self.steps += 1
+        if self.step_scheduler is not None and self.steps <= self.step_limit:
+            self.step_scheduler.step()
+
+    def step_epoch(self, accuracy: float):
+        """Advances the schedule at the end of an epoch."""
+        if self.plateau is not None and self.steps >= self.config.warmup_steps:
+            self.plateau.step(accuracy)
+
+    def get_lr(self) -> float:
+        return self.optimizer.param_groups[0]["lr"]
+
+    def state_dict(self) -> Dict[str, Any]:
+        return dict(
+            steps=self.steps,
+            step_scheduler=self.step_scheduler.state_dict()
+            if self.step_scheduler is not None
+            else None,
+            plateau=self.plateau.state_dict() if self.plateau is not None else None,
+        )
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        self.steps = state["steps"]
+        if self.step_scheduler is not None and state["step_scheduler"] is not None:
+            self.step_scheduler.load_state_dict(state["step_scheduler"])
+        if self.plateau is not None and state["plateau"] is not None:
+            self.plateau.load_state_dict(state["plateau"])
@@ -0,0 +1,182 @@
+from typing import TYPE_CHECKING, Optional, Tuple
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+if TYPE_CHECKING:
+    from transformers import ViTFeatureExtractor, ViTModel
+
+
+def padding_patches(
+    pixel_values: Tensor, patch_size: int, black: Tensor, scale: Tensor, tolerance: float
+) -> Tensor:
+    """
+    Returns a [batch, patches] mask of the patches in which every pixel is
+    within `tolerance` (in 0-1 intensity) of black.
+
+    Args:
+        pixel_values: Normalized [batch, channels, height, width] images.
+        patch_size: Size of the ViT patches.
+        black: Normalized value of black, per channel.
+        scale: Standard deviation of the normalization, per channel.
+        tolerance: Largest difference to black, JPEG noise is not exactly 0.
+    """
+    diff = (pixel_values - black.view(1, -1, 1, 1)).abs_().mul_(scale.view(1, -1, 1, 1))
+    # max_pool2d is much faster than amax over a strided view of the patches
+    diff = F.max_pool2d(diff.amax(dim=1, keepdim=True), patch_size)
+    return diff.flatten(1) <= tolerance
+
+
+def _gather_tokens(x: Tensor, index: Tensor) -> Tensor:
+    return x.gather(1, index.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+
+
+def merge_tokens(
+    x: Tensor, size: Tensor, owner: Tensor, r: int
+) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Merges `r` tokens into their most similar tokens by bipartite matching,
+    as in Token Merging (Bolya et al., 2023). The class token is never merged.
+
+    Args:
+        x: [batch, tokens, hidden] hidden states.
+        size: [batch, tokens, 1] number of original patches every token stands
+              for, merged tokens are weighted by it.
+        owner: [batch, patches + 1] index of the token every original patch
+               was merged into, -1 for patches that were dropped.
+        r: Number of tokens to merge.
+
+    Returns the merged hidden states, their sizes and the updated owners.
+    """
+    batch, count, hidden = x.shape
+    tokens, token_size = x[:, 1:], size[:, 1:]
+    a, b = tokens[:, ::2], tokens[:, 1::2]
+    a_size, b_size = token_size[:, ::2], token_size[:, 1::2]
+    a_count, b_count = a.shape[1], b.shape[1]
+
+    with torch.no_grad():
+        metric = tokens / tokens.norm(dim=-1, keepdim=True)
+        scores = metric[:, ::2] @ metric[:, 1::2].transpose(-1, -2)
+        node_max, node_index = scores.max(dim=-1)
+        order = node_max.argsort(dim=-1, descending=True)
+        src, unmerged = order[:, :r], order[:, r:]
+        dst = node_index.gather(1, src)
+
+    # Size weighted average of every b token and the a tokens merged into it
+    b_sum = (b * b_size).scatter_add(
+        1, dst.unsqueeze(-1).expand(-1, -1, hidden), _gather_tokens(a * a_size, src)
+    )
+    b_size = b_size.scatter_add(1, dst.unsqueeze(-1), a_size.gather(1, src.unsqueeze(-1)))
+    merged = torch.cat([x[:, :1], _gather_tokens(a, unmerged), b_sum / b_size], dim=1)
+    merged_size = torch.cat(
+        [size[:, :1], a_size.gather(1, unmerged.unsqueeze(-1)), b_size], dim=1
+    )
+
+    # New index of every old token. Old token 1 + 2j is a_j, 2 + 2j is b_j.
+    kept = a_count - r
+    arange = torch.arange(max(a_count, b_count), device=x.device).expand(batch, -1)
+    remap = torch.zeros(batch, count, dtype=torch.long, device=x.device)
+    remap[:, 2 : 2 + 2 * b_count : 2] = 1 + kept + arange[:, :b_count]
+    remap.scatter_(1, 1 + 2 * unmerged, 1 + arange[:, :kept])
+    remap.scatter_(1, 1 + 2 * src, 1 + kept + dst)
+    owner = torch.where(owner >= 0, remap.gather(1, owner.clamp(min=0)), owner)
+    return merged, merged_size, owner
+
+
+class TokenReducer:
+    def __init__(
+        self,
+        vit_model: "ViTModel",
+        vit_encoder: "ViTFeatureExtractor",
+        drop_padding: bool = True,
+        merge_ratio: float = 0.0,
+        padding_tolerance: int = 8,
+    ):
+        """
+        Runs the ViT on fewer tokens. The crops of DetrPetExtractor are
+        letterboxed with black bars, the patches of the bars are dropped
+        before the first layer. After every layer, `merge_ratio` of the
+        remaining tokens are merged into similar tokens.
+
+        The head flattens all tokens, so the original token layout is restored
+        after the last layer: every patch gets the hidden state of the token
+        it was merged into, and dropped patches get the hidden state of that
+        position in an all black image.
+
+        Args:
+            vit_model: The ViT of the model.
+            vit_encoder: Its feature extractor, for the normalization.
+            drop_padding: Drop the black patches.
+            merge_ratio: Fraction of the tokens merged after every layer, at
+                         most 0.5.
+            padding_tolerance: Largest difference to black of the pixels of a
+                               padding patch, in 0-255 levels.
+        """
+        self.vit_model = vit_model
+        self.drop_padding = drop_padding
+        self.merge_ratio = min(merge_ratio, 0.5)
+        self.tolerance = padding_tolerance / 255
+        self.patch_size = vit_model.config.patch_size
+
+        if getattr(vit_encoder, "do_normalize", True):
+            mean = torch.tensor(vit_encoder.image_mean, dtype=torch.float32)
+            std = torch.tensor(vit_encoder.image_std, dtype=torch.float32)
+        else:
+            mean, std = torch.zeros(3), torch.ones(3)
+        self.black = -mean / std
+        self.scale = std
+        # Hidden states of an all black image, computed on first use
+        self.reference: Optional[Tensor] = None
+
+    def padding_reference(self, like: Tensor) -> Tensor:
+        if self.reference is None or self.reference.device != like.device:
+            size = self.vit_model.config.image_size
+            black = self.black.to(like.device).view(1, -1, 1, 1).expand(1, -1, size, size)
+            with torch.no_grad():
+                self.reference = self.vit_model(pixel_values=black.to(like.dtype))[0][0]
+        return self.reference
+
+    def encode(self, pixel_values: Tensor) -> Tensor:
+        """Returns the last hidden state of the ViT, like ViTModel(...)[0]."""
+        vit = self.vit_model
+        pixel_values = pixel_values.to(vit.embeddings.patch_embeddings.projection.weight.dtype)
+        x = vit.embeddings(pixel_values)
+        batch, count, hidden = x.shape
+
+        owner = torch.arange(count, device=x.device).expand(batch, -1)
+        if self.drop_padding:
+            padding = padding_patches(
+                pixel_values,
+                self.patch_size,
+                self.black.to(x.device),
+                self.scale.to(x.device),
+                self.tolerance,
+            )
+            # Every image keeps as many patches as the image with the least
+            # padding, so the batch stays one tensor. Images with more padding
+            # keep some of their padding patches.
+            keep = max(int((~padding).sum(dim=1).max()), 1)
+            order = padding.int().argsort(dim=1, stable=True)[:, :keep]
+            patches = order.sort(dim=1).values + 1
+            index = torch.cat([torch.zeros_like(patches[:, :1]), patches], dim=1)
+            x = _gather_tokens(x, index)
+
+            owner = torch.full((batch, count), -1, dtype=torch.long, device=x.device)
+            owner.scatter_(1, index, torch.arange(index.shape[1], device=x.device).expand(batch, -1))
+
+        size = torch.ones(batch, x.shape[1], 1, dtype=x.dtype, device=x.device)
+        layers = vit.encoder.layer
+        for i, layer in enumerate(layers):
+            x = layer(x)
+            x = x[0] if isinstance(x, tuple) else x
+            # Merging after the last layer would save nothing
+            r = min(int(self.merge_ratio * (x.shape[1] - 1)), (x.shape[1] - 1) // 2)
+            if r > 0 and i < len(layers) - 1:
+                x, size, owner = merge_tokens(x, size, owner, r)
+        x = vit.layernorm(x)
+
+        restored = _gather_tokens(x, owner.clamp(min=0))
+        if self.drop_padding:
+            reference = self.padding_reference(x).unsqueeze(0)
+            restored = torch.where(owner.unsqueeze(-1) >= 0, restored, reference)
+        return restored
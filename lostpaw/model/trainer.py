@@ -1,13 +1,22 @@
-from typing import Any, Iterable, Optional, Union
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 from lostpaw.data.data_folder import PetImagesFolder
 from lostpaw.model import PetViTContrastiveModel, PetContrastiveLoss
-from lostpaw.config import TrainConfig, OptimizerConfig
+from lostpaw.model.checkpoint import CheckpointManager, find_state_file
+from lostpaw.model.evaluation import Evaluator
+from lostpaw.model.manifest import ModelManifest, load_manifest, manifest_path
+from lostpaw.model.profiling import TrainProfiler
+from lostpaw.model.scheduler import TrainScheduler
+from lostpaw.config import TrainConfig, OptimizerConfig, SchedulerConfig
 from lostpaw.data import RandomPairDataset
+from lostpaw.data.auto_augment import DataAugmenter, parse_policies
+from lostpaw.data.image_cache import create_image_cache
+from lostpaw.data.splits import load_folds
+from lostpaw.resources import configure_process
 from dataclasses import asdict
+from itertools import islice
 from pathlib import Path
 from tqdm import tqdm
 import logging
-import wandb
 import torch
 from torch.optim import Adam, AdamW, SGD
 import numpy as np
@@ -24,6 +33,8 @@ class Trainer:
         seed: Optional[int] = None,
     ) -> None:
         logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+        # One torch thread per physical core the process may use
+        configure_process(config.cpu_threads)
 
         self.config = config
         self.batches_per_epoch = config.batches_per_epoch
@@ -35,13 +46,37 @@ class Trainer:
             k = 0 if data is None else data.current_fold
             self.run_name += f" kfold-{k}of{config.cross_validiton_k_fold}"
 
-        self.model_state_path = self.model_path / f"model_{self.run_name}.pt"
+        self.model_state_path = self.model_path / f"model_{self.run_name}.safetensors"
 
-        # ViT model
+        # ViT model, the head is not initialized when it is loaded from a file
         self.vit_model = PetViTContrastiveModel(
-            config.model_path, config.latent_space_size, device=device
-        ).to(device)
+            config.model_path,
+            config.latent_space_size,
+            device=device,
+            empty_head=find_state_file(self.model_state_path).exists(),
+            head_rank=config.head_rank,
+            vit_name=config.vit_name,
+        )
+        if config.freeze_backbone:
+            self.vit_model.freeze_backbone()
+        # A frozen backbone is restored from the pretrained model, no need to save it
+        self.include_backbone = not (
+            config.freeze_backbone or config.checkpoint_exclude_backbone
+        )
         self.load_model()
+        self.vit_model.to(device)
+        manifest = load_manifest(self.model_state_path)
+        if manifest is not None and manifest.thresholds:
+            logging.warning(
+                "The calibrated thresholds of the model are reset to the margin when "
+                "this training saves it, run scripts/calibrate_threshold.py again afterwards"
+            )
+        if config.compile_model:
+            self.vit_model.enable_compile(
+                config.compile_batch_sizes
+                or [config.batch_size, config.test_batch_size, config.eval_batch_size],
+                grad=True,
+            )
 
         # Loss function
         self.contrastive_loss = PetContrastiveLoss(
@@ -50,17 +85,43 @@ class Trainer:
 
         # Dataset
         if data is None:
+            image_cache = None
+            if config.image_cache_mb > 0:
+                image_size = self.cache_image_size()
+                image_cache = create_image_cache(
+                    config.image_cache_mb * 2**20,
+                    (image_size, image_size),
+                    config.image_cache_shared,
+                )
+            augmenter = None
+            if config.augment_probability > 0:
+                augmenter = DataAugmenter(
+                    parse_policies(config.augment_policies),
+                    probability=config.augment_probability,
+                )
             info_path = Path(config.info_path)
-            data_folder = PetImagesFolder(info_path.parent, info_path.name)
+            data_folder = PetImagesFolder(info_path.parent, info_path.name, image_cache)
             self.pet_data = RandomPairDataset(
                 data_folder,
                 config.similarity_probability,
                 config.cross_validiton_k_fold,
                 seed=seed,
+                augmenter=augmenter,
+                folds=load_folds(Path(config.fold_path)) if config.fold_path else None,
             )
         else:
             self.pet_data = data
 
+        self.evaluator: Optional[Evaluator] = None
+        if config.eval_info_path:
+            eval_path = Path(config.eval_info_path)
+            self.evaluator = Evaluator(
+                PetImagesFolder(eval_path.parent, eval_path.name),
+                config.eval_batch_size,
+                config.eval_negatives_per_image,
+                config.similarity_probability,
+            )
+
         logging.info("Trainer initialized")
         logging.info(f"Using device: {device}")
         logging.info("Train config:")
@@ -70,9 +131,42 @@ class Trainer:
         self.optimizer: Union[Adam, AdamW, SGD]
         self.load_optimizer(config.optimizer, opt_config)
 
+        self.scheduler = TrainScheduler(
+            self.optimizer,
+            config.scheduler,
+            SchedulerConfig(**(config.scheduler_params or {})),
+            self.batches_per_epoch,
+            config.epochs,
+        )
+
+        # Training state, restored when a checkpoint of this run exists
+        self.start_epoch = 0
+        self.global_step = 0
+        self.bad_epochs = 0
+        self.best_accuracy = 0.0
+        self.stopped_early = False
+        self.checkpoints = CheckpointManager(
+            self.model_path / "checkpoints",
+            self.run_name,
+            config.keep_checkpoints,
+            config.async_checkpoints,
+        )
+        self.load_checkpoint()
+
+        self.profiler = TrainProfiler(
+            config.profile,
+            device,
+            config.torch_profiler_start,
+            config.torch_profiler_steps,
+            self.model_path / "profiles" / self.run_name,
+            self.model_path / f"trace_{self.run_name}.json",
+        )
+
         self.use_wandb = config.use_wandb
         self.use_tqdm = config.use_tqdm
         if config.use_wandb:
+            import wandb
+
             wandb.init(
                 project="lostpaw",
                 entity="klotzandrei",
@@ -83,6 +177,15 @@ class Trainer:
             wandb.watch(self.vit_model)
 
     def train(self):
+        try:
+            self.train_epochs()
+        finally:
+            # Also when training fails, is interrupted or has already finished,
+            # the pending checkpoints are written and the threads stopped
+            self.checkpoints.close()
+            self.profiler.close()
+
+    def train_epochs(self):
         epochs: int = self.config.epochs
         batch_size: int = self.config.batch_size
         test_batch_size: int = self.config.test_batch_size
@@ -91,22 +194,28 @@ class Trainer:
 
         progress_tqdm = None
 
-        data = self.pet_data.get_batches(batch_size)
+        if self.stopped_early or self.start_epoch >= epochs:
+            logging.info("Training of this run has already finished.")
+            return
+
+        # Continue the pair stream where the previous run stopped
+        data = self.pet_data.get_batches(
+            batch_size, start=self.global_step * batch_size
+        )
 
-        if test_batch_size != 0 and test_batch_count != 0:
+        if self.evaluator is None and test_batch_size != 0 and test_batch_count != 0:
             if self.pet_data.fold_count is not None and self.pet_data.fold_count > 1:
                 test_data = self.pet_data.get_batches(test_batch_size, test=True)
             else:
                 # For now just use the same data for testing, as long as the
                 # test_batch_size is small we should have old data generally. 
-                test_data = self.pet_data.get_batches(test_batch_size)
-
-        bad_epochs = 0
-        best_accuracy = 0
+                test_data = self.pet_data.get_batches(test_batch_size, augment=False)
 
-        for epoch in range(epochs):
+        for epoch in range(self.start_epoch, epochs):
             # Get the batches
-            progress: Iterable[Any] = enumerate(data)
+            progress: Iterable[Any] = enumerate(
+                self.profiler.timed(islice(data, self.batches_per_epoch), "data")
+            )
             if self.use_tqdm:
                 progress = progress_tqdm = tqdm(
                     progress,
@@ -118,34 +227,26 @@ class Trainer:
             total_metric = np.zeros([4])
 
             for idx, (imgs1, imgs2, given_labels) in progress:
-                if idx >= self.batches_per_epoch:
-                    break
-
                 self.optimizer.zero_grad()
 
-                # Get the features
-                features1 = self.vit_model(imgs1)
-                features2 = self.vit_model(imgs2)
-
-                # Merge the images for the contrastive loss
-                # fatures: [batch_size, 2, output_dim]
-                # labels: [batch_size]
-                features = torch.stack([features1, features2], dim=1).to(device)
-                labels = torch.tensor(given_labels, dtype=torch.float32).to(device)
-                distance = self.contrastive_loss.euclidean_distance(features)
+                loss, distance, labels = self.pair_loss(imgs1, imgs2, given_labels)
 
-                # Compute the loss
-                loss: torch.Tensor = self.contrastive_loss(features, labels, distance)
+                with self.profiler.stage("backward"):
+                    # Backpropagate
+                    loss.backward()
 
-                # Backpropagate
-                loss.backward()
+                with self.profiler.stage("optimizer"):
+                    # Update the weights
+                    self.optimizer.step()
+                    self.scheduler.step()
+                    self.global_step += 1
 
-                # Update the weights
-                self.optimizer.step()
+                with self.profiler.stage("metrics"):
+                    total_metric += self.compute_metrics(labels, distance, batch_size)
 
-                total_metric += self.compute_metrics(labels, distance, batch_size)
+                    total_loss += loss.item()
 
-                total_loss += loss.item()
+                self.profiler.step()
 
                 # Log the accuracy and loss
                 if progress_tqdm:
@@ -153,6 +254,7 @@ class Trainer:
                     progress_tqdm.set_postfix(
                         {
                             "epoch": epoch,
+                            "lr": self.scheduler.get_lr(),
                             "loss": total_loss / (idx + 1),
                             # "acc": total_acc / (idx + 1),
                             "diff": m_different,
@@ -168,7 +270,13 @@ class Trainer:
             total_acc = 1 - (metric_err1 + metric_err2)
 
             test_dict = dict()
-            if test_batch_size != 0:
+            if self.evaluator is not None:
+                with self.profiler.stage("evaluate"):
+                    metrics = self.evaluator.evaluate(
+                        self.vit_model, self.contrastive_loss.margin
+                    )
+                test_dict = {f"test_{k}": v for k, v in metrics.items()}
+            elif test_batch_size != 0:
                 test_dict = dict(
                     test_accuracy=0,
                     test_diff=0,
@@ -196,18 +304,34 @@ class Trainer:
                 test_dict["test_err1"] /= test_batch_count
                 test_dict["test_err2"] /= test_batch_count
 
-            if epoch > 50:
-                if test_dict["test_accuracy"] <= best_accuracy:
-                    bad_epochs += 1
+            profile_dict = self.profiler.summary()
+            self.profiler.log_summary(profile_dict)
+            if self.pet_data.image_cache is not None:
+                cache_stats = self.pet_data.image_cache.stats()
+                logging.info(f"Image cache: {cache_stats}")
+                profile_dict.update({f"image_cache_{k}": v for k, v in cache_stats.items()})
+
+            # Without a test set, fall back to the train accuracy
+            accuracy = test_dict.get("test_accuracy", total_acc)
+            if epoch > self.config.early_stopping_start_epoch:
+                if accuracy <= self.best_accuracy:
+                    self.bad_epochs += 1
                 else:
-                    bad_epochs = 0
-                    best_accuracy = test_dict["test_accuracy"]
+                    self.bad_epochs = 0
+                    self.best_accuracy = accuracy
+
+            lr = self.scheduler.get_lr()
+            self.scheduler.step_epoch(accuracy)
+
+            self.stopped_early = self.bad_epochs > self.config.early_stopping_epochs
 
 
             logging.info(
                 f"Epoch {epoch} - Avg. Loss: {total_loss:.3f} - Avg. Accuracy: {total_acc:.3f}"
             )
             if self.use_wandb:
+                import wandb
+
                 wandb.log(
                     dict(
                         loss=total_loss,
@@ -216,18 +340,44 @@ class Trainer:
                         same=metric_same,
                         err1=metric_err1,
                         err2=metric_err2,
-                        **test_dict
+                        lr=lr,
+                        **test_dict,
+                        **{f"profile/{k}": v for k, v in profile_dict.items()},
                     ),
                     step=epoch,
                 )
 
-            if (epoch % self.config.save_model_every == 0) or (epoch == epochs - 1) or (bad_epochs > self.config.early_stopping_epochs):
+            if (epoch % self.config.save_model_every == 0) or (epoch == epochs - 1) or self.stopped_early:
                 self.save_model()
+                self.save_checkpoint(epoch)
 
-            if bad_epochs > self.config.early_stopping_epochs:
+            if self.stopped_early:
                 logging.info("Early stopping!")
                 break
 
+    def embed_pairs(self, imgs1: List[Image], imgs2: List[Image]) -> torch.Tensor:
+        """Returns the features of the pairs, as a [batch_size, 2, output_dim] tensor."""
+        with self.profiler.stage("preprocess"):
+            inputs1 = self.vit_model.preprocess(imgs1)
+            inputs2 = self.vit_model.preprocess(imgs2)
+
+        with self.profiler.stage("forward"):
+            features1 = self.vit_model.embed(inputs1)
+            features2 = self.vit_model.embed(inputs2)
+            return torch.stack([features1, features2], dim=1).to(device)
+
+    def pair_loss(
+        self, imgs1: List[Image], imgs2: List[Image], given_labels: List[int]
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Returns the loss, the distances and the labels of a batch of pairs."""
+        features = self.embed_pairs(imgs1, imgs2)
+
+        with self.profiler.stage("forward"):
+            labels = torch.tensor(given_labels, dtype=torch.float32).to(device)
+            distance = self.contrastive_loss.euclidean_distance(features)
+            loss: torch.Tensor = self.contrastive_loss(features, labels, distance)
+        return loss, distance, labels
+
     def compute_metrics(self, labels, distances, batch_size) -> np.array:
         labels_u8 = labels.to(dtype=torch.int8)
         values_u8 = (distances <= self.contrastive_loss.margin).to(dtype=torch.int8)
@@ -245,14 +395,80 @@ class Trainer:
             distance = self.contrastive_loss.euclidean_distance(features)
             return self.compute_metrics(labels, distance, batch_size)
 
+    def cache_image_size(self) -> int:
+        """Size the image cache stores the images at, the input size of the ViT."""
+        return self.vit_model.vit_model.config.image_size
+
     def save_model(self):
         logging.info("Saving model...")
-        self.vit_model.save_model(self.model_state_path)
+        self.checkpoints.save_file(
+            self.vit_model.model_state(self.include_backbone),
+            self.model_state_path,
+        )
+        # The margin is the threshold until scripts/calibrate_threshold.py is
+        # run. New weights change the embedding space, so the thresholds
+        # calibrated for a resumed or fine-tuned model no longer apply.
+        ModelManifest(
+            self.config.latent_space_size,
+            self.contrastive_loss.margin,
+            image_size=self.vit_model.vit_model.config.image_size,
+            head_rank=self.config.head_rank,
+        ).save(manifest_path(self.model_state_path))
+
+    def save_checkpoint(self, epoch: int):
+        """
+        Saves everything needed to resume training after the given epoch.
+        """
+        state: Dict[str, Any] = dict(
+            model=self.vit_model.model_state(self.include_backbone),
+            optimizer=self.optimizer.state_dict(),
+            scheduler=self.scheduler.state_dict(),
+            epoch=epoch,
+            step=self.global_step,
+            data=dict(
+                seed=self.pet_data.seed,
+                fold=self.pet_data.current_fold,
+                fold_count=self.pet_data.fold_count,
+            ),
+            early_stopping=dict(
+                bad_epochs=self.bad_epochs,
+                best_accuracy=self.best_accuracy,
+                stopped=self.stopped_early,
+            ),
+            config=asdict(self.config),
+        )
+        self.checkpoints.save(state, epoch)
+
+    def load_checkpoint(self) -> bool:
+        state = self.checkpoints.load_latest()
+        if state is None:
+            return False
+
+        logging.info(f"Resuming training after epoch {state['epoch']}.")
+        self.vit_model.load_model_state(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        if state["scheduler"] is not None:
+            self.scheduler.load_state_dict(state["scheduler"])
+
+        self.start_epoch = state["epoch"] + 1
+        self.global_step = state["step"]
+
+        data = state["data"]
+        self.pet_data.seed = data["seed"]
+        if data["fold_count"] == self.pet_data.fold_count:
+            self.pet_data.set_fold(data["fold"])
+
+        early_stopping = state["early_stopping"]
+        self.bad_epochs = early_stopping["bad_epochs"]
+        self.best_accuracy = early_stopping["best_accuracy"]
+        self.stopped_early = early_stopping["stopped"]
+        return True
 
     def load_model(self):
-        if self.model_state_path.exists():
+        path = find_state_file(self.model_state_path)
+        if path.exists():
             logging.info("Found previous model. Continuing training...")
-            self.vit_model.load_model(self.model_state_path)
+            self.vit_model.load_model(path)
             return True
         else:
             logging.info("No model to load. Training from scratch.")
@@ -263,7 +479,7 @@ class Trainer:
         optimizer = optimizer.lower()
         if optimizer == "adam":
             self.optimizer = Adam(
-                self.vit_model.parameters(),
+                self.vit_model.trainable_parameters(),
                 config.lr,
                 config.betas,
                 config.eps,
@@ -278,7 +494,7 @@ class Trainer:
                 config.weight_decay = 1e-2
 
             self.optimizer = AdamW(
-                self.vit_model.parameters(),
+                self.vit_model.trainable_parameters(),
                 config.lr,
                 config.betas,
                 config.eps,
@@ -287,7 +503,7 @@ class Trainer:
             )
         elif optimizer == "sgd":
             self.optimizer = SGD(
-                self.vit_model.parameters(),
+                self.vit_model.trainable_parameters(),
                 config.lr,
                 config.momentum,
                 config.dampening,
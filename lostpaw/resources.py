@@ -0,0 +1,132 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+import logging
+import os
+
+# torch is imported when the threads are set, so the scripts can plan their
+# workers before they import it
+
+
+def available_cpus() -> List[int]:
+    """The CPUs this process may run on, taskset and cgroup cpusets restrict them."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_quota() -> Optional[float]:
+    """The number of CPUs the cgroup v2 quota of a container allows, if limited."""
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+    except (OSError, ValueError):
+        return None
+    if quota == "max":
+        return None
+    return int(quota) / int(period)
+
+
+def physical_cores(cpus: Sequence[int]) -> List[List[int]]:
+    """
+    Groups the CPUs by the physical core they run on, hyperthreads of one
+    core share its arithmetic units. Without topology information in sysfs
+    every CPU is its own core.
+    """
+    cores: Dict[Tuple[str, str], List[int]] = dict()
+    for cpu in cpus:
+        topology = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology")
+        try:
+            key = (
+                (topology / "physical_package_id").read_text().strip(),
+                (topology / "core_id").read_text().strip(),
+            )
+        except OSError:
+            key = ("cpu", str(cpu))
+        cores.setdefault(key, []).append(cpu)
+    return sorted(cores.values())
+
+
+@dataclass
+class WorkerResources:
+    # CPUs the worker is pinned to
+    cpus: Tuple[int, ...]
+    # Intra-op threads of torch, one per physical core
+    threads: int
+    # Threads that run independent operators in parallel
+    interop_threads: int
+
+    def apply(self):
+        """Pins the calling process to its CPUs and sets the torch thread pools."""
+        import torch
+
+        if hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, self.cpus)
+            except OSError as e:
+                logging.warning(f"Could not pin the process to CPUs {self.cpus}: {e}")
+        torch.set_num_threads(self.threads)
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError:
+            # Only possible before the first parallel work of the process
+            pass
+        logging.info(
+            f"Running on CPUs {list(self.cpus)} with {self.threads} threads "
+            f"and {self.interop_threads} interop threads"
+        )
+
+
+def plan_workers(
+    workers: int, cpus: Optional[Sequence[int]] = None, threads: Optional[int] = None
+) -> List[WorkerResources]:
+    """
+    Splits the available CPUs into disjoint sets of whole physical cores, one
+    per worker, and sizes the torch thread pools to match. Without a plan
+    every worker process starts a thread per core of the machine, and the
+    workers thrash each other.
+
+    When there are more workers than cores, the workers share cores and run
+    single threaded.
+
+    Args:
+        workers: Number of worker processes.
+        cpus: The CPUs to plan, by default those of the process.
+        threads: Intra-op threads per worker, by default its physical cores,
+                 limited by the CPU quota of the container.
+    """
+    cpus = available_cpus() if cpus is None else list(cpus)
+    cores = physical_cores(cpus)
+    # A CPU quota limits the CPU time of a container, not the cores it runs
+    # on. The workers stay on the cores of the affinity mask, only their
+    # number of threads is limited.
+    quota = cpu_quota()
+    budget = len(cores) if quota is None else min(len(cores), max(int(quota), 1))
+
+    plan = []
+    if workers >= len(cores):
+        for i in range(workers):
+            core = cores[i % len(cores)]
+            plan.append(WorkerResources(tuple(core), threads or 1, 1))
+        return plan
+
+    for i in range(workers):
+        # Spread the remainder, no worker has more than one core more than another
+        start, end = i * len(cores) // workers, (i + 1) * len(cores) // workers
+        assigned = cores[start:end]
+        worker_budget = (i + 1) * budget // workers - i * budget // workers
+        worker_threads = threads or max(min(len(assigned), worker_budget), 1)
+        plan.append(
+            WorkerResources(
+                tuple(cpu for core in assigned for cpu in core),
+                worker_threads,
+                min(2, worker_threads),
+            )
+        )
+    return plan
+
+
+def configure_process(threads: Optional[int] = None) -> WorkerResources:
+    """Sizes the torch thread pools of a single process to the CPUs it may use."""
+    resources = plan_workers(1, threads=threads)[0]
+    resources.apply()
+    return resources
@@ -0,0 +1,72 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from pprint import pprint
+
+from lostpaw.model.calibration import (
+    best_accuracy_threshold,
+    distance_histogram,
+    thresholds_for_fpr,
+)
+from lostpaw.model.evaluation import Embeddings
+from lostpaw.model.manifest import ModelManifest, load_manifest, manifest_path
+from lostpaw.resources import configure_process
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="""Picks match thresholds from the cached held-out
+        embeddings of scripts/test.py and stores them in the model manifest."""
+    )
+
+    parser.add_argument("embeddings", type=Path, help="path to the cached embeddings (.npz)")
+    parser.add_argument("model", type=Path, help="path to the model file the embeddings belong to")
+    parser.add_argument(
+        "--fpr",
+        type=float,
+        nargs="+",
+        default=[0.001, 0.01, 0.05, 0.1],
+        help="false positive rates to compute thresholds for",
+    )
+    parser.add_argument(
+        "--select",
+        type=float,
+        help="""false positive rate whose threshold becomes the default
+        threshold of the model. Without it, the most accurate threshold is used.""",
+    )
+    parser.add_argument("--bins", type=int, default=4096)
+    parser.add_argument("--similarity_probability", type=float, default=0.5)
+    parser.add_argument("--dry_run", action="store_true", help="only print the thresholds")
+    parser.add_argument(
+        "--cpu_threads",
+        type=int,
+        help="intra-op threads of torch, by default one per physical core",
+    )
+
+    args = parser.parse_args()
+    configure_process(args.cpu_threads)
+
+    embeddings = Embeddings.load(args.embeddings)
+    histogram = distance_histogram(embeddings, args.bins)
+
+    targets = sorted(set(args.fpr + ([args.select] if args.select is not None else [])))
+    calibrated = thresholds_for_fpr(histogram, targets)
+    best = best_accuracy_threshold(histogram, args.similarity_probability)
+
+    pprint(dict(
+        positive_pairs=int(histogram.positive.sum()),
+        negative_pairs=int(histogram.negative.sum()),
+    ))
+    pprint(calibrated)
+    pprint(dict(best_accuracy=best))
+
+    threshold = best["threshold"]
+    if args.select is not None:
+        threshold = calibrated[args.select]["threshold"]
+
+    if not args.dry_run:
+        manifest = load_manifest(args.model) or ModelManifest(
+            latent_space_size=int(embeddings.embeddings.shape[1]), threshold=threshold
+        )
+        manifest.threshold = threshold
+        manifest.thresholds = {str(fpr): t["threshold"] for fpr, t in calibrated.items()}
+        manifest.save(manifest_path(args.model))
+        print(f"Saved threshold {threshold:.4f} to {manifest_path(args.model)}")
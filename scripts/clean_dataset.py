@@ -2,8 +2,14 @@ from argparse import ArgumentParser
 from os import remove
 from pathlib import Path
 from random import random
+from pprint import pprint
+from typing import Optional
+import json
+import logging
 import numpy as np
 from lostpaw.data.data_folder import PetImagesFolder
+from lostpaw.data.near_duplicates import find_near_duplicates, resolve_near_duplicates
+from lostpaw.data.splits import assign_folds, dataset_stats, save_folds, split_pets
 
 
 def deduplicate(folder: PetImagesFolder):
@@ -19,26 +25,67 @@ def deduplicate(folder: PetImagesFolder):
     deduplicated.to_json(folder.info_file, orient="records", lines=True)
 
 
-def split_test(folder: PetImagesFolder, split_name: str, test_percentage: float):
+def remove_near_duplicates(
+    folder: PetImagesFolder,
+    report_path: Path,
+    action: str = "report",
+    max_distance: int = 3,
+    workers: int = 4,
+    max_bucket: int = 1024,
+):
+    stats = dict()
+    clusters = find_near_duplicates(folder, max_distance, workers, max_bucket, stats)
+    with open(report_path, "wt") as report:
+        for cluster in clusters:
+            report.write(json.dumps(cluster.to_dict()) + "\n")
+    # How much of the search had to fall back to splitting or chunked comparisons
+    stats_path = report_path.with_suffix(".stats.json")
+    with open(stats_path, "wt") as f:
+        json.dump(dict(stats, groups=len(clusters), max_distance=max_distance, max_bucket=max_bucket), f, indent=2)
+    print(f"near duplicates: {len(clusters)} groups, report in {report_path}, statistics in {stats_path}")
+
+    if action == "report":
+        return
+
+    keep, relabel = resolve_near_duplicates(folder, clusters, action)
     df = folder.data_frame()
-    ids = df["pet_id"].unique()
-    test_pet_count = int(len(ids) * test_percentage)
-
-    test_ids = set(np.random.choice(ids, size=test_pet_count, replace=False))
-
-    is_test = df["pet_id"].map(lambda id: id in test_ids)
+    df["pet_id"] = df["pet_id"].map(lambda pet_id: relabel.get(pet_id, pet_id))
+
+    # Paths can be shared by records, only remove the ones no longer used
+    kept_paths = set(path for paths in df[keep]["paths"] for path in paths)
+    for paths in df[~keep]["paths"]:
+        for path in paths:
+            if path not in kept_paths and Path(path).exists():
+                remove(path)
+
+    print(f"removed {np.count_nonzero(~keep)} records, merged {len(relabel)} pets")
+    df[keep].to_json(folder.info_file, orient="records", lines=True)
+
+
+def split_test(
+    folder: PetImagesFolder,
+    split_name: str,
+    test_percentage: float,
+    seed: Optional[int] = None,
+    dry_run: bool = False,
+):
+    df = folder.data_frame()
+    is_test = split_pets(df, test_percentage, seed)
     test = df[is_test]
     train = df[~is_test]
 
-    print("train:", np.bincount(train.groupby("pet_id")["paths"].apply(len), minlength=6).tolist())
-    print("test:", np.bincount(test.groupby("pet_id")["paths"].apply(len), minlength=6).tolist())
+    print("train:", dataset_stats(train)["records per pet"])
+    print("test:", dataset_stats(test)["records per pet"])
 
-    if input("should we continue? (y/n): ") == "y":
+    if not dry_run:
         train.to_json(folder.info_file, orient="records", lines=True)
+        test.to_json(folder.info_file.with_name(split_name), orient="records", lines=True)
 
-        test_path = Path(folder.info_file)
-        test_path.name = split_name
-        test.to_json(test_path, orient="records", lines=True)
+
+def write_folds(folder: PetImagesFolder, folds_name: str, fold_count: int, seed: Optional[int] = None):
+    folds = assign_folds(folder.data_frame(), fold_count, seed)
+    save_folds(folds, folder.info_file.with_name(folds_name))
+    print("pets per fold:", np.bincount(folds["fold"], minlength=fold_count).tolist())
 
 
 if __name__ == "__main__":
@@ -48,6 +95,32 @@ if __name__ == "__main__":
     parser.add_argument(
         "--deduplicate", action="store_true", help="deduplicate the dataset"
     )
+    parser.add_argument(
+        "--near-duplicates",
+        choices=["report", "remove", "merge"],
+        help="find images that are resized or re-encoded copies of each other, \
+            and only report them, remove the copies, or also merge the pets \
+            that share a copy",
+    )
+    parser.add_argument(
+        "--max-distance",
+        type=int,
+        default=3,
+        help="maximum number of differing bits of the 64 bit perceptual hashes",
+    )
+    parser.add_argument(
+        "--max-bucket",
+        type=int,
+        default=1024,
+        help="largest bucket of the hash index compared directly, larger ones \
+            are indexed again on the other bits",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        help="path of the near duplicate report, near_duplicates.jsonl in the dataset by default",
+    )
+    parser.add_argument("--workers", type=int, default=4)
     parser.add_argument(
         "--split-to",
         type=str,
@@ -59,11 +132,49 @@ if __name__ == "__main__":
         type=float,
         default=0.1,
     )
+    parser.add_argument(
+        "--folds-to",
+        type=str,
+        help="when given assign every pet to a cross validation fold, and save \
+            the assignment next to the info file with the given name",
+    )
+    parser.add_argument("--folds", type=int, default=5, help="number of folds")
+    parser.add_argument("--seed", type=int, help="seed of the split and the folds")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only show the sizes of the split"
+    )
+    parser.add_argument(
+        "--describe", action="store_true", help="print statistics of the dataset"
+    )
 
     args = parser.parse_args()
 
+    logging.basicConfig(format="[%(levelname)s] %(message)s", level=logging.INFO)
+
     if args.deduplicate:
         deduplicate(PetImagesFolder(args.path))
 
+    if args.near_duplicates:
+        remove_near_duplicates(
+            PetImagesFolder(args.path),
+            args.report or args.path / "near_duplicates.jsonl",
+            args.near_duplicates,
+            args.max_distance,
+            args.workers,
+            args.max_bucket,
+        )
+
     if args.split_to:
-        split_test(PetImagesFolder(args.path), args.split_to, args.split_percentage)
+        split_test(
+            PetImagesFolder(args.path),
+            args.split_to,
+            args.split_percentage,
+            args.seed,
+            args.dry_run,
+        )
+
+    if args.folds_to:
+        write_folds(PetImagesFolder(args.path), args.folds_to, args.folds, args.seed)
+
+    if args.describe:
+        pprint(dataset_stats(PetImagesFolder(args.path).data_frame()))
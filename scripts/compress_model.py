@@ -0,0 +1,158 @@
+from argparse import ArgumentParser
+from dataclasses import replace
+from pathlib import Path
+from pprint import pprint
+from time import perf_counter
+from typing import Any, Dict, Optional
+import logging
+
+import torch
+import yaml
+
+from lostpaw.config import TrainConfig
+from lostpaw.data.data_folder import PetImagesFolder
+from lostpaw.model.checkpoint import load_state_file
+from lostpaw.model.compression import count_parameters, factorize_head
+from lostpaw.model.evaluation import Evaluator
+from lostpaw.model.inference import load_inference_model
+from lostpaw.model.manifest import manifest_path
+from lostpaw.model.model import PetViTContrastiveModel
+from lostpaw.resources import configure_process
+
+
+def time_head(model: PetViTContrastiveModel, batch_size: int, repeats: int) -> float:
+    """Milliseconds the latent space head takes for one batch of ViT outputs."""
+    in_features = model.latent_space[0].in_features
+    x = torch.randn(batch_size, in_features, device=next(model.parameters()).device)
+    with torch.inference_mode():
+        model.latent_space(x)
+        start = perf_counter()
+        for _ in range(repeats):
+            model.latent_space(x)
+    return (perf_counter() - start) / repeats * 1000
+
+
+def describe(
+    model: PetViTContrastiveModel,
+    path: Path,
+    threshold: float,
+    evaluator: Optional[Evaluator],
+    args,
+) -> Dict[str, Any]:
+    info: Dict[str, Any] = dict(
+        head_parameters=count_parameters(model.latent_space),
+        file_mb=path.stat().st_size / 2**20,
+        head_ms=time_head(model, args.batch_size, args.repeats),
+    )
+    if evaluator is not None:
+        info.update(evaluator.evaluate(model, threshold))
+    return info
+
+
+def finetune(config_path: Path, output: Path, rank: int, latent_space_size: int, epochs: int):
+    with open(config_path, "rt") as f:
+        cfg = yaml.safe_load(f)
+    cfg.update(
+        model_path=str(output.parent),
+        run_name=output.stem[len("model_"):],
+        epochs=epochs,
+        head_rank=rank,
+        latent_space_size=latent_space_size,
+        cross_validiton_k_fold=1,
+    )
+
+    # Imported here, the trainer pulls in wandb
+    from lostpaw.model.trainer import Trainer
+
+    # The Trainer finds the compressed model by its run name and continues from it
+    trainer = Trainer(TrainConfig(**cfg))
+    trainer.train()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="""Compresses a trained model by replacing the first layer
+        of its latent space head with a truncated SVD, and reports the size,
+        speed and accuracy of both models. The result is a normal model file
+        with the rank in its manifest."""
+    )
+
+    parser.add_argument("model", type=Path, help="path to the model file")
+    rank = parser.add_mutually_exclusive_group(required=True)
+    rank.add_argument("--rank", type=int, help="rank of the factorized layer")
+    rank.add_argument(
+        "--energy",
+        type=float,
+        help="use the smallest rank that keeps this fraction of the squared singular values",
+    )
+    parser.add_argument(
+        "--run_name",
+        type=str,
+        help="run name of the compressed model, <run name>_rank<rank> by default",
+    )
+    parser.add_argument(
+        "--eval_info_path", type=Path, help="held-out data to measure the accuracy on"
+    )
+    parser.add_argument("--eval_batch_size", type=int, default=32)
+    parser.add_argument("--similarity_probability", type=float, default=0.5)
+    parser.add_argument(
+        "--finetune_config",
+        type=Path,
+        help="training config (YAML) used to fine-tune the compressed model",
+    )
+    parser.add_argument(
+        "--finetune_epochs",
+        type=int,
+        default=0,
+        help="epochs to fine-tune the compressed model with the contrastive loss",
+    )
+    parser.add_argument("--batch_size", type=int, default=16, help="batch size of the timings")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument(
+        "--cpu_threads",
+        type=int,
+        help="intra-op threads of torch, by default one per physical core",
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    if args.finetune_epochs > 0 and args.finetune_config is None:
+        parser.error("--finetune_epochs needs a --finetune_config")
+    configure_process(args.cpu_threads)
+
+    evaluator = None
+    if args.eval_info_path is not None:
+        evaluator = Evaluator(
+            PetImagesFolder(args.eval_info_path.parent, args.eval_info_path.name),
+            args.eval_batch_size,
+            same_probability=args.similarity_probability,
+        )
+
+    model, manifest = load_inference_model(args.model)
+    report = dict(original=describe(model, args.model, manifest.threshold, evaluator, args))
+
+    report["factorization"] = factorize_head(model, args.rank, args.energy)
+    run_name = args.run_name or f"{args.model.stem[len('model_'):]}_rank{model.head_rank}"
+    output = args.model.with_name(f"model_{run_name}.safetensors")
+
+    # Keep the backbone in the file if the original model has it
+    include_backbone = any(k.startswith("vit_model.") for k in load_state_file(args.model))
+    model.save_model(output, include_backbone)
+    manifest = replace(manifest, head_rank=model.head_rank)
+    manifest.save(manifest_path(output))
+    logging.info(f"Saved {output}")
+    report["compressed"] = describe(model, output, manifest.threshold, evaluator, args)
+
+    if args.finetune_epochs > 0:
+        del model
+        finetune(
+            args.finetune_config,
+            output,
+            manifest.head_rank,
+            manifest.latent_space_size,
+            args.finetune_epochs,
+        )
+        model, manifest = load_inference_model(output)
+        report["finetuned"] = describe(model, output, manifest.threshold, evaluator, args)
+
+    pprint(report, sort_dicts=False)
@@ -0,0 +1,32 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import logging
+
+from lostpaw.model.checkpoint import atomic_save, load_state_file
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="""Converts .pt model files saved by torch.save into
+        memory mapped .safetensors files, which the models load lazily and
+        without copying. The manifest of a model is shared by both files."""
+    )
+
+    parser.add_argument("models", type=Path, nargs="+", help="paths to the .pt model files")
+    parser.add_argument(
+        "--remove", action="store_true", help="delete the .pt files after converting them"
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+
+    for path in args.models:
+        target = path.with_suffix(".safetensors")
+        state = load_state_file(path)
+        if "model" in state and isinstance(state["model"], dict):
+            # A training checkpoint, only the model weights are kept
+            state = state["model"]
+
+        atomic_save(state, target)
+        logging.info(f"Converted {path} to {target}")
+        if args.remove:
+            path.unlink()
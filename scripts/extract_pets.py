@@ -3,34 +3,69 @@ from glob import glob
 import json
 import logging
 from pathlib import Path
-from typing import Any, List, Set, Tuple
-from lostpaw.data import PetImagesDataset, DetrPetExtractor
+from typing import Any, List, Optional, Set, Tuple
+from lostpaw.data import PetImageDataset, DetrPetExtractor
 from lostpaw.data.auto_augment import DataAugmenter
+from lostpaw.data.buckets import bucketed_batches
+from lostpaw.data.cascade import FastPetDetector
+from lostpaw.data.decode import DETR_SHORTEST_EDGE
+from lostpaw.data.detection_cache import DetectionCache
+from lostpaw.resources import WorkerResources, plan_workers
 from multiprocessing import Process
 from PIL.Image import Image
 
 from lostpaw.data.extract_pets import lookup_next_image_name
 
-def extract_images(data: PetImagesDataset, output_dir: Path, model_path: Path, batch_size: int = 4):
+def extract_images(data: PetImageDataset, output_dir: Path, model_path: Path, batch_size: int = 4,
+                   augmented_copies: int = 0, cache_path: Optional[Path] = None, threshold: float = 0.9,
+                   bucket_width: float = 0.1, cascade: Optional[Tuple[float, float]] = None,
+                   resources: Optional[WorkerResources] = None):
     logging.basicConfig(
         format="[%(levelname)s] %(message)s", level=logging.INFO)
-
-    pet_extractor = DetrPetExtractor(model_path)
-    pet_augment = DataAugmenter()
+    # Before torch runs anything, the interop threads can only be set then
+    if resources is not None:
+        resources.apply()
+
+    # With a detection cache, extracting again with other settings does not
+    # run DETR on the images it has seen
+    cache = DetectionCache(cache_path) if cache_path else None
+    # With a cascade, DETR only runs on the images the fast detector is not
+    # confident about
+    fast_detector = FastPetDetector(*cascade) if cascade is not None else None
+    pet_extractor = DetrPetExtractor(
+        model_path, cache=cache, bucket_width=bucket_width, fast_detector=fast_detector)
+    # Training augments the images when they are loaded, so by default only
+    # the crop itself is stored
+    pet_augment = DataAugmenter() if augmented_copies > 0 else None
 
     with open(output_dir / "processed.txt", "at") as processed_file:
         with open(output_dir / "train.data", "at") as resulting_file:
-            for batch in data.get_batches(batch_size=batch_size):
-                input_images = batch["images"]
-                input_labels = [str(l) for l in batch["labels"]]
-                input_paths = batch["paths"]
-                labels = zip(input_labels, input_paths)
-
+            # Batches of images with about the same aspect ratio, so DETR
+            # runs on little padding
+            items = (
+                item
+                for batch in data.get_batches(batch_size=batch_size)
+                for item in zip(batch["images"], batch["labels"], batch["paths"], batch["sources"])
+            )
+            for batch in bucketed_batches(items, lambda item: item[0].size, batch_size, bucket_width):
+                input_images = [image for image, _, _, _ in batch]
+                labels = [(str(label), path) for _, label, path, _ in batch]
+                sources = [source for _, _, _, source in batch]
+
+                # The images are decoded at about the size DETR runs at, the
+                # crops come from the resolution the output size needs
                 cropped: List[Tuple[Image, Tuple[str, Any]]] = pet_extractor.extract(
-                    input_images, labels, output_size=(384, 384))
+                    input_images, labels, threshold=threshold, output_size=(384, 384),
+                    sources=sources)
 
-                for image, (label, path) in cropped:
-                    augmented = pet_augment.get_transforms(image, 2)
+                variants = []
+                if pet_augment is not None:
+                    # Augment all crops of the batch at once
+                    variants = pet_augment.variants(
+                        [image for image, _ in cropped], augmented_copies)
+
+                for i, (image, (label, path)) in enumerate(cropped):
+                    augmented = variants[i::len(cropped)]
                     augmented.insert(0, image)
 
                     paths = [save_image(image, label, output_dir)
@@ -44,6 +79,13 @@ def extract_images(data: PetImagesDataset, output_dir: Path, model_path: Path, b
                 processed_file.flush()
                 resulting_file.flush()
 
+    logging.info(f"Padding of the DETR inputs: {pet_extractor.padding_fraction():.1%}")
+    if fast_detector is not None:
+        logging.info(f"Detector cascade: {fast_detector.stats()}")
+    if cache is not None:
+        cache.flush()
+        logging.info(f"Detection cache: {cache.stats()}")
+
 
 def save_image(image, label, output_dir):
     folder_path = Path(output_dir, str(label))
@@ -66,13 +108,21 @@ def main(args: Namespace):
         with open(processed_file_path, "rt") as processed_file:
             ignore.union(l.strip() for l in processed_file.readlines())
 
-    pet_data = PetImagesDataset.load_from_file(Path(args.info_file), ignore=ignore)
+    shortest_edge = None if args.full_decode else DETR_SHORTEST_EDGE
+    pet_data = PetImageDataset.load_from_file(
+        Path(args.info_file), ignore=ignore, shortest_edge=shortest_edge)
 
+    cascade = (args.cascade_confidence, args.cascade_uncertainty) if args.cascade else None
+    # Every process gets its own cores, instead of a torch thread per core of
+    # the machine each
+    plan = plan_workers(args.threads, threads=args.threads_per_worker)
     processes: List[Process] = []
     for i, data_subset in enumerate(pet_data.split(args.threads)):
         sub_out_path = output_dir / f"thread_{i}"
         sub_out_path.mkdir(exist_ok=True)
-        process = Process(target=extract_images, args=[data_subset, sub_out_path, args.model_path])
+        process = Process(target=extract_images, args=[
+            data_subset, sub_out_path, args.model_path, args.batch_size, args.augmented_copies,
+            args.detection_cache, args.threshold, args.aspect_bucket_width, cascade, plan[i]])
         process.start()
         processes.append(process)
 
@@ -85,8 +135,33 @@ if __name__ == "__main__":
     parser.add_argument("--info_file", type=str, required=True)
     parser.add_argument("--model_path", type=str, required=True)
     parser.add_argument("--output_dir", type=str, required=True)
-    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4, help="number of worker processes")
+    parser.add_argument(
+        "--threads_per_worker", type=int,
+        help="torch threads of every worker, by default one per physical core assigned to it")
     parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--threshold", type=float, default=0.9, help="minimum score of a detected pet")
+    parser.add_argument(
+        "--detection_cache", type=str,
+        help="folder that keeps the DETR detections of every image, to extract again without running DETR")
+    parser.add_argument(
+        "--aspect_bucket_width", type=float, default=0.1,
+        help="batch images of about the same aspect ratio (log scale), 0 keeps the input order")
+    parser.add_argument(
+        "--cascade", action="store_true",
+        help="run a small Faster R-CNN first, DETR only runs when it is uncertain or finds several animals")
+    parser.add_argument(
+        "--cascade_confidence", type=float, default=0.9,
+        help="smallest score of the single pet found by the fast detector to skip DETR")
+    parser.add_argument(
+        "--cascade_uncertainty", type=float, default=0.3,
+        help="smallest score of the animals the fast detector counts")
+    parser.add_argument(
+        "--full_decode", action="store_true",
+        help="decode JPEGs at full size instead of the lowest resolution DETR needs")
+    parser.add_argument(
+        "--augmented_copies", type=int, default=0,
+        help="Augmented copies to store per crop and policy. Training can augment on the fly instead.")
 
     args = parser.parse_args()
 
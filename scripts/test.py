@@ -2,28 +2,80 @@ from pathlib import Path
 from pprint import pprint
 from lostpaw.config.args import get_args
 from lostpaw.data.data_folder import PetImagesFolder
-from lostpaw.model.trainer import Trainer, TrainConfig
-from tqdm import tqdm
+from lostpaw.model.evaluation import (
+    Embeddings,
+    Evaluator,
+    pair_metrics,
+    threshold_sweep,
+)
+from lostpaw.model.inference import load_inference_model, model_file
+from lostpaw.config import TrainConfig
+from lostpaw.resources import configure_process
 
 import numpy as np
+import torch
 
 def main(args):
     config = TrainConfig(**vars(args))
     config.use_wandb = False
+    configure_process(config.cpu_threads)
 
-    trainer = Trainer(config)
-    pet_data = trainer.pet_data
-    batch_size = config.test_batch_size
-    test_batches = pet_data.get_batches(batch_size=batch_size)
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    model_path = model_file(config)
+    model, manifest = load_inference_model(
+        model_path,
+        device,
+        config.latent_space_size,
+        config.contrastive_margin,
+        config.drop_padding_tokens,
+        config.token_merge_ratio,
+        (config.compile_batch_sizes or [config.eval_batch_size])
+        if config.compile_model
+        else None,
+    )
+    info_path = Path(config.eval_info_path or config.info_path)
+    evaluator = Evaluator(
+        PetImagesFolder(info_path.parent, info_path.name),
+        config.eval_batch_size,
+        config.eval_negatives_per_image,
+        config.similarity_probability,
+    )
 
-    metrics = np.zeros(4)
-    for _ in tqdm(range(config.test_batch_count)):
-        imgs1, imgs2, labels = next(test_batches)
-        metrics += trainer.test_batch(imgs1, imgs2, labels, batch_size)
+    # Reuse the embeddings of an earlier run, as long as the model did not change
+    reduction = ""
+    if config.drop_padding_tokens or config.token_merge_ratio > 0:
+        reduction = f"_tokens{int(config.drop_padding_tokens)}-{config.token_merge_ratio}"
+    cache_path = model_path.with_name(
+        f"{model_path.stem}_{info_path.stem}{reduction}.embeddings.npz"
+    )
+    embeddings = None
+    if cache_path.exists() and (
+        not model_path.exists()
+        or cache_path.stat().st_mtime > model_path.stat().st_mtime
+    ):
+        embeddings = Embeddings.load(cache_path)
+        if embeddings.paths != evaluator.paths:
+            embeddings = None
 
-    m_diff, m_err1, m_err2, m_same = metrics / config.test_batch_count
+    if embeddings is None:
+        embeddings = evaluator.embed(model)
+        embeddings.save(cache_path)
 
-    pprint(dict(m_diff=m_diff, m_err1=m_err1, m_err2=m_err2, m_same=m_same))
+    distances = evaluator.pair_distances(embeddings)
+    metrics = pair_metrics(distances, manifest.threshold, config.similarity_probability)
+    sweep = threshold_sweep(distances, same_probability=config.similarity_probability)
+    best = int(np.argmax(sweep["accuracy"]))
+
+    pprint(metrics)
+    pprint(
+        dict(
+            positive_pairs=len(distances.positive),
+            negative_pairs=len(distances.negative),
+            auc=sweep["auc"],
+            best_threshold=float(sweep["thresholds"][best]),
+            best_accuracy=float(sweep["accuracy"][best]),
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 from lostpaw.config.args import get_args
 from lostpaw.model.trainer import Trainer, TrainConfig
+from lostpaw.model.distillation import DistillationTrainer
 
 def main(args):
     config = TrainConfig(**vars(args))
@@ -8,7 +9,10 @@ def main(args):
     pet_data = None
 
     for _ in range(k_folds):
-        trainer = Trainer(config, pet_data)
+        if config.teacher_path:
+            trainer = DistillationTrainer(config, pet_data)
+        else:
+            trainer = Trainer(config, pet_data)
         pet_data = trainer.pet_data
 
         trainer.train()
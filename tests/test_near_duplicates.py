@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from lostpaw.data.near_duplicates import candidate_pairs, connected_components, hamming_distance
+
+
+def hashes_with_near_duplicates(seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    hashes = rng.integers(0, 2**63, 500, dtype=np.int64).astype(np.uint64)
+    base = hashes[:100]
+    one_bit = np.uint64(1) << rng.integers(0, 64, 100).astype(np.uint64)
+    three_bits = np.uint64(7) << rng.integers(0, 61, 100).astype(np.uint64)
+    return np.unique(np.concatenate([hashes, base ^ one_bit, base ^ three_bits]))
+
+
+def brute_force(hashes: np.ndarray, max_distance: int) -> set:
+    first, second = np.triu_indices(len(hashes), 1)
+    close = hamming_distance(hashes[first], hashes[second]) <= max_distance
+    return set(zip(first[close].tolist(), second[close].tolist()))
+
+
+@pytest.mark.parametrize("max_distance", [0, 3, 6])
+@pytest.mark.parametrize("max_bucket", [1024, 4, 1])
+def test_candidate_pairs_finds_all_close_pairs(max_distance, max_bucket):
+    hashes = hashes_with_near_duplicates()
+    first, second = candidate_pairs(hashes, max_distance, max_bucket)
+
+    assert (first < second).all()
+    assert set(zip(first.tolist(), second.tolist())) == brute_force(hashes, max_distance)
+
+
+def test_oversized_buckets_are_split():
+    hashes = hashes_with_near_duplicates()
+    stats = dict()
+    candidate_pairs(hashes, 6, 4, stats)
+    assert stats["split_buckets"] > 0
+
+
+def test_connected_components():
+    labels = connected_components(6, np.array([4, 1, 2]), np.array([5, 2, 3]))
+    assert labels.tolist() == [0, 1, 1, 1, 4, 4]
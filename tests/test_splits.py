@@ -0,0 +1,60 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lostpaw.data.data_folder import PetImagesFolder
+from lostpaw.data.dataset import RandomPairDataset
+from lostpaw.data.splits import assign_folds, split_pets
+
+
+def records(sizes):
+    """A data frame with `size` records for every pet."""
+    rows = [
+        dict(pet_id=pet_id, paths=[f"{pet_id}/{i}.jpg"])
+        for pet_id, size in enumerate(sizes)
+        for i in range(size)
+    ]
+    return pd.DataFrame(rows)
+
+
+def test_split_pets_keeps_pets_together():
+    df = records([1, 2, 3, 4, 5, 6] * 10)
+    is_test = split_pets(df, 0.2, seed=0)
+
+    per_pet = pd.Series(is_test).groupby(df["pet_id"]).agg(["min", "max"])
+    assert (per_pet["min"] == per_pet["max"]).all()
+    # Every stratum of 10 pets puts 2 in the test set
+    assert per_pet["min"].sum() == 12
+
+
+def test_assign_folds_is_balanced():
+    df = records([2, 3, 4] * 21)
+    folds = assign_folds(df, 3, seed=0)
+
+    assert sorted(folds["pet_id"]) == list(range(63))
+    assert np.bincount(folds["fold"], minlength=3).tolist() == [21, 21, 21]
+
+
+def pair_dataset(tmp_path, sizes, folds):
+    with open(tmp_path / "train.data", "wt") as f:
+        for row in records(sizes).to_dict("records"):
+            f.write(json.dumps(row) + "\n")
+    return RandomPairDataset(PetImagesFolder(tmp_path), fold_count=2, seed=1, folds=folds)
+
+
+def test_fold_with_a_single_pet_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match="has 1 pets"):
+        pair_dataset(tmp_path, [2, 2, 2], {0: 0, 1: 0, 2: 1})
+
+
+def test_empty_fold_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match="has 0 pets"):
+        pair_dataset(tmp_path, [2, 2, 2], {0: 0, 1: 0, 2: 0})
+
+
+def test_valid_folds(tmp_path):
+    dataset = pair_dataset(tmp_path, [2, 2, 2, 2], {0: 0, 1: 0, 2: 1, 3: 1})
+    dataset.set_fold(1)
+    assert len(dataset.train_pets) == len(dataset.test_pets) == 2
@@ -0,0 +1,65 @@
+import torch
+from transformers import ViTConfig, ViTFeatureExtractor, ViTModel
+
+from lostpaw.model.token_reduction import TokenReducer, merge_tokens
+
+
+def small_vit(image_size: int = 64) -> ViTModel:
+    torch.manual_seed(0)
+    config = ViTConfig(
+        image_size=image_size,
+        patch_size=16,
+        hidden_size=32,
+        num_hidden_layers=3,
+        num_attention_heads=2,
+        intermediate_size=64,
+    )
+    return ViTModel(config).eval()
+
+
+def test_no_reduction_reproduces_the_vit():
+    vit = small_vit()
+    reducer = TokenReducer(vit, ViTFeatureExtractor(size=64), drop_padding=False, merge_ratio=0.0)
+    pixel_values = torch.randn(2, 3, 64, 64)
+
+    with torch.no_grad():
+        expected = vit(pixel_values=pixel_values)[0]
+        assert torch.equal(reducer.encode(pixel_values), expected)
+
+
+def test_drop_padding_without_padding_reproduces_the_vit():
+    vit = small_vit()
+    reducer = TokenReducer(vit, ViTFeatureExtractor(size=64), drop_padding=True, merge_ratio=0.0)
+    # Normalized pixels far from black, no patch is padding
+    pixel_values = torch.ones(2, 3, 64, 64)
+
+    with torch.no_grad():
+        expected = vit(pixel_values=pixel_values)[0]
+        assert torch.allclose(reducer.encode(pixel_values), expected, atol=1e-6)
+
+
+def test_merged_tokens_keep_a_valid_owner_for_every_patch():
+    torch.manual_seed(1)
+    batch, count, hidden = 3, 17, 8
+    x = torch.randn(batch, count, hidden)
+    size = torch.ones(batch, count, 1)
+    owner = torch.arange(count).expand(batch, -1)
+
+    for r in (4, 3, 2):
+        x, size, owner = merge_tokens(x, size, owner, r)
+        assert ((owner >= 0) & (owner < x.shape[1])).all()
+        # The class token is never merged
+        assert (owner[:, 0] == 0).all()
+        # Every token stands for as many patches as point to it
+        counts = torch.zeros(batch, x.shape[1]).scatter_add_(1, owner, torch.ones(batch, count))
+        assert torch.equal(counts, size.squeeze(-1))
+
+
+def test_merging_identical_tokens_keeps_their_value():
+    x = torch.randn(1, 1, 4).repeat(1, 9, 1)
+    size = torch.ones(1, 9, 1)
+    owner = torch.arange(9).unsqueeze(0)
+
+    merged, _, owner = merge_tokens(x, size, owner, 4)
+    restored = merged.gather(1, owner.unsqueeze(-1).expand(-1, -1, 4))
+    assert torch.allclose(restored, x)
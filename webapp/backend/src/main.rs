@@ -132,7 +132,9 @@ async fn pet_spotted(
             )
         })?;
 
-    let result = state.pets.compare_features(&features, 1.66, 5);
+    let result = state
+        .pets
+        .compare_features(&features, state.extractor.threshold(), 5);
 
     Ok(Json(result))
 }
@@ -1,35 +1,49 @@
-from io import BytesIO
 from lostpaw.config.config import TrainConfig
+from lostpaw.data.cascade import FastPetDetector
+from lostpaw.data.decode import ScaledImage
 from lostpaw.data.extract_pets import DetrPetExtractor
-from lostpaw.model import PetViTContrastiveModel
-from PIL import Image
-from torch import Tensor
+from lostpaw.model.inference import embed, load_inference_model, model_file
+from lostpaw.resources import configure_process
 import yaml
 import numpy as np
 
-from lostpaw.model.trainer import Trainer
-
 with open("lostpaw/configs/container.yaml", "r") as f:
     config = TrainConfig(**yaml.safe_load(f))
     print(config)
 
-trainer = Trainer(config)
-model = trainer.vit_model
-model.train(False)
+# One torch thread per physical core the container may use
+configure_process(config.cpu_threads)
+
+# Only the model is loaded, no optimizer, dataset or wandb run
+model, manifest = load_inference_model(
+    model_file(config),
+    latent_space_size=config.latent_space_size,
+    threshold=config.contrastive_margin,
+    drop_padding_tokens=config.drop_padding_tokens,
+    token_merge_ratio=config.token_merge_ratio,
+    # Uploads are embedded one at a time
+    compile_batch_sizes=(config.compile_batch_sizes or [1]) if config.compile_model else None,
+)
+threshold = manifest.threshold
+output_size = (manifest.image_size, manifest.image_size)
+
+# Most uploads are close ups of a single pet, the cascade skips DETR for them
+fast_detector = None
+if config.detector_cascade:
+    fast_detector = FastPetDetector(config.cascade_confidence, config.cascade_uncertainty)
+extractor = DetrPetExtractor(config.model_path, fast_detector=fast_detector)
+
 
-extractor = DetrPetExtractor(config.model_path)
+def match_threshold():
+    return threshold
 
 
 def create_latent_space(buffer):
-    bytes = BytesIO(buffer)
-    # print(len(bytes))
-    bytes.seek(0)
-    image = Image.open(bytes, formats=["JPEG", "PNG"])
-    image.load()
-    image = image.convert("RGB")
-    print(np.array(image).shape)
-    extracted_pets = extractor.extract([image], [0], output_size=(384, 384))
+    # Phone photos are decoded at about the size DETR runs at, the crop of
+    # the pet at the size the model needs
+    scaled = ScaledImage(buffer, formats=["JPEG", "PNG"])
+    extracted_pets = extractor.extract(
+        [scaled.image], [0], output_size=output_size, sources=[scaled])
     if len(extracted_pets) == 0:
         return np.array([], dtype=np.float32)
-    feature_tensor: Tensor = model(extracted_pets[0][0])
-    return np.reshape(feature_tensor.detach().to(device="cpu").numpy(), -1)
\ No newline at end of file
+    return np.reshape(embed(model, [extracted_pets[0][0]]), -1)
\ No newline at end of file
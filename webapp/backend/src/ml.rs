@@ -2,18 +2,28 @@ use pyo3::{
     types::{PyByteArray, PyModule},
     Python,
 };
+use std::sync::{
+    atomic::{AtomicU32, Ordering},
+    Arc,
+};
 use tokio::{
     sync::{mpsc, oneshot},
     task::spawn_blocking,
 };
 
+/// Distance used until the model reports its calibrated threshold
+const DEFAULT_THRESHOLD: f32 = 1.66;
+
 pub struct ImageFeatureExtractor {
     sender: mpsc::Sender<(Vec<u8>, oneshot::Sender<Option<Vec<f32>>>)>,
+    threshold: Arc<AtomicU32>,
 }
 
 impl ImageFeatureExtractor {
     pub fn launch() -> ImageFeatureExtractor {
         let (sender, mut receiver) = mpsc::channel::<(Vec<u8>, oneshot::Sender<Option<Vec<f32>>>)>(20);
+        let threshold = Arc::new(AtomicU32::new(DEFAULT_THRESHOLD.to_bits()));
+        let model_threshold = threshold.clone();
         spawn_blocking(move || {
             Python::with_gil(move |py| {
                 // Load the module from file
@@ -21,6 +31,15 @@ impl ImageFeatureExtractor {
                     .map_err(|e| format!("{:?} {}", &e, e.traceback(py).unwrap().format().unwrap()))
                     .unwrap();
 
+                // The threshold is stored in the manifest next to the model
+                if let Ok(value) = module
+                    .getattr("match_threshold")
+                    .and_then(|f| f.call0())
+                    .and_then(|v| v.extract::<f32>())
+                {
+                    model_threshold.store(value.to_bits(), Ordering::Relaxed);
+                }
+
                 // Call a function in the module
                 let func = module.getattr("create_latent_space").unwrap();
 
@@ -39,7 +58,11 @@ impl ImageFeatureExtractor {
             });
         });
 
-        ImageFeatureExtractor { sender }
+        ImageFeatureExtractor { sender, threshold }
+    }
+
+    pub fn threshold(&self) -> f32 {
+        f32::from_bits(self.threshold.load(Ordering::Relaxed))
     }
 
     pub async fn extract(&self, bytes: Vec<u8>) -> Option<Vec<f32>> {